@@ -0,0 +1,113 @@
+# bench/booking_stress.py
+# Стресс-проверка бронирования: сотни параллельных бронирований (и отмен) одной поездки.
+# Проверяет, что мест не продано больше, чем есть, и что места не теряются:
+#   available_seats + сумма подтвержденных мест == total_seats
+#
+# Запуск из корня проекта:
+#   python -m bench.booking_stress --passengers 500 --seats 40 --workers 32
+# По умолчанию используется временный файл SQLite; для PostgreSQL задайте BENCH_DATABASE_URL.
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix="bottaxi_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_tmp_dir}/bench.db")
+os.environ.setdefault("BOT_TOKEN", "bench")
+
+from sqlalchemy import func # noqa: E402
+from src.database import crud, models # noqa: E402
+from src.database.database import init_db, session_scope, SessionLocal # noqa: E402
+
+def seed(passengers: int, seats: int) -> tuple[int, list[int]]:
+    """Создает водителя, поездку и пассажиров. Возвращает id поездки и id пассажиров."""
+    with session_scope() as db:
+        driver = crud.create_user(db, telegram_id=1, full_name="Водитель Тестовый", phone_number="+70000000001")
+        trip = crud.create_trip(
+            db, driver_id=driver.id, departure_city="Москва", arrival_city="Тверь",
+            departure_datetime=datetime.now() + timedelta(days=1),
+            estimated_arrival_datetime=datetime.now() + timedelta(days=1, hours=3),
+            total_seats=seats,
+        )
+        passenger_ids = [
+            crud.create_user(db, telegram_id=1000 + i, full_name=f"Пассажир {i}", phone_number=f"+7{i:010d}").id
+            for i in range(passengers)
+        ]
+        return trip.id, passenger_ids
+
+def book(trip_id: int, passenger_id: int) -> int | None:
+    with session_scope() as db: # Отдельная сессия (и соединение) на каждый "апдейт", коммит - при выходе
+        booking = crud.create_booking(db, passenger_id=passenger_id, trip_id=trip_id, seats=1)
+        return booking.id if booking else None
+
+def cancel(booking_id: int) -> bool:
+    with session_scope() as db:
+        return crud.cancel_booking(db, booking_id, cancelled_by="passenger") is not None
+
+def check_invariants(trip_id: int) -> tuple[int, int, int]:
+    db = SessionLocal()
+    try:
+        trip = crud.get_trip_by_id(db, trip_id)
+        confirmed = db.query(func.coalesce(func.sum(models.Booking.seats_booked), 0)).filter(
+            models.Booking.trip_id == trip_id, models.Booking.status == 'confirmed'
+        ).scalar()
+        return trip.total_seats, trip.available_seats, confirmed
+    finally:
+        db.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Стресс-проверка параллельного бронирования")
+    parser.add_argument("--passengers", type=int, default=300)
+    parser.add_argument("--seats", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=32)
+    parser.add_argument("--cancel-ratio", type=float, default=0.3, help="Доля успешных броней, отменяемых параллельно")
+    args = parser.parse_args()
+
+    init_db()
+    trip_id, passenger_ids = seed(args.passengers, args.seats)
+    print(f"База: {os.environ['DATABASE_URL']}; поездка #{trip_id}, мест: {args.seats}, пассажиров: {len(passenger_ids)}")
+
+    # Фаза 1: все пассажиры одновременно бронируют
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        results = list(pool.map(lambda pid: (pid, book(trip_id, pid)), passenger_ids))
+    booking_ids = [booking_id for _, booking_id in results if booking_id]
+    elapsed = time.perf_counter() - started
+    print(f"Фаза 1: успешных броней {len(booking_ids)} за {elapsed:.2f} с")
+
+    # Фаза 2: часть броней отменяется, одновременно оставшиеся пассажиры бронируют освободившиеся места
+    to_cancel = random.sample(booking_ids, int(len(booking_ids) * args.cancel_ratio))
+    rest = [pid for pid, booking_id in results if not booking_id]
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        cancel_futures = [pool.submit(cancel, bid) for bid in to_cancel]
+        # Повторная отмена тех же броней не должна вернуть места дважды
+        cancel_futures += [pool.submit(cancel, bid) for bid in to_cancel]
+        book_futures = [pool.submit(book, trip_id, pid) for pid in rest]
+        cancelled = sum(f.result() for f in cancel_futures)
+        rebooked = sum(1 for f in book_futures if f.result())
+    print(f"Фаза 2: отменено {cancelled} (из {len(to_cancel)}), дозабронировано {rebooked}")
+
+    total, available, confirmed = check_invariants(trip_id)
+    print(f"Итог: всего мест {total}, свободно {available}, подтверждено {confirmed}")
+
+    errors = []
+    if len(booking_ids) > total:
+        errors.append(f"перепродажа в фазе 1: {len(booking_ids)} броней на {total} мест")
+    if cancelled != len(to_cancel):
+        errors.append(f"отменено {cancelled} броней вместо {len(to_cancel)}")
+    if available < 0:
+        errors.append(f"отрицательное число свободных мест: {available}")
+    if available + confirmed != total:
+        errors.append(f"потеряны места: {available} + {confirmed} != {total}")
+    if errors:
+        print("ОШИБКА: " + "; ".join(errors))
+        return 1
+    print("OK: перепродаж и потерянных мест нет")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# bench/find_trips_bench.py
+# Замер задержки поиска поездок (crud.find_trips) на большой таблице trips.
+# Для сравнения замеряется и прежний вариант поиска (ILIKE '%город%'), который не может использовать индекс.
+#
+# Запуск из корня проекта:
+#   python -m bench.find_trips_bench --trips 1000000 --queries 200
+# По умолчанию используется временный файл SQLite; для PostgreSQL задайте BENCH_DATABASE_URL.
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix="bottaxi_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_tmp_dir}/bench.db")
+os.environ.setdefault("BOT_TOKEN", "bench")
+
+from sqlalchemy import insert, text # noqa: E402
+from src.database import crud, models # noqa: E402
+from src.database.database import init_db, engine, SessionLocal # noqa: E402
+from src.utils.cities import city_key # noqa: E402
+
+CITIES = ["Москва", "Санкт-Петербург", "Тверь", "Орёл", "Казань", "Нижний Новгород", "Самара", "Воронеж",
+          "Ярославль", "Владимир", "Рязань", "Тула", "Калуга", "Смоленск", "Курск", "Белгород",
+          "Липецк", "Тамбов", "Пенза", "Саратов", "Ульяновск", "Чебоксары", "Иваново", "Кострома"]
+
+def seed(trips: int, drivers: int, days: int, batch: int = 50_000) -> datetime:
+    """Заполняет таблицы пакетными INSERT. Возвращает дату первого дня расписания."""
+    base = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    with engine.begin() as conn:
+        conn.execute(insert(models.User), [
+            {"telegram_id": 10_000 + i, "full_name": f"Водитель {i}", "phone_number": f"+7{i:010d}",
+             "role": "driver", "is_blocked": i % 50 == 0}
+            for i in range(drivers)
+        ])
+    rnd = random.Random(42)
+    statuses = ["scheduled"] * 8 + ["cancelled", "completed"]
+    for start in range(0, trips, batch):
+        rows = []
+        for _ in range(min(batch, trips - start)):
+            dep, arr = rnd.sample(CITIES, 2)
+            dep_dt = base + timedelta(days=rnd.randrange(days), minutes=rnd.randrange(24 * 60))
+            seats = rnd.randint(1, 8)
+            rows.append({
+                "driver_id": rnd.randint(1, drivers), "departure_city": dep, "arrival_city": arr,
+                "departure_key": city_key(dep), "arrival_key": city_key(arr),
+                "departure_datetime": dep_dt, "estimated_arrival_datetime": dep_dt + timedelta(hours=4),
+                "total_seats": seats, "available_seats": rnd.randint(0, seats), "status": rnd.choice(statuses),
+            })
+        with engine.begin() as conn:
+            conn.execute(insert(models.Trip), rows)
+        print(f"  вставлено {start + len(rows)}/{trips}", end="\r", flush=True)
+    print()
+    if engine.dialect.name == "sqlite":
+        with engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+    return base
+
+def legacy_find_trips(db, departure_city: str, arrival_city: str, trip_date) -> list:
+    """Прежняя реализация поиска (ILIKE с ведущим %), для сравнения."""
+    start_of_day = datetime.combine(trip_date, datetime.min.time())
+    end_of_day = datetime.combine(trip_date, datetime.max.time())
+    return db.query(models.Trip).join(models.User).filter(
+        models.Trip.departure_city.ilike(f"%{departure_city}%"),
+        models.Trip.arrival_city.ilike(f"%{arrival_city}%"),
+        models.Trip.departure_datetime >= start_of_day,
+        models.Trip.departure_datetime <= end_of_day,
+        models.Trip.available_seats > 0,
+        models.Trip.status == 'scheduled',
+        models.User.is_blocked == False
+    ).order_by(models.Trip.departure_datetime).all()
+
+def measure(search, queries: list) -> list[float]:
+    timings = []
+    for dep, arr, day in queries:
+        db = SessionLocal()
+        try:
+            started = time.perf_counter()
+            search(db, dep, arr, day)
+            timings.append((time.perf_counter() - started) * 1000)
+        finally:
+            db.close()
+    return timings
+
+def report(name: str, timings: list[float]) -> None:
+    timings = sorted(timings)
+    p = lambda q: timings[min(len(timings) - 1, int(len(timings) * q))]
+    print(f"{name:<28} p50={p(0.50):8.2f} мс  p95={p(0.95):8.2f} мс  p99={p(0.99):8.2f} мс  "
+          f"среднее={statistics.mean(timings):8.2f} мс")
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Замер задержки поиска поездок")
+    parser.add_argument("--trips", type=int, default=1_000_000)
+    parser.add_argument("--drivers", type=int, default=5_000)
+    parser.add_argument("--days", type=int, default=90, help="На сколько дней вперед распределены поездки")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--skip-legacy", action="store_true", help="Не замерять прежний поиск через ILIKE")
+    args = parser.parse_args()
+
+    init_db()
+    print(f"База: {os.environ['DATABASE_URL']}; заполнение {args.trips} поездок...")
+    started = time.perf_counter()
+    base = seed(args.trips, args.drivers, args.days)
+    print(f"Заполнено за {time.perf_counter() - started:.1f} с")
+
+    rnd = random.Random(7)
+    # Пользователи вводят названия по-разному: регистр, пробелы, ё/е
+    variants = lambda city: rnd.choice([city, city.lower(), f"  {city.upper()} ", city.replace("ё", "е")])
+    queries = [(variants(dep), variants(arr), (base + timedelta(days=rnd.randrange(args.days))).date())
+               for dep, arr in (rnd.sample(CITIES, 2) for _ in range(args.queries))]
+
+    if engine.dialect.name == "sqlite":
+        dep, arr, day = queries[0]
+        db = SessionLocal()
+        try:
+            compiled = db.query(models.Trip).filter(
+                models.Trip.departure_key == city_key(dep), models.Trip.arrival_key == city_key(arr),
+                models.Trip.departure_datetime >= datetime.combine(day, datetime.min.time()),
+                models.Trip.departure_datetime <= datetime.combine(day, datetime.max.time()),
+                models.Trip.status == 'scheduled',
+            ).statement.compile(engine, compile_kwargs={"literal_binds": True})
+            plan = db.execute(text(f"EXPLAIN QUERY PLAN {compiled}")).fetchall()
+            print("План запроса:", "; ".join(row[-1] for row in plan))
+        finally:
+            db.close()
+
+    db = SessionLocal()
+    try:
+        found = sum(len(crud.find_trips(db, dep, arr, day)) for dep, arr, day in queries[:20])
+    finally:
+        db.close()
+    print(f"Найдено поездок в первых 20 запросах: {found}")
+    report("find_trips (индекс)", measure(crud.find_trips, queries))
+    if not args.skip_legacy:
+        report("ILIKE '%город%' (прежний)", measure(legacy_find_trips, queries[: max(1, args.queries // 10)]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# bench/notify_bench.py
+# Проверка очереди уведомлений (utils/notifier.py) на заглушке Bot API:
+# - сколько времени "обработчик" тратит на постановку рассылки в очередь;
+# - не превышаются ли общий лимит и лимит на чат;
+# - RetryAfter от Telegram выдерживается и сообщение доставляется повторно.
+#
+# Запуск из корня проекта:
+#   python -m bench.notify_bench --trips 50 --seats 8 --latency 0.05
+import argparse
+import asyncio
+import os
+import sys
+import time
+from collections import defaultdict
+
+os.environ.setdefault("BOT_TOKEN", "bench")
+
+from telegram.error import RetryAfter # noqa: E402
+from src.utils.notifier import NotificationDispatcher # noqa: E402
+
+class FakeBot:
+    """Имитирует send_message: задержка сети, изредка - RetryAfter."""
+
+    def __init__(self, latency: float, retry_every: int):
+        self.latency = latency
+        self.retry_every = retry_every
+        self.calls = 0
+        self.sent: list[tuple[float, int]] = [] # (время, chat_id)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.retry_every and self.calls % self.retry_every == 0:
+            raise RetryAfter(1)
+        self.sent.append((time.monotonic(), chat_id))
+
+def max_in_window(times: list[float], window: float) -> int:
+    """Наибольшее число событий в любом окне длиной window секунд."""
+    best, start = 0, 0
+    for end in range(len(times)):
+        while times[end] - times[start] >= window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+async def run(args) -> int:
+    bot = FakeBot(args.latency, args.retry_every)
+    dispatcher = NotificationDispatcher(workers=args.workers, global_rate=args.global_rate, chat_rate=args.chat_rate)
+    dispatcher.start(bot)
+
+    # Отмена trips поездок по seats пассажиров + каждому пассажиру второе сообщение (склеится с первым)
+    started = time.perf_counter()
+    for trip in range(args.trips):
+        for seat in range(args.seats):
+            chat_id = trip * args.seats + seat
+            dispatcher.notify(chat_id, f"Поездка #{trip} отменена водителем.")
+            dispatcher.notify(chat_id, f"Ваше бронирование в поездке #{trip} отменено.")
+    enqueue_ms = (time.perf_counter() - started) * 1000
+    messages = args.trips * args.seats * 2
+
+    started = time.monotonic()
+    await dispatcher.stop(timeout=3600)
+    elapsed = time.monotonic() - started
+
+    per_chat = defaultdict(list)
+    for sent_at, chat_id in bot.sent:
+        per_chat[chat_id].append(sent_at)
+    all_times = sorted(sent_at for sent_at, _ in bot.sent)
+    global_peak = max_in_window(all_times, 1.0)
+    chat_peak = max(max_in_window(times, 1.0) for times in per_chat.values())
+    delivered_chats = len(per_chat)
+
+    print(f"Сообщений поставлено: {messages} за {enqueue_ms:.1f} мс (последовательная отправка заняла бы "
+          f"~{messages * args.latency:.1f} с внутри обработчиков)")
+    print(f"Доставлено в {delivered_chats}/{args.trips * args.seats} чатов за {elapsed:.1f} с, "
+          f"вызовов API: {bot.calls}, статистика: {dispatcher.stats}")
+    print(f"Пик за 1 с: всего {global_peak} (лимит {args.global_rate:g}), в один чат {chat_peak} (лимит {args.chat_rate:g})")
+
+    # Корзина емкостью 1 допускает одно "лишнее" сообщение на границе окна
+    ok = (delivered_chats == args.trips * args.seats and global_peak <= args.global_rate + 1
+          and chat_peak <= max(1, args.chat_rate))
+    print("OK" if ok else "ОШИБКА: превышен лимит или потеряны сообщения")
+    return 0 if ok else 1
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Проверка очереди уведомлений на заглушке Bot API")
+    parser.add_argument("--trips", type=int, default=20)
+    parser.add_argument("--seats", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--global-rate", type=float, default=25)
+    parser.add_argument("--chat-rate", type=float, default=1)
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа заглушки, с")
+    parser.add_argument("--retry-every", type=int, default=50, help="Каждый N-й вызов отвечает RetryAfter (0 - никогда)")
+    return asyncio.run(run(parser.parse_args()))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,92 @@
+# bench/query_count.py
+# Проверка N+1: число SQL-запросов на вывод страницы поездок/броней/водителей не должно зависеть
+# от числа строк. Для каждого размера страницы выполняется чтение с профилем загрузки и
+# форматирование результата теми же функциями, что и в обработчиках.
+#
+# Запуск из корня проекта:
+#   python -m bench.query_count --sizes 1 10 100
+# Код возврата 1, если число запросов растет с размером страницы.
+import argparse
+import os
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix="bottaxi_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_tmp_dir}/bench.db")
+os.environ.setdefault("BOT_TOKEN", "bench")
+os.environ["TRIP_SEARCH_CACHE_TTL"] = "0" # Считаем запросы к БД, а не попадания в кэш
+
+from src.database import crud # noqa: E402
+from src.database.database import init_db, count_queries, session_scope, SessionLocal # noqa: E402
+from src.utils.helpers import format_trip_details, format_booking_details # noqa: E402
+from src.keyboards.inline import trips_keyboard # noqa: E402
+
+_next_telegram_id = iter(range(1, 10**9))
+
+def seed(size: int) -> tuple[int, int]:
+    """Создает size водителей с поездками по одному маршруту и пассажира с size бронями."""
+    departure = datetime.now().replace(hour=8, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    with session_scope() as db:
+        passenger = crud.create_user(db, next(_next_telegram_id), f"Пассажир {size}", "+79990000000")
+        first_driver_id = None
+        for i in range(size):
+            driver = crud.create_user(db, next(_next_telegram_id), f"Водитель {size}-{i}", f"+7{i:010d}")
+            crud.create_driver_profile(db, driver.id, "Лада", "Веста", "белый", f"А{i:03d}АА{size}")
+            first_driver_id = first_driver_id or driver.id
+            # Маршрут уникален для размера страницы, чтобы страницы не пересекались
+            trip = crud.create_trip(db, driver.id, f"Город {size}", "Тверь", departure + timedelta(minutes=i),
+                                    departure + timedelta(hours=3), 4)
+            crud.create_booking(db, passenger.id, trip.id)
+        # Все поездки одного водителя - для проверки "мои поездки"
+        for i in range(size):
+            crud.create_trip(db, first_driver_id, "Москва", f"Город {size}-{i}", departure + timedelta(hours=i),
+                             departure + timedelta(hours=i + 3), 4)
+        return passenger.id, first_driver_id
+
+def run_case(action) -> int:
+    db = SessionLocal()
+    try:
+        with count_queries() as counter:
+            action(db)
+        return counter.count
+    finally:
+        db.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Проверка числа SQL-запросов на страницу результатов")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 10, 100])
+    args = parser.parse_args()
+
+    init_db()
+    cases = {
+        "поиск (кнопки)": lambda db, size, ids: trips_keyboard(
+            crud.find_trips(db, f"Город {size}", "Тверь", (datetime.now() + timedelta(days=1)).date())),
+        "поиск (карточки)": lambda db, size, ids: [format_trip_details(t) for t in crud.find_trips(
+            db, f"Город {size}", "Тверь", (datetime.now() + timedelta(days=1)).date(), load=crud.LOAD_TRIP_CARD)],
+        "мои поездки": lambda db, size, ids: [format_trip_details(t) for t in crud.get_driver_trips(
+            db, ids[1], load=crud.LOAD_TRIP_CARD)],
+        "мои бронирования": lambda db, size, ids: [format_booking_details(b) for b in crud.get_user_bookings(
+            db, ids[0], load=crud.LOAD_BOOKING_CARD)],
+        "список водителей": lambda db, size, ids: [d.driver_profile.car_plate for d in crud.get_all_drivers(
+            db, load=crud.LOAD_DRIVER_PROFILE)],
+        "водители (поток)": lambda db, size, ids: [d.driver_profile.car_plate for d in crud.iter_drivers(db)],
+    }
+
+    results: dict[str, list[int]] = {name: [] for name in cases}
+    for size in args.sizes:
+        ids = seed(size)
+        for name, action in cases.items():
+            results[name].append(run_case(lambda db: action(db, size, ids)))
+
+    print(f"{'Сценарий':<20}" + "".join(f"{f'N={size}':>10}" for size in args.sizes))
+    failed = False
+    for name, counts in results.items():
+        # Список водителей растет с каждым сидом, но число запросов все равно должно быть постоянным
+        constant = len(set(counts)) == 1
+        failed |= not constant
+        print(f"{name:<20}" + "".join(f"{count:>10}" for count in counts) + ("" if constant else "   <- N+1"))
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
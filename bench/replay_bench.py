@@ -0,0 +1,231 @@
+# bench/replay_bench.py
+# Прогон апдейтов через настоящее приложение бота (bot.build_application: все обработчики,
+# persistence, фильтр заблокированных, очередь уведомлений) с заглушкой Bot API вместо Telegram.
+# Сценарий по умолчанию: регистрация пассажиров, диалог /find_trip, бронирование (book_),
+# отмена поездок водителями (cancel_trip_). Либо --updates: файл с записанными апдейтами
+# (по одному JSON Update в строке). Отчет: пропускная способность, p50/p95/p99 по типам апдейтов,
+# SQL-запросов на апдейт и вызовы Bot API.
+#
+# Запуск из корня проекта:
+#   python -m bench.replay_bench --users 200 --drivers 20 --trips 40 --latency 0.02
+#   python -m bench.replay_bench --updates updates.jsonl
+# Код возврата 1, если обработчики завершились с ошибками.
+# На SQLite с --latency видны ожидания блокировки записи: синхронный обработчик ждет (до busy_timeout,
+# блокируя цикл событий) транзакцию фоновой асинхронной записи (outbox, persistence), которой нужен этот цикл.
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix="bottaxi_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_tmp_dir}/bench.db")
+os.environ["BOT_TOKEN"] = "123456:bench"
+os.environ.setdefault("ADMIN_IDS", "1")
+
+from telegram import Update # noqa: E402
+from telegram.request import BaseRequest # noqa: E402
+from src import bot # noqa: E402
+from src.database import crud, models # noqa: E402
+from src.database.database import init_db, count_queries, session_scope # noqa: E402
+from src.database.async_database import async_engine # noqa: E402
+
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "BotTaxi", "username": "bottaxi_bench_bot",
+            "can_join_groups": False, "can_read_all_group_messages": False, "supports_inline_queries": False}
+DRIVER_TG_ID = 10_000 # telegram_id водителей: DRIVER_TG_ID + i
+PASSENGER_TG_ID = 100_000
+
+class FakeBotAPI(BaseRequest):
+    """Заглушка Bot API на уровне HTTP-транспорта python-telegram-bot: отвечает как Telegram
+    (с задержкой latency) и записывает все вызовы."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter[str] = Counter()
+        self._message_id = 0
+
+    @property
+    def read_timeout(self) -> float | None:
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls[api_method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if api_method == "getMe":
+            result = BOT_USER
+        elif api_method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            self._message_id += 1
+            result = {"message_id": params.get("message_id", self._message_id), "date": int(time.time()),
+                      "chat": {"id": params.get("chat_id", 0), "type": "private"}, "text": params.get("text", "")}
+        else:
+            result = True # answerCallbackQuery, setMyCommands и т.п.
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+# --- Синтетические апдейты ---
+
+_update_ids = iter(range(1, 10**9))
+
+def _user(user_id: int) -> dict:
+    return {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+
+def _message(user_id: int, **fields) -> dict:
+    return {"message_id": next(_update_ids), "date": int(time.time()), "from": _user(user_id),
+            "chat": {"id": user_id, "type": "private"}, **fields}
+
+def text_update(user_id: int, text: str) -> dict:
+    fields = {"text": text}
+    if text.startswith("/"):
+        fields["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": next(_update_ids), "message": _message(user_id, **fields)}
+
+def contact_update(user_id: int) -> dict:
+    contact = {"phone_number": f"+7999{user_id:07d}", "first_name": f"User{user_id}", "user_id": user_id}
+    return {"update_id": next(_update_ids), "message": _message(user_id, contact=contact)}
+
+def callback_update(user_id: int, data: str) -> dict:
+    return {"update_id": next(_update_ids), "callback_query": {
+        "id": str(next(_update_ids)), "from": _user(user_id), "chat_instance": "bench", "data": data,
+        "message": _message(user_id, text="...")}}
+
+def label(update: Update) -> str:
+    """Тип апдейта для отчета: команда, префикс callback_data или вид сообщения."""
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        return data.rstrip("0123456789_") + "_"
+    message = update.message
+    if message is None:
+        return "прочее"
+    if message.contact:
+        return "контакт"
+    if message.text and message.text.startswith("/"):
+        return message.text.split()[0]
+    return "текст"
+
+def seed(drivers: int, trips: int, seats: int) -> list[tuple[int, int]]:
+    """Водители и поездки Москва - Тверь на завтра. Возвращает [(id поездки, telegram_id водителя)]."""
+    departure = datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    result = []
+    with session_scope() as db:
+        driver_users = []
+        for i in range(drivers):
+            user = crud.create_user(db, DRIVER_TG_ID + i, f"Водитель {i}", f"+7000{i:07d}")
+            crud.create_driver_profile(db, user.id, "Лада", "Веста", "белый", f"А{i:03d}АА77")
+            driver_users.append(user)
+        for i in range(trips):
+            driver = driver_users[i % drivers]
+            trip = crud.create_trip(db, driver.id, "Москва", "Тверь", departure + timedelta(minutes=i),
+                                    departure + timedelta(hours=3), seats)
+            result.append((trip.id, driver.telegram_id))
+    return result
+
+def scenario(users: int, trips: list[tuple[int, int]]) -> list[tuple[str, list[dict]]]:
+    """Шаги сценария. Апдейты одного шага - от разных пользователей и обрабатываются параллельно."""
+    passengers = [PASSENGER_TG_ID + i for i in range(users)]
+    trip_date = (datetime.now() + timedelta(days=1)).strftime("%d.%m.%Y")
+    return [
+        ("регистрация: /start", [text_update(p, "/start") for p in passengers]),
+        ("регистрация: контакт", [contact_update(p) for p in passengers]),
+        ("регистрация: ФИО", [text_update(p, f"Пассажир Тестовый {p}") for p in passengers]),
+        ("поиск: /find_trip", [text_update(p, "/find_trip") for p in passengers]),
+        ("поиск: откуда", [text_update(p, "Москва") for p in passengers]),
+        ("поиск: куда", [text_update(p, "Тверь") for p in passengers]),
+        ("поиск: дата", [text_update(p, trip_date) for p in passengers]),
+        ("бронирование", [callback_update(p, f"book_{trips[i % len(trips)][0]}") for i, p in enumerate(passengers)]),
+        ("отмена поездки", [callback_update(driver_tg_id, f"cancel_trip_{trip_id}") for trip_id, driver_tg_id in trips]),
+    ]
+
+def percentile(values: list[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+async def run(args) -> int:
+    init_db()
+    fake_api = FakeBotAPI(args.latency)
+    application = bot.build_application(fake_api)
+    errors: list[BaseException] = []
+
+    async def count_error(update, context):
+        errors.append(context.error)
+    application.add_error_handler(count_error)
+
+    await application.initialize()
+    await application.post_init(application)
+
+    if args.updates:
+        with open(args.updates, encoding="utf-8") as f:
+            steps = [("записанные апдейты", [json.loads(line) for line in f if line.strip()])]
+    else:
+        steps = scenario(args.users, seed(args.drivers, args.trips, args.seats))
+
+    latencies: dict[str, list[float]] = defaultdict(list)
+    queries: dict[str, int] = Counter()
+    total_updates = 0
+
+    async def process(update: Update) -> None:
+        started = time.perf_counter()
+        await application.update_processor.process_update(update, application.process_update(update))
+        latencies[label(update)].append(time.perf_counter() - started)
+
+    started_all = time.perf_counter()
+    for step_name, raw_updates in steps:
+        updates = [Update.de_json(raw, application.bot) for raw in raw_updates]
+        # Обработчики работают через асинхронный движок, фоновые задачи и сидирование - и через синхронный
+        with count_queries() as counter, count_queries(async_engine.sync_engine) as async_counter:
+            await asyncio.gather(*(process(update) for update in updates))
+        queries[step_name] = counter.count + async_counter.count
+        total_updates += len(updates)
+        print(f"{step_name:<24} апдейтов {len(updates):>6}  SQL-запросов на апдейт {queries[step_name] / max(len(updates), 1):>6.1f}")
+    elapsed = time.perf_counter() - started_all
+
+    await application.update_persistence()
+    await application.post_stop(application)
+    await application.shutdown()
+    await application.post_shutdown(application)
+
+    print(f"\nВсего апдейтов: {total_updates} за {elapsed:.2f} с ({total_updates / elapsed:.0f} апдейтов/с), "
+          f"задержка Bot API {args.latency * 1000:.0f} мс")
+    print(f"{'Тип апдейта':<16}{'число':>8}{'p50, мс':>10}{'p95, мс':>10}{'p99, мс':>10}")
+    for name, values in sorted(latencies.items()):
+        print(f"{name:<16}{len(values):>8}{percentile(values, 0.5) * 1000:>10.1f}"
+              f"{percentile(values, 0.95) * 1000:>10.1f}{percentile(values, 0.99) * 1000:>10.1f}")
+    print(f"Вызовы Bot API: {dict(fake_api.calls)}")
+
+    if not args.updates:
+        with session_scope() as db:
+            registered = db.query(models.User).filter(models.User.telegram_id >= PASSENGER_TG_ID).count()
+            bookings = db.query(models.Booking).count()
+        print(f"Зарегистрировано пассажиров: {registered}/{args.users}, бронирований: {bookings}")
+    if errors:
+        print(f"ОШИБКИ в обработчиках: {len(errors)}, первая: {errors[0]!r}")
+        return 1
+    return 0
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Прогон апдейтов через приложение бота с заглушкой Bot API")
+    parser.add_argument("--users", type=int, default=200, help="Пассажиров в сценарии")
+    parser.add_argument("--drivers", type=int, default=20)
+    parser.add_argument("--trips", type=int, default=40)
+    parser.add_argument("--seats", type=int, default=4)
+    parser.add_argument("--latency", type=float, default=0.0, help="Задержка ответа заглушки Bot API, с")
+    parser.add_argument("--updates", help="Файл с записанными апдейтами (JSON Update в каждой строке)")
+    args = parser.parse_args()
+    logging.disable(logging.WARNING) # Логи каждого апдейта (и ожидаемых отказов в брони) исказили бы замеры
+    return asyncio.run(run(args))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,120 @@
+# bench/write_queries.py
+# Число SQL-запросов и время на одно бронирование/отмену: прежний путь записи (коммит истекает объекты,
+# после него db.refresh) против текущего (expire_on_commit=False, RETURNING, synchronize_session='evaluate').
+# Как и в обработчике book_trip_callback, после записи используется результат: бронь и места поездки.
+#
+# Запуск из корня проекта:
+#   python -m bench.write_queries --bookings 500
+import argparse
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+_tmp_dir = tempfile.mkdtemp(prefix="bottaxi_bench_")
+os.environ["DATABASE_URL"] = os.getenv("BENCH_DATABASE_URL", f"sqlite:///{_tmp_dir}/bench.db")
+os.environ.setdefault("BOT_TOKEN", "bench")
+
+from sqlalchemy.orm import sessionmaker # noqa: E402
+from src.database import crud, models # noqa: E402
+from src.database.database import init_db, engine, count_queries, session_scope, SessionLocal # noqa: E402
+
+# Сессия с прежними настройками: после коммита все объекты истекают
+LegacySessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+def legacy_create_booking(db, passenger_id: int, trip_id: int, seats: int = 1):
+    """Прежняя реализация: условный UPDATE, коммит и два refresh."""
+    existing_booking = db.query(models.Booking).filter(
+        models.Booking.passenger_id == passenger_id, models.Booking.trip_id == trip_id
+    ).first()
+    if existing_booking and existing_booking.status == 'confirmed':
+        return None
+    reserved = db.query(models.Trip).filter(
+        models.Trip.id == trip_id, models.Trip.status == 'scheduled', models.Trip.available_seats >= seats
+    ).update({models.Trip.available_seats: models.Trip.available_seats - seats}, synchronize_session=False)
+    if not reserved:
+        db.rollback()
+        return None
+    db_booking = models.Booking(passenger_id=passenger_id, trip_id=trip_id, seats_booked=seats, status='confirmed')
+    db.add(db_booking)
+    db.commit()
+    db.refresh(db_booking)
+    return db_booking
+
+def legacy_cancel_booking(db, booking_id: int, cancelled_by: str = "passenger"):
+    """Прежняя реализация отмены: два условных UPDATE, коммит и refresh брони и поездки."""
+    db_booking = db.query(models.Booking).filter(models.Booking.id == booking_id).first()
+    if not db_booking or db_booking.status != 'confirmed':
+        return None
+    db_trip = db_booking.trip
+    new_status = 'cancelled_by_driver' if cancelled_by == "driver" else 'cancelled_by_passenger'
+    db.query(models.Booking).filter(models.Booking.id == booking_id, models.Booking.status == 'confirmed').update(
+        {models.Booking.status: new_status}, synchronize_session=False)
+    db.query(models.Trip).filter(models.Trip.id == db_trip.id).update(
+        {models.Trip.available_seats: models.Trip.available_seats + db_booking.seats_booked}, synchronize_session=False)
+    db.commit()
+    db.refresh(db_booking)
+    db.refresh(db_trip)
+    return db_booking
+
+def seed(bookings: int) -> tuple[list[int], list[int]]:
+    """Водитель, bookings пассажиров и по поездке на каждую пару "прежний/текущий" прогон."""
+    with session_scope() as db:
+        driver = crud.create_user(db, 1, "Водитель", "+70000000000")
+        crud.create_driver_profile(db, driver.id, "Лада", "Веста", "белый", "А000АА77")
+        departure = datetime.now() + timedelta(days=1)
+        trips = [crud.create_trip(db, driver.id, "Москва", "Тверь", departure, departure + timedelta(hours=3), bookings).id
+                 for _ in range(2)]
+        passengers = [crud.create_user(db, 1000 + i, f"Пассажир {i}", "+79990000000").id for i in range(bookings)]
+        return trips, passengers
+
+def run(session_factory, book, cancel, trip_id: int, passengers: list[int]) -> dict:
+    totals = {"book_queries": 0, "cancel_queries": 0, "book_ms": 0.0, "cancel_ms": 0.0}
+    booking_ids = []
+    for passenger_id in passengers:
+        db = session_factory()
+        try:
+            started = time.perf_counter()
+            with count_queries() as counter:
+                booking = book(db, passenger_id, trip_id)
+                db.commit() # Текущий crud не коммитит сам (коммит - в session_scope), у прежнего - no-op
+                # Что показывает book_trip_callback: бронь и оставшиеся места
+                _ = (booking.id, booking.status, booking.booked_at, booking.trip.available_seats)
+            totals["book_ms"] += (time.perf_counter() - started) * 1000
+            totals["book_queries"] += counter.count
+            booking_ids.append(booking.id)
+        finally:
+            db.close()
+    for booking_id in booking_ids:
+        db = session_factory()
+        try:
+            started = time.perf_counter()
+            with count_queries() as counter:
+                booking = cancel(db, booking_id)
+                db.commit()
+                _ = (booking.status, booking.trip.available_seats)
+            totals["cancel_ms"] += (time.perf_counter() - started) * 1000
+            totals["cancel_queries"] += counter.count
+        finally:
+            db.close()
+    return {key: value / len(passengers) for key, value in totals.items()}
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Запросы на бронирование и отмену: прежний и текущий путь записи")
+    parser.add_argument("--bookings", type=int, default=200)
+    args = parser.parse_args()
+
+    init_db()
+    (legacy_trip, current_trip), passengers = seed(args.bookings)
+    results = {
+        "прежний (refresh)": run(LegacySessionLocal, legacy_create_booking, legacy_cancel_booking, legacy_trip, passengers),
+        "текущий": run(SessionLocal, crud.create_booking, crud.cancel_booking, current_trip, passengers),
+    }
+    print(f"{'Путь записи':<20}{'запросов/бронь':>16}{'мс/бронь':>10}{'запросов/отмена':>17}{'мс/отмена':>11}")
+    for name, r in results.items():
+        print(f"{name:<20}{r['book_queries']:>16.1f}{r['book_ms']:>10.2f}{r['cancel_queries']:>17.1f}{r['cancel_ms']:>11.2f}")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
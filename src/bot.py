@@ -1,5 +1,6 @@
 # src/bot.py
 import asyncio
+import logging
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -8,17 +9,25 @@ from telegram.ext import (
     MessageHandler,
     CallbackQueryHandler,
     ContextTypes,
-    PicklePersistence, # Для сохранения состояний между перезапусками (опционально)
     Defaults,
     filters
 )
 from telegram.constants import ParseMode
+from telegram.request import BaseRequest, HTTPXRequest
 
 # Конфигурация и логгер
-from src.config import BOT_TOKEN, logger, ADMIN_IDS
+from src.config import (BOT_TOKEN, ADMIN_IDS, MAX_CONCURRENT_UPDATES, RUN_MODE, DB_CREATE_ALL, METRICS_ENABLED,
+                        USER_CACHE_TTL)
 
 # База данных
 from src.database import database, crud
+from src.database.async_database import dispose_async_engine, async_session_scope
+from src.database import async_crud
+from src.utils.cities import load_city_index
+from src.utils.notifier import notifier
+from src.utils.outbox import outbox_sender
+from src.utils.persistence import SQLPersistence
+from src.utils import metrics
 
 # Клавиатуры
 from src.keyboards import reply as reply_kb
@@ -26,28 +35,89 @@ from src.keyboards import inline as inline_kb
 
 # Обработчики
 from src.handlers import common, passenger, driver, admin, support
+from src.utils.update_processor import PerUserUpdateProcessor
+from src.webhook import run_webhook
+
+logger = logging.getLogger(__name__)
+
+# Фоновое перечитывание заблокированных пользователей (запускается в post_init)
+_blocked_refresh_task: asyncio.Task | None = None
+
+async def refresh_blocked_users() -> None:
+    """Раз в USER_CACHE_TTL перечитывает заблокированных из БД: блокировки с других реплик доходят
+    и без Redis, и при потерянном сообщении pub/sub."""
+    while True:
+        await asyncio.sleep(USER_CACHE_TTL)
+        try:
+            async with async_session_scope() as db:
+                await async_crud.load_blocked_users(db)
+        except Exception as e:
+            logger.error("Не удалось перечитать заблокированных пользователей: %s", e)
 
 # --- Основная функция ---
 async def post_init(application: Application) -> None:
     """Действия после инициализации приложения (например, установка команд)."""
     await application.bot.set_my_commands([
-        ('start', ' FONT="monospace"> Запустить бота / Главное меню'),
-        ('find_trip', ' FONT="monospace"> Найти поездку'),
-        ('my_bookings', ' FONT="monospace"> Мои бронирования'),
-        ('create_trip', ' FONT="monospace"> Создать поездку (для водителей)'),
-        ('my_trips', ' FONT="monospace"> Мои поездки (для водителей)'),
-        ('register_driver', ' FONT="monospace"> Стать водителем'),
-        ('support', ' FONT="monospace"> Связь с поддержкой'),
-        ('help', ' FONT="monospace"> Помощь'),
-        ('cancel', ' FONT="monospace"> Отменить текущее действие'),
+        ('start', '🏠 Запустить бота / Главное меню'),
+        ('find_trip', '🔍 Найти поездку'),
+        ('my_bookings', '🎫 Мои бронирования'),
+        ('create_trip', '➕ Создать поездку (для водителей)'),
+        ('my_trips', '🚕 Мои поездки (для водителей)'),
+        ('register_driver', '🚗 Стать водителем'),
+        ('support', '❓ Связь с поддержкой'),
+        ('help', 'ℹ️ Помощь'),
+        ('cancel', '❌ Отменить текущее действие'),
         # Добавить админские команды?
         # ('admin', 'Админ-панель'),
     ])
     logger.info("Команды бота установлены.")
 
+    # Справочник городов: встроенный список + города из уже созданных поездок.
+    # Множество заблокированных пользователей - для фильтра common.blocked_user_gate
+    async with async_session_scope() as db:
+        trip_cities = await async_crud.get_distinct_cities(db)
+        blocked = await async_crud.load_blocked_users(db)
+    city_index = load_city_index(trip_cities)
+    logger.info("Справочник городов загружен: %s городов.", len(city_index))
+    logger.info("Заблокированных пользователей загружено: %s", blocked)
+    crud.start_user_cache_sync() # Сбросы кэша профилей и блокировок от других реплик (если настроен Redis)
+    global _blocked_refresh_task
+    if USER_CACHE_TTL > 0:
+        _blocked_refresh_task = asyncio.create_task(refresh_blocked_users(), name="blocked-users-refresh")
+
+    # Фоновая отправка уведомлений (обработчики только ставят сообщения в очередь или в outbox)
+    notifier.start(application.bot)
+    outbox_sender.start()
+
+    # Мгновенные значения для /metrics (время обработчиков, запросов и Bot API собирается само)
+    metrics.register_gauge("bot_update_queue_size", "Апдейтов в очереди приложения", application.update_queue.qsize)
+    metrics.register_gauge("bot_db_connections_in_use", "Выданных соединений пулов БД (сумма по пулам)",
+                           lambda: database.get_pool_stats()["in_use"])
+    metrics.register_gauge("bot_notifier_queued", "Уведомлений в очереди отправки", lambda: notifier.queued)
+    metrics.register_gauge("bot_outbox_exhausted", "Неотправленных уведомлений outbox, исчерпавших попытки",
+                           lambda: outbox_sender.exhausted)
+    await metrics.start_server()
+
+async def post_stop(application: Application) -> None:
+    """Действия после остановки приема апдейтов: досылаем очередь уведомлений, пока бот еще открыт."""
+    await outbox_sender.stop() # Новые строки outbox больше не берем
+    if _blocked_refresh_task is not None:
+        _blocked_refresh_task.cancel()
+        await asyncio.gather(_blocked_refresh_task, return_exceptions=True)
+    await notifier.stop()
+    await outbox_sender.flush_results() # Отмечаем отправленное, остальное дошлется после перезапуска
+    logger.info("Очередь уведомлений остановлена: %s", notifier.stats)
+
+async def post_shutdown(application: Application) -> None:
+    """Действия при остановке приложения: закрываем асинхронный пул соединений."""
+    await dispose_async_engine()
+    logger.info("Асинхронный пул соединений БД закрыт.")
+    await asyncio.to_thread(crud.stop_user_cache_sync) # Ждет отправки сбросов кэша в Redis, не блокируя цикл
+    await metrics.stop_server()
+
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Логирует ошибки, вызванные Updates."""
-    logger.error(f"Исключение при обработке апдейта {update}:", exc_info=context.error)
+    logger.error("Исключение при обработке апдейта %s:", update, exc_info=context.error)
     # Можно добавить отправку сообщения об ошибке админам
     # if isinstance(update, Update) and update.effective_user:
     #     user_info = f"User: {update.effective_user.id} (@{update.effective_user.username})"
@@ -58,27 +128,37 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     #     try:
     #         await context.bot.send_message(chat_id=admin_id, text=error_message[:4000])
     #     except Exception as e:
-    #         logger.error(f"Не удалось отправить сообщение об ошибке админу {admin_id}: {e}")
+    #         logger.error("Не удалось отправить сообщение об ошибке админу %s: %s", admin_id, e)
 
 
-def main() -> None:
-    """Запуск бота."""
-    logger.info("Инициализация базы данных...")
-    database.init_db() # Создаем таблицы, если их нет
+def build_application(request: BaseRequest | None = None) -> Application:
+    """Собирает приложение со всеми обработчиками (без запуска).
 
-    # Настройка persistence (опционально, для сохранения user_data/chat_data)
-    # persistence = PicklePersistence(filepath="bot_persistence")
+    request - транспорт Bot API; бенчмарк (bench/replay_bench.py) подставляет заглушку.
+    Вызовы Bot API и все обработчики замеряются для /metrics (utils/metrics.py).
+    """
+    # user_data/chat_data и состояния диалогов хранятся в БД и переживают перезапуск
+    persistence = SQLPersistence()
 
     # Установка настроек по умолчанию для парсинга HTML
     defaults = Defaults(parse_mode=ParseMode.HTML)
 
     logger.info("Сборка приложения бота...")
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if request is not None:
+        builder = builder.get_updates_request(request)
+    # Размер пула - как у транспорта, который ApplicationBuilder создает по умолчанию; getUpdates не замеряется
+    api_request = request if request is not None else HTTPXRequest(connection_pool_size=256)
+    builder = builder.request(metrics.InstrumentedRequest(api_request) if METRICS_ENABLED else api_request)
     application = (
-        ApplicationBuilder()
-        .token(BOT_TOKEN)
-        # .persistence(persistence) # Раскомментировать для persistence
+        builder
+        .persistence(persistence)
         .defaults(defaults)
+        # Параллельная обработка апдейтов разных пользователей, по очереди - для одного пользователя
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
         .post_init(post_init) # Установка команд после инициализации
+        .post_stop(post_stop)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -88,6 +168,9 @@ def main() -> None:
     # 0. Обработчик ошибок (должен быть первым)
     application.add_error_handler(error_handler)
 
+    # Апдейты заблокированных пользователей отсекаются до всех обработчиков и до обращения к БД
+    application.add_handler(common.blocked_user_gate_handler, group=-1)
+
     # 1. Conversation Handler для регистрации (из common.py)
     # Он включает /start и должен идти перед другими CommandHandler('start')
     application.add_handler(common.registration_conv_handler)
@@ -117,15 +200,15 @@ def main() -> None:
 
     # 7. Обработчик неизвестных команд (должен быть последним среди CommandHandler)
     # async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    #     await update.message.reply_text(" FONT="monospace"> Неизвестная команда.")
+    #     await update.message.reply_text("🤷 Неизвестная команда.")
     # application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
     # 8. Обработчик текстовых сообщений вне команд и диалогов (если нужно)
     # async def echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
     #     # Пример: если пользователь просто пишет текст, показываем меню
     #     user_tg_id = update.effective_user.id
-    #     db = next(get_db())
-    #     db_user = crud.get_user_by_telegram_id(db, user_tg_id)
+    #     async with async_session_scope(user_tg_id) as db:
+    #         db_user = await async_crud.get_user_by_telegram_id(db, user_tg_id)
     #     if db_user:
     #         if db_user.role == ROLE_ADMIN or user_tg_id in ADMIN_IDS: await admin.admin_menu(update, context)
     #         elif db_user.role == ROLE_DRIVER: await driver.driver_menu(update, context)
@@ -135,14 +218,32 @@ def main() -> None:
     #         await update.message.reply_text("Пожалуйста, используйте /start для начала работы.")
     # application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, echo))
 
+    # Замер времени и SQL-запросов каждого обработчика (после регистрации всех)
+    wrapped = metrics.instrument_handlers(application)
+    if wrapped:
+        logger.info("Метрики включены для %s обработчиков.", wrapped)
+
+    return application
+
+def main() -> None:
+    """Запуск бота."""
+    if DB_CREATE_ALL:
+        logger.info("Инициализация базы данных...")
+        database.init_db() # Создаем таблицы, если их нет (без миграций)
+
+    application = build_application()
 
     # --- Запуск бота ---
-    logger.info("Запуск бота...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if RUN_MODE == 'webhook':
+        logger.info("Запуск бота в режиме webhook...")
+        asyncio.run(run_webhook(application))
+    else:
+        logger.info("Запуск бота...")
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 if __name__ == "__main__":
     try:
         main()
     except Exception as e:
-        logger.critical(f"Критическая ошибка при запуске или работе бота: {e}", exc_info=True)
+        logger.critical("Критическая ошибка при запуске или работе бота: %s", e, exc_info=True)
@@ -2,15 +2,19 @@
 import os
 import logging
 from dotenv import load_dotenv
+from src.utils.logs import setup_logging
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# Настройка логирования (utils/logs.py): запись в stderr идет из фонового потока через очередь.
+# LOG_LEVEL - общий уровень, LOG_FORMAT - text или json (одна запись - одна строка JSON),
+# LOG_LEVELS - уровни отдельных модулей: "src.handlers=DEBUG,src.database.crud=WARNING".
+# httpx по умолчанию WARNING: на INFO он пишет строку на каждый запрос к Bot API.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').strip().lower()
+LOG_LEVELS = os.getenv('LOG_LEVELS', 'httpx=WARNING')
+setup_logging(LOG_LEVEL, LOG_FORMAT, LOG_LEVELS)
 logger = logging.getLogger(__name__)
 
 # Токен Telegram бота
@@ -19,6 +23,22 @@ if not BOT_TOKEN:
     logger.error("Токен бота (BOT_TOKEN) не найден в переменных окружения!")
     raise ValueError("Необходимо установить BOT_TOKEN")
 
+# Режим получения апдейтов: 'polling' (по умолчанию) или 'webhook'
+RUN_MODE = os.getenv('RUN_MODE', 'polling').strip().lower()
+if RUN_MODE not in ('polling', 'webhook'):
+    logger.error("Неизвестный RUN_MODE '%s'. Допустимо: polling, webhook", RUN_MODE)
+    raise ValueError("RUN_MODE должен быть 'polling' или 'webhook'")
+
+# Настройки webhook-сервера (используются только при RUN_MODE=webhook)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/') # Публичный адрес; пусто - вебхук в Telegram не регистрируется (локальные тесты)
+WEBHOOK_PATH = '/' + os.getenv('WEBHOOK_PATH', 'telegram').strip('/')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '') # Сверяется с заголовком X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_BODY_SIZE = int(os.getenv('WEBHOOK_MAX_BODY_SIZE', str(1024 * 1024))) # Байт
+if RUN_MODE == 'webhook' and not WEBHOOK_SECRET:
+    logger.warning("WEBHOOK_SECRET не задан: запросы к вебхуку не проверяются!")
+
 # ID администраторов (список целых чисел)
 ADMIN_IDS_STR = os.getenv('ADMIN_IDS', '')
 try:
@@ -31,7 +51,100 @@ except ValueError:
 
 # Строка подключения к базе данных
 DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///./travel_bot.db')
-logger.info(f"Используется база данных: {DATABASE_URL.split('://')[0]}")
+logger.info("Используется база данных: %s", DATABASE_URL.split('://')[0])
+
+def _to_async_url(url: str) -> str:
+    """Подставляет асинхронный драйвер: aiosqlite для SQLite, asyncpg для PostgreSQL."""
+    scheme, sep, rest = url.partition('://')
+    if scheme in ('sqlite', 'sqlite+pysqlite'):
+        return f"sqlite+aiosqlite{sep}{rest}"
+    if scheme in ('postgres', 'postgresql', 'postgresql+psycopg2'):
+        return f"postgresql+asyncpg{sep}{rest}"
+    return url # Драйвер уже указан явно (или СУБД без известного async-драйвера)
+
+# Строка подключения для асинхронного движка (по умолчанию выводится из DATABASE_URL)
+ASYNC_DATABASE_URL = os.getenv('ASYNC_DATABASE_URL') or _to_async_url(DATABASE_URL)
+
+# Схема БД ведется миграциями (alembic upgrade head, см. src/database/migrations), и при старте бот ее
+# не проверяет. DB_CREATE_ALL=true - создать недостающие таблицы при старте (create_all), удобно для
+# быстрого локального запуска на пустой SQLite.
+DB_CREATE_ALL = os.getenv('DB_CREATE_ALL', 'false').lower() in ('1', 'true', 'yes')
+
+# Реплика только для чтения (необязательно). Поиск и списки (функции crud с @replica_reads) читают с нее,
+# запись и все чтения после записи - с основной БД. Пользователь, который только что что-то изменил,
+# еще DB_READ_STICKY_SECONDS секунд читает с основной БД, чтобы не увидеть данные до своей записи
+# (отставание реплики).
+DATABASE_READ_URL = os.getenv('DATABASE_READ_URL', '')
+ASYNC_DATABASE_READ_URL = os.getenv('ASYNC_DATABASE_READ_URL') or _to_async_url(DATABASE_READ_URL)
+DB_READ_STICKY_SECONDS = float(os.getenv('DB_READ_STICKY_SECONDS', '5'))
+
+# Пул соединений (database.engine_options): постоянные соединения, сверх них временные, ожидание свободного (с),
+# пересоздание соединения старше DB_POOL_RECYCLE секунд и проверка соединения перед выдачей (pre-ping)
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '30'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Ограничение времени одного запроса в PostgreSQL, мс (0 - без ограничения)
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv('DB_STATEMENT_TIMEOUT_MS', '5000'))
+# SQLite: сколько ждать снятия блокировки записи, мс, и размер отображения файла в память, байт (0 - выключено)
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', '5000'))
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)))
+
+# Максимум апдейтов, обрабатываемых одновременно (апдейты одного пользователя всегда идут по очереди).
+# 1 - строго последовательная обработка, как раньше.
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '16'))
+
+# Кэш результатов поиска поездок (crud.find_trips): время жизни в секундах (0 - выключен),
+# максимум записей и максимум закэшированных поездок суммарно (ограничение памяти)
+TRIP_SEARCH_CACHE_TTL = float(os.getenv('TRIP_SEARCH_CACHE_TTL', '60'))
+TRIP_SEARCH_CACHE_SIZE = int(os.getenv('TRIP_SEARCH_CACHE_SIZE', '512'))
+TRIP_SEARCH_CACHE_MAX_TRIPS = int(os.getenv('TRIP_SEARCH_CACHE_MAX_TRIPS', '20000'))
+
+# Кэш отрисованных карточек поездок и броней (utils/helpers.py): ключ включает версию поездки,
+# поэтому сбрасывать его не нужно; TTL только освобождает память от прошедших поездок
+RENDER_CACHE_SIZE = int(os.getenv('RENDER_CACHE_SIZE', '10000'))
+RENDER_CACHE_TTL = float(os.getenv('RENDER_CACHE_TTL', '3600'))
+
+# Размер страницы результатов поиска (кнопки "Назад"/"Далее" листают страницы по курсору)
+TRIP_SEARCH_PAGE_SIZE = int(os.getenv('TRIP_SEARCH_PAGE_SIZE', '10'))
+
+# Кэш профилей пользователей (crud.get_user_profile): роль, блокировка, id, наличие профиля водителя.
+# Сбрасывается при смене роли, блокировке и создании профиля водителя. USER_CACHE_REDIS_URL (необязательно) -
+# рассылка сбросов и блокировок между репликами через Redis pub/sub; без него профили в репликах
+# расходятся не дольше USER_CACHE_TTL. Множество заблокированных (common.blocked_user_gate) каждая реплика
+# перечитывает из БД раз в USER_CACHE_TTL, поэтому и оно расходится не дольше этого времени.
+USER_CACHE_TTL = float(os.getenv('USER_CACHE_TTL', '300'))
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '10000'))
+USER_CACHE_REDIS_URL = os.getenv('USER_CACHE_REDIS_URL', '')
+
+# Очередь уведомлений (utils/notifier.py). Лимиты Telegram: ~30 сообщений в секунду всего
+# и ~1 сообщение в секунду в один чат; значения по умолчанию - с запасом.
+NOTIFY_WORKERS = int(os.getenv('NOTIFY_WORKERS', '4'))
+NOTIFY_GLOBAL_RATE = float(os.getenv('NOTIFY_GLOBAL_RATE', '25')) # Сообщений в секунду
+NOTIFY_CHAT_RATE = float(os.getenv('NOTIFY_CHAT_RATE', '1')) # Сообщений в секунду в один чат
+NOTIFY_QUEUE_SIZE = int(os.getenv('NOTIFY_QUEUE_SIZE', '10000')) # При переполнении новые сообщения отбрасываются
+NOTIFY_MAX_ATTEMPTS = int(os.getenv('NOTIFY_MAX_ATTEMPTS', '5'))
+
+# Outbox уведомлений (utils/outbox.py): уведомления сохраняются в БД вместе с изменением
+# и отправляются в фоне, поэтому перезапуск бота их не теряет.
+OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', '1')) # Секунд между проверками таблицы
+OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', '100'))
+OUTBOX_LEASE_SECONDS = float(os.getenv('OUTBOX_LEASE_SECONDS', '120')) # Через сколько взятая, но не отправленная строка берется снова
+OUTBOX_MAX_ATTEMPTS = int(os.getenv('OUTBOX_MAX_ATTEMPTS', '10'))
+OUTBOX_RETENTION_HOURS = float(os.getenv('OUTBOX_RETENTION_HOURS', '24')) # Сколько хранить отправленные (для отсева дублей)
+
+# Сохранение user_data/chat_data и состояний диалогов в БД (utils/persistence.py): как часто (с)
+# изменения записываются. После перезапуска теряются только изменения последних секунд.
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv('PERSISTENCE_UPDATE_INTERVAL', '10'))
+
+# Метрики (utils/metrics.py): время обработчиков, SQL-запросов и вызовов Bot API в формате Prometheus.
+# Отдаются по GET /metrics только на отдельном сервере METRICS_LISTEN:METRICS_PORT (0 - не запускать),
+# в том числе в режиме webhook: публичный сервер вебхука метрики не отдает. Запросы дольше SLOW_QUERY_MS мс пишутся в лог с текстом SQL (0 - не писать).
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '200'))
 
 # Роли пользователей
 ROLE_PASSENGER = 'passenger'
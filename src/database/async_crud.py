@@ -0,0 +1,57 @@
+# src/database/async_crud.py
+# Асинхронные аналоги функций из crud.py.
+# Каждая функция выполняет ту же логику, что и синхронная версия, через AsyncSession.run_sync:
+# запросы идут через асинхронный драйвер (aiosqlite/asyncpg), и цикл событий не блокируется.
+# Логика запросов живет только в crud.py, поэтому обе версии не расходятся.
+import functools
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import crud
+
+def _async_version(func):
+    @functools.wraps(func)
+    async def wrapper(db: AsyncSession, *args, **kwargs):
+        return await db.run_sync(func, *args, **kwargs)
+    return wrapper
+
+# --- User Operations ---
+get_user_by_telegram_id = _async_version(crud.get_user_by_telegram_id)
+get_user_profile = _async_version(crud.get_user_profile)
+create_user = _async_version(crud.create_user)
+update_user_role = _async_version(crud.update_user_role)
+block_user = _async_version(crud.block_user)
+load_blocked_users = _async_version(crud.load_blocked_users)
+get_all_drivers = _async_version(crud.get_all_drivers)
+
+# --- Driver Profile Operations ---
+create_driver_profile = _async_version(crud.create_driver_profile)
+get_driver_profile = _async_version(crud.get_driver_profile)
+is_car_plate_taken = _async_version(crud.is_car_plate_taken)
+
+# --- Trip Operations ---
+create_trip = _async_version(crud.create_trip)
+get_trip_by_id = _async_version(crud.get_trip_by_id)
+get_driver_trip = _async_version(crud.get_driver_trip)
+find_trips = _async_version(crud.find_trips)
+find_trips_page = _async_version(crud.find_trips_page)
+get_distinct_cities = _async_version(crud.get_distinct_cities)
+get_driver_trips = _async_version(crud.get_driver_trips)
+update_trip_status = _async_version(crud.update_trip_status)
+cancel_trip_with_bookings = _async_version(crud.cancel_trip_with_bookings)
+
+# --- Booking Operations ---
+create_booking = _async_version(crud.create_booking)
+get_user_bookings = _async_version(crud.get_user_bookings)
+get_passenger_booking = _async_version(crud.get_passenger_booking)
+cancel_booking = _async_version(crud.cancel_booking)
+
+# --- Outbox Operations ---
+claim_outbox_batch = _async_version(crud.claim_outbox_batch)
+mark_outbox_sent = _async_version(crud.mark_outbox_sent)
+reschedule_outbox = _async_version(crud.reschedule_outbox)
+purge_outbox = _async_version(crud.purge_outbox)
+count_exhausted_outbox = _async_version(crud.count_exhausted_outbox)
+
+# --- Persistence Operations ---
+load_persistence = _async_version(crud.load_persistence)
+save_persistence = _async_version(crud.save_persistence)
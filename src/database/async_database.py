@@ -0,0 +1,98 @@
+# src/database/async_database.py
+import logging
+import asyncio
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.util import await_only
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from src.config import ASYNC_DATABASE_URL, ASYNC_DATABASE_READ_URL
+from src.utils.metrics import instrument_engine
+from .database import (engine_options, setup_sqlite_connections, track_pool, RoutingSession,
+                       stick_to_primary_if_recent_writer, remember_writer)
+
+logger = logging.getLogger(__name__)
+
+try:
+    async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+    setup_sqlite_connections(async_engine.sync_engine)
+    instrument_engine(async_engine.sync_engine)
+    track_pool("асинхронный", async_engine.sync_engine)
+    async_read_engine = (create_async_engine(ASYNC_DATABASE_READ_URL, **engine_options(ASYNC_DATABASE_READ_URL))
+                         if ASYNC_DATABASE_READ_URL else None)
+    if async_read_engine is not None:
+        setup_sqlite_connections(async_read_engine.sync_engine)
+        instrument_engine(async_read_engine.sync_engine)
+        track_pool("асинхронный, реплика", async_read_engine.sync_engine)
+    # expire_on_commit=False: после коммита объекты остаются загруженными,
+    # иначе обращение к атрибутам вне сессии потребовало бы ленивой (синхронной) загрузки
+    # Функции crud выполняются через run_sync в RoutingSession - маршрутизация чтений та же, что в database.py
+    AsyncSessionLocal = sessionmaker(async_engine, class_=AsyncSession, sync_session_class=RoutingSession,
+                                     expire_on_commit=False, autoflush=False,
+                                     read_bind=async_read_engine.sync_engine if async_read_engine is not None else None)
+    logger.info("Асинхронный движок БД создан (%s).", ASYNC_DATABASE_URL.split('://')[0])
+except Exception as e:
+    logger.error("Ошибка создания асинхронного движка БД: %s", e)
+    raise
+
+# Как и в session_scope, текущая сессия хранится в ContextVar: вложенные вызовы async_session_scope
+# получают ту же сессию и транзакцию.
+_current_async_session: ContextVar[AsyncSession | None] = ContextVar("_current_async_session", default=None)
+
+# SQLite допускает одного писателя, а ожидание его блокировки (busy_timeout) - это опрос со сном до 100 мс.
+# Пишущие транзакции процесса ждут друг друга в очереди asyncio, а не в этом опросе. Блокировка берется
+# перед первым пишущим запросом сессии и держится до ее конца; чтения (в WAL они не ждут писателя)
+# идут параллельно. Драйвер начинает транзакцию только перед записью, поэтому чтения до нее не держат
+# снимок, который устарел бы к моменту записи.
+_sqlite_lock = asyncio.Lock() if async_engine.dialect.name == "sqlite" else None
+_WRITE_LOCK_KEY = "sqlite_write_lock"
+
+if _sqlite_lock is not None:
+    @event.listens_for(async_engine.sync_engine, "before_cursor_execute")
+    def _lock_before_write(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip()[:6].upper() in ("SELECT", "PRAGMA"):
+            return
+        db = _current_async_session.get()
+        if db is None or db.sync_session.info.get(_WRITE_LOCK_KEY):
+            return
+        # Запрос выполняется в greenlet сессии (run_sync/execute) - ждать блокировку asyncio можно отсюда
+        await_only(_sqlite_lock.acquire())
+        db.sync_session.info[_WRITE_LOCK_KEY] = True
+
+@asynccontextmanager
+async def async_session_scope(user_id: int | None = None):
+    """Асинхронная сессия (или уже открытая): коммит при успехе, откат при ошибке, всегда закрывается.
+
+    user_id - автор апдейта: как и в session_scope, после его записи (в любой из сессий) следующие
+    апдейты какое-то время читают с основной БД.
+    """
+    db = _current_async_session.get()
+    if db is not None:
+        # Вложенный вызов: жизненным циклом управляет внешний async_session_scope
+        yield db
+        return
+
+    db = AsyncSessionLocal()
+    stick_to_primary_if_recent_writer(db.sync_session, user_id)
+    token = _current_async_session.set(db)
+    try:
+        yield db
+        await db.commit()
+        remember_writer(db.sync_session, user_id)
+    except Exception:
+        await db.rollback()
+        raise
+    finally:
+        _current_async_session.reset(token)
+        try:
+            await db.close()
+        finally:
+            if db.sync_session.info.pop(_WRITE_LOCK_KEY, False):
+                _sqlite_lock.release() # Транзакция завершена - следующий писатель может начинать
+
+async def dispose_async_engine():
+    """Закрывает соединения асинхронного пула (вызывается при остановке бота)."""
+    await async_engine.dispose()
+    if async_read_engine is not None:
+        await async_read_engine.dispose()
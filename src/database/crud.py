@@ -1,17 +1,230 @@
 # src/database/crud.py
-from sqlalchemy.orm import Session
-from sqlalchemy import func, and_
-from datetime import datetime, date
+import logging
+import threading
+from sqlalchemy.orm import Session, contains_eager, joinedload, selectinload
+from sqlalchemy import func, and_, or_, insert, select, update
+from dataclasses import dataclass
+from datetime import datetime, date, timedelta
+from typing import Any, Callable, Iterable, Iterator
 
 # Импортируем модели и роли
 from . import models
-from src.config import ROLE_DRIVER, ROLE_PASSENGER, logger
+from .database import replica_reads, reads_from_replica, after_commit
+from src.config import (ROLE_DRIVER, ROLE_PASSENGER, DB_READ_STICKY_SECONDS,
+                        TRIP_SEARCH_CACHE_TTL, TRIP_SEARCH_CACHE_SIZE, TRIP_SEARCH_CACHE_MAX_TRIPS,
+                        TRIP_SEARCH_PAGE_SIZE, USER_CACHE_TTL, USER_CACHE_SIZE, USER_CACHE_REDIS_URL)
+from src.utils.cities import city_key
+from src.utils.cache import TTLCache, RedisInvalidationBus
+
+logger = logging.getLogger(__name__)
+
+# Функции записи не вызывают commit/rollback: транзакция одна на апдейт (session_scope/async_session_scope).
+# Ошибки ограничений всплывают в самой функции (flush) и откатывают всю транзакцию апдейта, сбросы кэшей
+# откладываются до коммита (after_commit). Запись, которая может не состояться, начинается с условного UPDATE:
+# если он ничего не изменил, функция возвращается без записей, и точка сохранения (лишние SAVEPOINT/RELEASE,
+# а в SQLite и BEGIN IMMEDIATE) не нужна.
+
+# Кэш поиска: ключ (город отправления, город прибытия, дата) -> список поездок.
+# Записи помечены тегом маршрута, тегами ("trip", id) входящих в них поездок и ("driver", id) их водителей;
+# любая запись в crud, меняющая поездку или водителя, сбрасывает соответствующие теги после коммита.
+# Поколение кэша берется до запроса: результат, прочитанный до сброса своих тегов, в кэш не попадает.
+# Сессии, закрепленные за основной БД (автор недавней записи), кэш не читают и не заполняют, а результат
+# чтения с реплики кэшируется, только если его теги не сбрасывались дольше DB_READ_STICKY_SECONDS.
+# Кэш локален для процесса: при нескольких репликах устаревание ограничено TTL.
+_trip_search_cache = TTLCache(
+    maxsize=TRIP_SEARCH_CACHE_SIZE,
+    ttl=TRIP_SEARCH_CACHE_TTL,
+    max_weight=TRIP_SEARCH_CACHE_MAX_TRIPS,
+    weigh=lambda trips: max(1, len(trips)),
+)
+
+def _route_tag(departure_key: str, arrival_key: str, trip_date: date) -> tuple:
+    return ("route", departure_key, arrival_key, trip_date)
+
+def _invalidate_trip_search(trip: models.Trip) -> None:
+    """Сбрасывает закэшированные результаты поиска, в которые входит или может войти поездка."""
+    _trip_search_cache.invalidate_tag(_route_tag(trip.departure_key, trip.arrival_key, trip.departure_datetime.date()))
+    _trip_search_cache.invalidate_tag(("trip", trip.id))
+
+def get_trip_search_cache_stats() -> dict:
+    """Счетчики кэша поиска (попадания, промахи, вытеснения, сбросы)."""
+    return _trip_search_cache.stats()
+
+# Кэш профилей: telegram_id -> UserProfile. Почти каждый обработчик начинает с поиска пользователя,
+# и за один диалог это 5-10 одинаковых запросов. Кэшируется неизменяемый снимок, а не ORM-объект:
+# он не привязан к сессии. Сбрасывается после коммита функций, меняющих эти поля.
+@dataclass(frozen=True)
+class UserProfile:
+    id: int
+    telegram_id: int
+    full_name: str
+    phone_number: str
+    role: str
+    is_blocked: bool
+    has_driver_profile: bool
+
+_user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+_user_cache_bus = RedisInvalidationBus(USER_CACHE_REDIS_URL, "bottaxi:user_cache") if USER_CACHE_REDIS_URL else None
+
+# Заблокированные пользователи (telegram_id) для проверки до обработчиков (common.blocked_user_gate).
+# Загружается при старте и перечитывается раз в USER_CACHE_TTL (load_blocked_users), обновляется в block_user;
+# между репликами - через Redis, а без него (или при потерянном сообщении) - при следующем перечитывании.
+_blocked_user_ids: set[int] = set()
+_blocked_lock = threading.Lock() # _set_blocked вызывается и из потока подписки Redis
+_blocked_changes: list[tuple[int, bool]] | None = None # Изменения, пришедшие во время load_blocked_users
+_blocked_users_bus = RedisInvalidationBus(USER_CACHE_REDIS_URL, "bottaxi:blocked_users") if USER_CACHE_REDIS_URL else None
+
+def is_user_blocked(telegram_id: int) -> bool:
+    """Проверка без обращения к БД."""
+    return telegram_id in _blocked_user_ids
+
+def _set_blocked(telegram_id: int, blocked: bool) -> None:
+    with _blocked_lock:
+        if blocked:
+            _blocked_user_ids.add(telegram_id)
+        else:
+            _blocked_user_ids.discard(telegram_id)
+        if _blocked_changes is not None:
+            _blocked_changes.append((telegram_id, blocked))
+
+def _on_block_committed(telegram_id: int, blocked: bool, search_tags: list[tuple]) -> None:
+    _invalidate_user(telegram_id)
+    for tag in search_tags:
+        _trip_search_cache.invalidate_tag(tag)
+    _set_blocked(telegram_id, blocked)
+    if _blocked_users_bus is not None:
+        _blocked_users_bus.publish(f"{telegram_id}:{int(blocked)}")
+
+def _on_blocked_message(message: str) -> None:
+    telegram_id, blocked = message.split(":")
+    _set_blocked(int(telegram_id), blocked == "1")
+
+def load_blocked_users(db: Session) -> int:
+    """Загружает (перечитывает) множество заблокированных пользователей из БД. Возвращает их число.
+
+    Блокировки, примененные, пока шел запрос, накладываются поверх прочитанного: снимок из БД
+    может быть старше них.
+    """
+    global _blocked_changes
+    with _blocked_lock:
+        _blocked_changes = changes = []
+    try:
+        loaded = {telegram_id for (telegram_id,) in
+                  db.query(models.User.telegram_id).filter(models.User.is_blocked.is_(True))}
+    except Exception:
+        with _blocked_lock:
+            _blocked_changes = None
+        raise
+    with _blocked_lock:
+        _blocked_changes = None
+        for telegram_id, blocked in changes:
+            if blocked:
+                loaded.add(telegram_id)
+            else:
+                loaded.discard(telegram_id)
+        # Множество обновляется на месте и без промежуточного пустого состояния
+        _blocked_user_ids.intersection_update(loaded)
+        _blocked_user_ids.update(loaded)
+        return len(_blocked_user_ids)
+
+def _invalidate_user(telegram_id: int) -> None:
+    _user_cache.invalidate(telegram_id)
+    if _user_cache_bus is not None:
+        _user_cache_bus.publish(telegram_id)
+
+def start_user_cache_sync() -> None:
+    """Подписывается на сбросы кэша профилей от других реплик (если задан USER_CACHE_REDIS_URL)."""
+    if _user_cache_bus is not None:
+        _user_cache_bus.listen(lambda key: _user_cache.invalidate(int(key)))
+        _blocked_users_bus.listen(_on_blocked_message)
+        logger.info("Кэш профилей пользователей синхронизируется через Redis.")
+
+def stop_user_cache_sync() -> None:
+    """Останавливает подписку и досылает поставленные в очередь сбросы (при остановке бота)."""
+    for bus in (_user_cache_bus, _blocked_users_bus):
+        if bus is not None:
+            bus.close()
+
+def get_user_cache_stats() -> dict:
+    return _user_cache.stats()
+
+# --- Профили загрузки связей ---
+# Функции чтения принимают load - какие связи понадобятся при выводе результата.
+# Связи загружаются фиксированным числом запросов на всю страницу результатов,
+# а не ленивым запросом на каждую строку (N+1).
+LOAD_TRIP_CARD = "trip_card" # Поездка + водитель + профиль водителя (helpers.format_trip_details)
+LOAD_BOOKING_CARD = "booking_card" # Бронь + поездка (helpers.format_booking_details)
+LOAD_DRIVER_PROFILE = "driver_profile" # Пользователь + профиль водителя (список водителей)
+
+def _trip_load_options(load: str | None, driver_joined: bool = False) -> list:
+    if load is None:
+        return [contains_eager(models.Trip.driver)] if driver_joined else []
+    if load == LOAD_TRIP_CARD:
+        # Если водитель уже присоединен JOIN-ом, берем его оттуда; профиль (один-к-одному) - тем же запросом
+        driver = contains_eager(models.Trip.driver) if driver_joined else joinedload(models.Trip.driver)
+        return [driver.joinedload(models.User.driver_profile)]
+    raise ValueError(f"Неизвестный профиль загрузки поездок: {load}")
+
+def _booking_load_options(load: str | None, trip_joined: bool = False) -> list:
+    if load is None:
+        return []
+    if load == LOAD_BOOKING_CARD:
+        return [contains_eager(models.Booking.trip) if trip_joined else selectinload(models.Booking.trip)]
+    raise ValueError(f"Неизвестный профиль загрузки бронирований: {load}")
+
+def _user_load_options(load: str | None) -> list:
+    if load is None:
+        return []
+    if load == LOAD_DRIVER_PROFILE:
+        return [joinedload(models.User.driver_profile)]
+    raise ValueError(f"Неизвестный профиль загрузки пользователей: {load}")
+
+# --- Outbox: уведомления в той же транзакции, что и изменение ---
+# Функции записи принимают notify - функцию, которая по результату операции (пользователь, бронь)
+# возвращает уведомления. Они записываются в таблицу outbox до коммита: изменение и уведомления
+# сохраняются вместе или не сохраняются вовсе. Отправляет их utils/outbox.py.
+@dataclass(frozen=True)
+class OutboxItem:
+    chat_id: int
+    text: str
+    dedup_key: str | None = None
+
+NotifyFactory = Callable[[Any], Iterable[OutboxItem]]
+
+def _add_outbox(db: Session, notify: NotifyFactory | None, result: Any) -> None:
+    if notify is None:
+        return
+    now = datetime.now()
+    rows = [{"chat_id": item.chat_id, "text": item.text, "dedup_key": item.dedup_key, "next_attempt_at": now}
+            for item in notify(result)]
+    if rows:
+        db.execute(insert(models.OutboxMessage), rows) # Одна пачка INSERT на все уведомления операции
 
 # --- User Operations ---
 
 def get_user_by_telegram_id(db: Session, telegram_id: int) -> models.User | None:
     return db.query(models.User).filter(models.User.telegram_id == telegram_id).first()
 
+def get_user_profile(db: Session, telegram_id: int) -> UserProfile | None:
+    """Снимок пользователя для проверок в обработчиках (из кэша, при промахе - один запрос).
+
+    Для изменения пользователя используйте get_user_by_telegram_id и функции записи ниже.
+    Незарегистрированные пользователи не кэшируются.
+    """
+    profile = _user_cache.get(telegram_id)
+    if profile is not None:
+        return profile
+    generation = _user_cache.generation()
+    row = db.query(
+        models.User.id, models.User.telegram_id, models.User.full_name, models.User.phone_number,
+        models.User.role, models.User.is_blocked, models.DriverProfile.id
+    ).outerjoin(models.User.driver_profile).filter(models.User.telegram_id == telegram_id).first()
+    if row is None:
+        return None
+    profile = UserProfile(row[0], row[1], row[2], row[3], row[4], bool(row[5]), row[6] is not None)
+    _user_cache.set(telegram_id, profile, since=generation)
+    return profile
+
 def create_user(db: Session, telegram_id: int, full_name: str, phone_number: str) -> models.User:
     db_user = models.User(
         telegram_id=telegram_id,
@@ -20,49 +233,97 @@ def create_user(db: Session, telegram_id: int, full_name: str, phone_number: str
         role=ROLE_PASSENGER # По умолчанию - пассажир
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
-    logger.info(f"Создан новый пользователь: {db_user}")
+    db.flush() # id и registration_date возвращаются тем же INSERT (RETURNING, eager_defaults)
+    logger.info("Создан новый пользователь: %s", db_user)
     return db_user
 
-def update_user_role(db: Session, telegram_id: int, new_role: str) -> models.User | None:
+def update_user_role(db: Session, telegram_id: int, new_role: str,
+                     notify: NotifyFactory | None = None) -> models.User | None:
     db_user = get_user_by_telegram_id(db, telegram_id)
     if db_user:
         db_user.role = new_role
-        db.commit()
-        db.refresh(db_user)
-        logger.info(f"Роль пользователя {telegram_id} обновлена на '{new_role}'")
+        _add_outbox(db, notify, db_user)
+        after_commit(db, _invalidate_user, telegram_id)
+        logger.info("Роль пользователя %s обновлена на '%s'", telegram_id, new_role)
     return db_user
 
-def block_user(db: Session, telegram_id: int, block_status: bool = True) -> models.User | None:
+def block_user(db: Session, telegram_id: int, block_status: bool = True,
+               notify: NotifyFactory | None = None) -> models.User | None:
     db_user = get_user_by_telegram_id(db, telegram_id)
     if db_user:
         db_user.is_blocked = block_status
-        db.commit()
-        db.refresh(db_user)
+        _add_outbox(db, notify, db_user)
+        after_commit(db, _on_block_committed, telegram_id, block_status,
+                     _block_search_tags(db, db_user.id, block_status))
         status_str = "заблокирован" if block_status else "разблокирован"
-        logger.info(f"Пользователь {telegram_id} {status_str}")
+        logger.info("Пользователь %s %s", telegram_id, status_str)
     return db_user
 
-def get_all_drivers(db: Session) -> list[models.User]:
-    return db.query(models.User).filter(models.User.role == ROLE_DRIVER).all()
+def _block_search_tags(db: Session, user_id: int, blocked: bool) -> list[tuple]:
+    """Теги результатов поиска, которые меняет (раз)блокировка пользователя.
+
+    Заблокированный водитель пропадает из результатов, где есть его поездки (тег водителя);
+    разблокированный - появляется в результатах по маршрутам своих запланированных поездок.
+    """
+    if blocked:
+        return [("driver", user_id)]
+    rows = db.query(models.Trip.departure_key, models.Trip.arrival_key, models.Trip.departure_datetime).filter(
+        models.Trip.driver_id == user_id, models.Trip.status == 'scheduled').distinct()
+    return list({_route_tag(departure_key, arrival_key, departure_datetime.date())
+                 for departure_key, arrival_key, departure_datetime in rows})
+
+@replica_reads
+def get_all_drivers(db: Session, load: str | None = None) -> list[models.User]:
+    return db.query(models.User).options(*_user_load_options(load)).filter(models.User.role == ROLE_DRIVER).all()
+
+@replica_reads
+def iter_drivers(db: Session, blocked: bool | None = None, name_prefix: str | None = None,
+                 batch_size: int = 500) -> Iterator[models.User]:
+    """Водители (с профилями) по id, пачками по batch_size строк: в памяти не больше одной пачки.
+
+    blocked: True - только заблокированные, False - только активные, None - все.
+    name_prefix: начало имени без учета регистра.
+    """
+    query = db.query(models.User).options(joinedload(models.User.driver_profile)).filter(
+        models.User.role == ROLE_DRIVER)
+    if blocked is not None:
+        # is_blocked может быть NULL у старых записей - считаем их активными
+        query = query.filter(models.User.is_blocked.is_(True) if blocked else
+                             or_(models.User.is_blocked.is_(False), models.User.is_blocked.is_(None)))
+    if name_prefix:
+        escaped = name_prefix.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        query = query.filter(models.User.full_name.ilike(f"{escaped}%", escape="\\"))
+    yield from query.order_by(models.User.id).yield_per(batch_size)
 
 # --- Driver Profile Operations ---
 
+def _bump_driver_trips(db: Session, driver_id: int) -> None:
+    """Карточки поездок показывают водителя и его авто: изменение профиля меняет версию всех его поездок,
+    а результаты поиска с ними (тег водителя) сбрасываются после коммита."""
+    db.query(models.Trip).filter(models.Trip.driver_id == driver_id).update(
+        {models.Trip.version: models.Trip.version + 1}, synchronize_session='evaluate')
+    after_commit(db, _trip_search_cache.invalidate_tag, ("driver", driver_id))
+
 def create_driver_profile(db: Session, user_id: int, car_make: str, car_model: str, car_color: str, car_plate: str) -> models.DriverProfile:
     # Убедимся, что профиль для этого user_id еще не создан
     existing_profile = db.query(models.DriverProfile).filter(models.DriverProfile.user_id == user_id).first()
     if existing_profile:
-        logger.warning(f"Попытка создать дублирующийся профиль водителя для user_id={user_id}")
+        logger.warning("Попытка создать дублирующийся профиль водителя для user_id=%s", user_id)
         # Можно обновить существующий или вернуть ошибку
         existing_profile.car_make = car_make
         existing_profile.car_model = car_model
         existing_profile.car_color = car_color
         existing_profile.car_plate = car_plate
-        db.commit()
-        db.refresh(existing_profile)
+        db.flush()
+        _bump_driver_trips(db, user_id)
         return existing_profile
     else:
+        # Пользователь проверяется до добавления профиля: при ошибке в сессии не остается несохраненного профиля
+        user = db.query(models.User).filter(models.User.id == user_id).first()
+        if not user:
+             logger.error("Не найден пользователь с id=%s при создании профиля водителя", user_id)
+             raise ValueError(f"User with id {user_id} not found")
+
         db_profile = models.DriverProfile(
             user_id=user_id,
             car_make=car_make,
@@ -72,23 +333,21 @@ def create_driver_profile(db: Session, user_id: int, car_make: str, car_model: s
         )
         db.add(db_profile)
         # Обновляем роль пользователя на 'driver'
-        user = db.query(models.User).filter(models.User.id == user_id).first()
-        if user:
-            user.role = ROLE_DRIVER
-            logger.info(f"Роль пользователя {user.telegram_id} обновлена на driver при создании профиля")
-        else:
-             logger.error(f"Не найден пользователь с id={user_id} при создании профиля водителя")
-             db.rollback() # Откатываем создание профиля, если юзера нет
-             raise ValueError(f"User with id {user_id} not found")
+        user.role = ROLE_DRIVER
+        logger.info("Роль пользователя %s обновлена на driver при создании профиля", user.telegram_id)
+        db.flush()
 
-        db.commit()
-        db.refresh(db_profile)
-        logger.info(f"Создан профиль водителя для user_id={user_id}: {db_profile}")
+        _bump_driver_trips(db, user_id)
+        after_commit(db, _invalidate_user, user.telegram_id)
+        logger.info("Создан профиль водителя для user_id=%s: %s", user_id, db_profile)
         return db_profile
 
 def get_driver_profile(db: Session, user_id: int) -> models.DriverProfile | None:
     return db.query(models.DriverProfile).filter(models.DriverProfile.user_id == user_id).first()
 
+def is_car_plate_taken(db: Session, car_plate: str) -> bool:
+    return db.query(models.DriverProfile.id).filter(models.DriverProfile.car_plate == car_plate).first() is not None
+
 # --- Trip Operations ---
 
 def create_trip(db: Session, driver_id: int, departure_city: str, arrival_city: str,
@@ -99,37 +358,146 @@ def create_trip(db: Session, driver_id: int, departure_city: str, arrival_city:
         driver_id=driver_id,
         departure_city=departure_city,
         arrival_city=arrival_city,
+        departure_key=city_key(departure_city),
+        arrival_key=city_key(arrival_city),
         departure_datetime=departure_datetime,
         estimated_arrival_datetime=estimated_arrival_datetime,
         total_seats=total_seats,
         available_seats=total_seats # Изначально все места свободны
     )
     db.add(db_trip)
-    db.commit()
-    db.refresh(db_trip)
-    logger.info(f"Создана новая поездка: {db_trip}")
+    db.flush()
+    after_commit(db, _invalidate_trip_search, db_trip)
+    logger.info("Создана новая поездка: %s", db_trip)
     return db_trip
 
-def get_trip_by_id(db: Session, trip_id: int) -> models.Trip | None:
-    return db.query(models.Trip).filter(models.Trip.id == trip_id).first()
+def get_trip_by_id(db: Session, trip_id: int, load: str | None = None) -> models.Trip | None:
+    return db.query(models.Trip).options(*_trip_load_options(load)).filter(models.Trip.id == trip_id).first()
+
+def get_driver_trip(db: Session, trip_id: int, driver_id: int) -> models.Trip | None:
+    """Поездка водителя по id (None, если ее нет или она чужая)."""
+    return db.query(models.Trip).filter(models.Trip.id == trip_id, models.Trip.driver_id == driver_id).first()
+
+# --- Постраничный поиск (keyset) ---
+# Курсор - (departure_datetime, id) крайней поездки страницы. Следующая страница начинается строго
+# после него, поэтому каждая страница - ограниченный диапазон индекса, без OFFSET и без
+# пропусков/дублей, если между запросами поездки добавились или исчезли.
+TripCursor = tuple[datetime, int]
+
+@dataclass(frozen=True)
+class TripPage:
+    trips: list[models.Trip]
+    has_prev: bool
+    has_next: bool
+
+    @property
+    def first_cursor(self) -> TripCursor | None:
+        return (self.trips[0].departure_datetime, self.trips[0].id) if self.trips else None
+
+    @property
+    def last_cursor(self) -> TripCursor | None:
+        return (self.trips[-1].departure_datetime, self.trips[-1].id) if self.trips else None
+
+def _keyset_after(cursor: TripCursor):
+    departure_datetime, trip_id = cursor
+    return or_(models.Trip.departure_datetime > departure_datetime,
+               and_(models.Trip.departure_datetime == departure_datetime, models.Trip.id > trip_id))
+
+def _keyset_before(cursor: TripCursor):
+    departure_datetime, trip_id = cursor
+    return or_(models.Trip.departure_datetime < departure_datetime,
+               and_(models.Trip.departure_datetime == departure_datetime, models.Trip.id < trip_id))
+
+@replica_reads
+def find_trips(db: Session, departure_city: str, arrival_city: str, trip_date: date,
+               load: str | None = None, after: TripCursor | None = None, before: TripCursor | None = None,
+               limit: int | None = None) -> list[models.Trip]:
+    """Находит поездки на конкретную дату.
+
+    Сравнение идет по ключам городов (city_key: у "Мск" и "Москва" один ключ), поэтому запрос -
+    диапазонное сканирование индекса ix_trips_route_date, а не полный просмотр таблицы.
+    Постраничный вывод - по курсору (departure_datetime, id): after - поездки после курсора,
+    before - до него (в обоих случаях результат упорядочен по времени), limit - размер страницы.
+    """
+    if after is not None and before is not None:
+        raise ValueError("Нельзя одновременно задать after и before")
+    departure_key, arrival_key = city_key(departure_city), city_key(arrival_city)
+    cache_key = (departure_key, arrival_key, trip_date, load, after, before, limit)
+    # Автор недавней записи должен видеть ее, а в общем кэше может лежать результат с отстающей реплики
+    use_cache = _trip_search_cache.enabled and not db.info.get("primary")
+    if use_cache:
+        cached = _trip_search_cache.get(cache_key)
+        if cached is not None:
+            return list(cached)
+    generation = _trip_search_cache.generation()
 
-def find_trips(db: Session, departure_city: str, arrival_city: str, trip_date: date) -> list[models.Trip]:
-    """Находит поездки на конкретную дату"""
     start_of_day = datetime.combine(trip_date, datetime.min.time())
     end_of_day = datetime.combine(trip_date, datetime.max.time())
 
-    return db.query(models.Trip).join(models.User).filter(
-        models.Trip.departure_city.ilike(f"%{departure_city}%"), # ilike для регистронезависимого поиска
-        models.Trip.arrival_city.ilike(f"%{arrival_city}%"),
+    # Водитель загружается тем же JOIN (contains_eager), без ленивых запросов при выводе кнопок
+    query = db.query(models.Trip).join(models.Trip.driver).options(*_trip_load_options(load, driver_joined=True)).filter(
+        models.Trip.departure_key == departure_key,
+        models.Trip.arrival_key == arrival_key,
         models.Trip.departure_datetime >= start_of_day,
         models.Trip.departure_datetime <= end_of_day,
         models.Trip.available_seats > 0, # Только поездки со свободными местами
         models.Trip.status == 'scheduled', # Только запланированные
         models.User.is_blocked == False # Водитель не заблокирован
-    ).order_by(models.Trip.departure_datetime).all()
+    )
+    if before is not None:
+        # Предыдущая страница: идем по индексу в обратном порядке и разворачиваем результат
+        query = query.filter(_keyset_before(before)).order_by(models.Trip.departure_datetime.desc(), models.Trip.id.desc())
+    else:
+        if after is not None:
+            query = query.filter(_keyset_after(after))
+        query = query.order_by(models.Trip.departure_datetime, models.Trip.id)
+    if limit is not None:
+        query = query.limit(limit)
+    trips = query.all()
+    if before is not None:
+        trips.reverse()
+
+    if use_cache:
+        # Отсоединяем объекты от сессии: в кэше они живут дольше нее и не должны истекать при коммите
+        for trip in trips:
+            profile = trip.driver.driver_profile if load == LOAD_TRIP_CARD else None
+            for obj in (profile, trip.driver, trip):
+                if obj is not None and obj in db:
+                    db.expunge(obj)
+        _trip_search_cache.set(
+            cache_key, tuple(trips),
+            tags=[_route_tag(departure_key, arrival_key, trip_date)]
+                 + [("trip", trip.id) for trip in trips] + list({("driver", trip.driver_id) for trip in trips}),
+            since=generation,
+            # Реплика могла еще не получить коммит, после которого сбросили теги: ждем, пока она догонит
+            settle=DB_READ_STICKY_SECONDS if reads_from_replica(db) else 0,
+        )
+    return trips
+
+def find_trips_page(db: Session, departure_city: str, arrival_city: str, trip_date: date,
+                    after: TripCursor | None = None, before: TripCursor | None = None,
+                    page_size: int = TRIP_SEARCH_PAGE_SIZE, load: str | None = None) -> TripPage:
+    """Одна страница результатов поиска. Запрашивается на одну поездку больше, чтобы узнать,
+    есть ли страница дальше в направлении листания."""
+    trips = find_trips(db, departure_city, arrival_city, trip_date, load=load,
+                       after=after, before=before, limit=page_size + 1)
+    has_more = len(trips) > page_size
+    if before is not None:
+        trips = trips[-page_size:] if has_more else trips
+        return TripPage(trips, has_prev=has_more, has_next=True)
+    trips = trips[:page_size]
+    return TripPage(trips, has_prev=after is not None, has_next=has_more)
 
-def get_driver_trips(db: Session, driver_id: int, active_only: bool = True) -> list[models.Trip]:
-    query = db.query(models.Trip).filter(models.Trip.driver_id == driver_id)
+@replica_reads
+def get_distinct_cities(db: Session) -> list[str]:
+    """Все названия городов, встречающиеся в поездках (для справочника городов)."""
+    departures = db.query(models.Trip.departure_city).distinct()
+    arrivals = db.query(models.Trip.arrival_city).distinct()
+    return [row[0] for row in departures.union(arrivals).all()]
+
+@replica_reads
+def get_driver_trips(db: Session, driver_id: int, active_only: bool = True, load: str | None = None) -> list[models.Trip]:
+    query = db.query(models.Trip).options(*_trip_load_options(load)).filter(models.Trip.driver_id == driver_id)
     if active_only:
         # Показываем запланированные и активные
         query = query.filter(models.Trip.status.in_(['scheduled', 'active']))
@@ -138,92 +506,306 @@ def get_driver_trips(db: Session, driver_id: int, active_only: bool = True) -> l
 def update_trip_status(db: Session, trip_id: int, new_status: str) -> models.Trip | None:
     db_trip = get_trip_by_id(db, trip_id)
     if db_trip:
-        db_trip.status = new_status
-        db.commit()
-        db.refresh(db_trip)
-        logger.info(f"Статус поездки {trip_id} обновлен на '{new_status}'")
+        # Версия увеличивается в SQL: параллельные записи не получат одну версию ('evaluate' обновит и db_trip)
+        db.query(models.Trip).filter(models.Trip.id == trip_id).update(
+            {models.Trip.status: new_status, models.Trip.version: models.Trip.version + 1},
+            synchronize_session='evaluate')
+        after_commit(db, _invalidate_trip_search, db_trip)
+        logger.info("Статус поездки %s обновлен на '%s'", trip_id, new_status)
     return db_trip
 
-# --- Booking Operations ---
+@dataclass(frozen=True)
+class CancelledBooking:
+    booking_id: int
+    passenger_id: int
+    passenger_telegram_id: int
+    seats_booked: int
 
-def create_booking(db: Session, passenger_id: int, trip_id: int, seats: int = 1) -> models.Booking | None:
-    db_trip = get_trip_by_id(db, trip_id)
-    if not db_trip:
-        logger.error(f"Попытка бронирования несуществующей поездки {trip_id}")
-        return None # Поездка не найдена
+@dataclass(frozen=True)
+class TripCancellation:
+    trip: models.Trip
+    bookings: list[CancelledBooking] # Подтвержденные брони, отмененные вместе с поездкой
+
+def cancel_trip_with_bookings(db: Session, trip_id: int, driver_id: int | None = None,
+                              notify: NotifyFactory | None = None) -> TripCancellation | None:
+    """Отменяет поездку и все ее подтвержденные брони (в транзакции апдейта).
 
-    if db_trip.status != 'scheduled':
-        logger.warning(f"Попытка бронирования поездки {trip_id} со статусом {db_trip.status}")
-        return None # Поездка не активна для бронирования
+    Сначала поездка переводится в 'cancelled' условным UPDATE: после него новые брони невозможны
+    (create_booking списывает места только у 'scheduled'). Затем брони отменяются одним UPDATE по
+    trip_id, а RETURNING отдает отмененные строки для возврата мест и уведомлений - бронь,
+    подтвержденная между чтением и отменой, не останется активной. Число запросов не зависит от
+    числа броней. driver_id - отменить, только если поездка принадлежит этому водителю.
+    None - поездка не найдена, чужая или уже не может быть отменена.
+    """
+    # Переход поездки блокирует ее строку (на PostgreSQL) до конца транзакции
+    trip_filter = [models.Trip.id == trip_id, models.Trip.status.in_(['scheduled', 'active'])]
+    if driver_id is not None:
+        trip_filter.append(models.Trip.driver_id == driver_id)
+    cancelled = db.query(models.Trip).filter(*trip_filter).update(
+        {models.Trip.status: 'cancelled', models.Trip.version: models.Trip.version + 1},
+        synchronize_session='evaluate')
+    if not cancelled: # Ничего не изменено - откатывать нечего
+        logger.warning("Поездку %s нельзя отменить (не найдена, чужая или уже завершена/отменена)", trip_id)
+        return None
 
-    if db_trip.available_seats < seats:
-        logger.warning(f"Недостаточно мест в поездке {trip_id} ({db_trip.available_seats} доступно, запрошено {seats})")
-        return None # Недостаточно мест
+    # Условие status='confirmed' не даст отмене пассажиром и водителем вернуть места дважды
+    passenger_telegram_id = select(models.User.telegram_id).where(
+        models.User.id == models.Booking.passenger_id).scalar_subquery()
+    bookings = [CancelledBooking(*row) for row in db.execute(
+        update(models.Booking).where(
+            models.Booking.trip_id == trip_id,
+            models.Booking.status == 'confirmed'
+        ).values(status='cancelled_by_driver').returning(
+            models.Booking.id, models.Booking.passenger_id, passenger_telegram_id, models.Booking.seats_booked
+        ), execution_options={"synchronize_session": "evaluate"})]
+
+    returned_seats = sum(b.seats_booked for b in bookings)
+    if returned_seats:
+        db.query(models.Trip).filter(models.Trip.id == trip_id).update(
+            {models.Trip.available_seats: models.Trip.available_seats + returned_seats},
+            synchronize_session='evaluate')
+
+    db_trip = db.get(models.Trip, trip_id) # Уже загруженная поездка обновлена UPDATE-ом ('evaluate'), иначе - SELECT
+    result = TripCancellation(db_trip, bookings)
+    _add_outbox(db, notify, result)
+    after_commit(db, _invalidate_trip_search, db_trip)
+    logger.info("Поездка %s отменена вместе с бронями: %s", trip_id, len(bookings))
+    return result
+
+# --- Booking Operations ---
+
+def create_booking(db: Session, passenger_id: int, trip_id: int, seats: int = 1,
+                   notify: NotifyFactory | None = None) -> models.Booking | None:
+    """Бронирует места атомарно: проверка и списание мест - один условный UPDATE.
+
+    Два пассажира, одновременно бронирующие последнее место, не могут оба получить бронь:
+    UPDATE ... WHERE available_seats >= :seats изменит строку только для одного из них
+    (на PostgreSQL строка блокируется до конца транзакции, в SQLite запись сериализуется).
+    """
+    if seats <= 0:
+        logger.warning("Попытка забронировать некорректное количество мест (%s) в поездке %s", seats, trip_id)
+        return None
 
     # Проверяем, не бронировал ли этот пассажир уже эту поездку
     existing_booking = db.query(models.Booking).filter(
         models.Booking.passenger_id == passenger_id,
         models.Booking.trip_id == trip_id
     ).first()
-    if existing_booking and existing_booking.status == 'confirmed':
-        logger.warning(f"Пассажир {passenger_id} уже забронировал поездку {trip_id}")
-        return None # Уже забронировано
+    if existing_booking:
+        if existing_booking.status == 'confirmed':
+            logger.warning("Пассажир %s уже забронировал поездку %s", passenger_id, trip_id)
+        else:
+            # Уникальное ограничение (passenger_id, trip_id) не даст создать вторую бронь
+            logger.warning("Пассажир %s уже имеет бронирование поездки %s", passenger_id, trip_id)
+        return None
 
-    # Уменьшаем количество доступных мест и создаем бронь (в транзакции)
-    try:
-        db_trip.available_seats -= seats
-        db_booking = models.Booking(
-            passenger_id=passenger_id,
-            trip_id=trip_id,
-            seats_booked=seats,
-            status='confirmed'
-        )
-        db.add(db_booking)
-        db.commit()
-        db.refresh(db_booking)
-        db.refresh(db_trip) # Обновляем и поездку тоже
-        logger.info(f"Создано бронирование: {db_booking}")
-        return db_booking
-    except Exception as e:
-        db.rollback() # Откатываем изменения в случае ошибки
-        logger.error(f"Ошибка при создании бронирования для поездки {trip_id}: {e}")
+    # Списываем места: если UPDATE ничего не изменил, записей нет и откатывать нечего.
+    # Ошибка после него (например, дубль брони, созданный параллельно в другой реплике) откатывает
+    # всю транзакцию апдейта вместе со списанными местами.
+    reserved = db.query(models.Trip).filter(
+        models.Trip.id == trip_id,
+        models.Trip.status == 'scheduled',
+        models.Trip.available_seats >= seats
+    ).update(
+        {models.Trip.available_seats: models.Trip.available_seats - seats, models.Trip.version: models.Trip.version + 1},
+        synchronize_session='evaluate' # Если поездка уже загружена в сессию, места обновятся и в ней, без SELECT
+    )
+    if not reserved:
+        _log_booking_rejection(db, trip_id, seats)
         return None
 
-def get_user_bookings(db: Session, passenger_id: int, active_only: bool = True) -> list[models.Booking]:
+    db_booking = models.Booking(
+        passenger_id=passenger_id,
+        trip_id=trip_id,
+        seats_booked=seats,
+        status='confirmed'
+    )
+    db.add(db_booking)
+    db.flush() # Уведомлению нужен id брони
+    _add_outbox(db, notify, db_booking)
+
+    # Места поездки уменьшились: после коммита сбрасываем результаты поиска, в которых она показана
+    after_commit(db, _trip_search_cache.invalidate_tag, ("trip", trip_id))
+    logger.info("Создано бронирование: %s", db_booking)
+    return db_booking
+
+def _log_booking_rejection(db: Session, trip_id: int, seats: int) -> None:
+    """Логирует причину, по которой условный UPDATE не зарезервировал места."""
+    db_trip = get_trip_by_id(db, trip_id)
+    if not db_trip:
+        logger.error("Попытка бронирования несуществующей поездки %s", trip_id)
+    elif db_trip.status != 'scheduled':
+        logger.warning("Попытка бронирования поездки %s со статусом %s", trip_id, db_trip.status)
+    else:
+        logger.warning("Недостаточно мест в поездке %s (%s доступно, запрошено %s)", trip_id, db_trip.available_seats, seats)
+
+@replica_reads
+def get_user_bookings(db: Session, passenger_id: int, active_only: bool = True,
+                      load: str | None = None) -> list[models.Booking]:
     query = db.query(models.Booking).filter(models.Booking.passenger_id == passenger_id)
     if active_only:
         # Показываем только подтвержденные бронирования на запланированные поездки
-        query = query.join(models.Trip).filter(
+        query = query.join(models.Booking.trip).filter(
             models.Booking.status == 'confirmed',
             models.Trip.status.in_(['scheduled', 'active']) # Можно уточнить до 'scheduled'
         )
+    query = query.options(*_booking_load_options(load, trip_joined=active_only))
     return query.order_by(models.Booking.booked_at.desc()).all()
 
-def cancel_booking(db: Session, booking_id: int, cancelled_by: str = "passenger") -> models.Booking | None:
+def get_passenger_booking(db: Session, booking_id: int, passenger_id: int) -> models.Booking | None:
+    """Бронь пассажира по id (None, если ее нет или она чужая)."""
+    return db.query(models.Booking).filter(
+        models.Booking.id == booking_id,
+        models.Booking.passenger_id == passenger_id
+    ).first()
+
+def cancel_booking(db: Session, booking_id: int, cancelled_by: str = "passenger",
+                   notify: NotifyFactory | None = None) -> models.Booking | None:
     """ Отменяет бронирование и возвращает места """
     db_booking = db.query(models.Booking).filter(models.Booking.id == booking_id).first()
     if not db_booking or db_booking.status != 'confirmed':
-        logger.warning(f"Попытка отменить неактивное или несуществующее бронирование {booking_id}")
+        logger.warning("Попытка отменить неактивное или несуществующее бронирование %s", booking_id)
         return None # Бронь не найдена или уже отменена
 
     db_trip = db_booking.trip # Получаем связанную поездку
     if not db_trip:
-         logger.error(f"Не найдена поездка для бронирования {booking_id}")
+         logger.error("Не найдена поездка для бронирования %s", booking_id)
          return None # Ошибка данных
 
-    # Возвращаем места и меняем статус брони (в транзакции)
-    try:
-        db_trip.available_seats += db_booking.seats_booked
-        if cancelled_by == "driver":
-            db_booking.status = 'cancelled_by_driver'
-        else:
-            db_booking.status = 'cancelled_by_passenger'
-        db.commit()
-        db.refresh(db_booking)
-        db.refresh(db_trip)
-        logger.info(f"Бронирование {booking_id} отменено ({cancelled_by}). Места возвращены в поездку {db_trip.id}.")
-        return db_booking
-    except Exception as e:
-        db.rollback()
-        logger.error(f"Ошибка при отмене бронирования {booking_id}: {e}")
+    new_status = 'cancelled_by_driver' if cancelled_by == "driver" else 'cancelled_by_passenger'
+    # Возвращаем места и меняем статус брони.
+    # Оба изменения - условные/относительные UPDATE, чтобы параллельная отмена не вернула места дважды,
+    # а параллельное бронирование не потеряло списанные места.
+    cancelled = db.query(models.Booking).filter(
+        models.Booking.id == booking_id,
+        models.Booking.status == 'confirmed'
+    ).update({models.Booking.status: new_status}, synchronize_session='evaluate')
+    if not cancelled: # Ничего не изменено - откатывать нечего
+        logger.warning("Бронирование %s уже отменено параллельным запросом", booking_id)
         return None
+    db.query(models.Trip).filter(models.Trip.id == db_trip.id).update(
+        {models.Trip.available_seats: models.Trip.available_seats + db_booking.seats_booked,
+         models.Trip.version: models.Trip.version + 1},
+        synchronize_session='evaluate' # db_booking и db_trip обновляются в памяти, refresh не нужен
+    )
+    _add_outbox(db, notify, db_booking)
+
+    after_commit(db, _invalidate_trip_search, db_trip) # Освободились места: поездка может снова появиться в поиске
+    logger.info("Бронирование %s отменено (%s). Места возвращены в поездку %s.", booking_id, cancelled_by, db_trip.id)
+    return db_booking
+
+# --- Outbox Operations ---
+
+def claim_outbox_batch(db: Session, limit: int, lease_seconds: float, max_attempts: int,
+                       lease_token: str) -> list[tuple[int, int, str, str | None]]:
+    """Берет в работу до limit неотправленных уведомлений: [(id, chat_id, text, dedup_key)].
+
+    Строки "арендуются" условным UPDATE (next_attempt_at сдвигается на lease_seconds), поэтому
+    несколько реплик не возьмут одну строку. Если отправитель упадет, аренда истечет и строку
+    возьмут снова (доставка "хотя бы один раз").
+    """
+    now = datetime.now()
+    candidate_ids = [row.id for row in db.query(models.OutboxMessage.id).filter(
+        models.OutboxMessage.sent_at.is_(None),
+        models.OutboxMessage.next_attempt_at <= now,
+        models.OutboxMessage.attempts < max_attempts
+    ).order_by(models.OutboxMessage.id).limit(limit)]
+    if not candidate_ids:
+        return []
+    db.query(models.OutboxMessage).filter(
+        models.OutboxMessage.id.in_(candidate_ids),
+        models.OutboxMessage.sent_at.is_(None),
+        models.OutboxMessage.next_attempt_at <= now # Строку еще не взял другой отправитель
+    ).update({
+        models.OutboxMessage.next_attempt_at: now + timedelta(seconds=lease_seconds),
+        models.OutboxMessage.attempts: models.OutboxMessage.attempts + 1,
+        models.OutboxMessage.lease_token: lease_token,
+    }, synchronize_session=False)
+    rows = db.query(models.OutboxMessage.id, models.OutboxMessage.chat_id, models.OutboxMessage.text,
+                    models.OutboxMessage.dedup_key).filter(
+        models.OutboxMessage.id.in_(candidate_ids),
+        models.OutboxMessage.lease_token == lease_token
+    ).order_by(models.OutboxMessage.id).all()
+
+    # Дубли: событие с тем же ключом уже отправлено - закрываем строку без отправки
+    keys = {row.dedup_key for row in rows if row.dedup_key}
+    sent_keys = {row[0] for row in db.query(models.OutboxMessage.dedup_key).filter(
+        models.OutboxMessage.dedup_key.in_(keys), models.OutboxMessage.sent_at.isnot(None)
+    ).distinct()} if keys else set()
+    duplicates = [row.id for row in rows if row.dedup_key in sent_keys]
+    if duplicates:
+        mark_outbox_sent(db, duplicates)
+        logger.info("Outbox: пропущено дублей уведомлений: %s", len(duplicates))
+    # Дубли внутри пачки не отправляем: mark_outbox_sent закроет их по ключу вместе с первой строкой
+    batch, batch_keys = [], set()
+    for row in rows:
+        if row.dedup_key in sent_keys or (row.dedup_key and row.dedup_key in batch_keys):
+            continue
+        batch_keys.add(row.dedup_key)
+        batch.append(tuple(row))
+    return batch
+
+def mark_outbox_sent(db: Session, ids: list[int], dedup_keys: Iterable[str] = ()) -> None:
+    """Отмечает уведомления отправленными (вместе с неотправленными дублями по dedup_key)."""
+    if not ids:
+        return
+    now = datetime.now()
+    db.query(models.OutboxMessage).filter(models.OutboxMessage.id.in_(ids)).update(
+        {models.OutboxMessage.sent_at: now, models.OutboxMessage.lease_token: None}, synchronize_session=False)
+    dedup_keys = [key for key in dedup_keys if key]
+    if dedup_keys:
+        db.query(models.OutboxMessage).filter(
+            models.OutboxMessage.dedup_key.in_(dedup_keys), models.OutboxMessage.sent_at.is_(None)
+        ).update({models.OutboxMessage.sent_at: now, models.OutboxMessage.lease_token: None}, synchronize_session=False)
+
+def reschedule_outbox(db: Session, ids: list[int], delay_seconds: float) -> None:
+    """Возвращает неотправленные уведомления в очередь с задержкой."""
+    if not ids:
+        return
+    db.query(models.OutboxMessage).filter(models.OutboxMessage.id.in_(ids)).update({
+        models.OutboxMessage.next_attempt_at: datetime.now() + timedelta(seconds=delay_seconds),
+        models.OutboxMessage.lease_token: None,
+    }, synchronize_session=False)
+
+def count_exhausted_outbox(db: Session, max_attempts: int) -> int:
+    """Число неотправленных уведомлений, исчерпавших попытки (claim_outbox_batch их больше не берет)."""
+    return db.query(func.count(models.OutboxMessage.id)).filter(
+        models.OutboxMessage.sent_at.is_(None),
+        models.OutboxMessage.attempts >= max_attempts,
+        models.OutboxMessage.next_attempt_at <= datetime.now() # Аренда последней попытки закончилась
+    ).scalar()
+
+def purge_outbox(db: Session, older_than: datetime) -> int:
+    """Удаляет отправленные уведомления старше older_than. Возвращает число удаленных."""
+    deleted = db.query(models.OutboxMessage).filter(
+        models.OutboxMessage.sent_at.isnot(None), models.OutboxMessage.sent_at < older_than
+    ).delete(synchronize_session=False)
+    return deleted
+
+# --- Persistence Operations (utils/persistence.py) ---
+
+def load_persistence(db: Session, namespace: str) -> dict[str, bytes]:
+    """Все записи пространства имен: ключ -> сериализованные данные."""
+    rows = db.query(models.PersistenceEntry.key, models.PersistenceEntry.data).filter(
+        models.PersistenceEntry.namespace == namespace).all()
+    return {key: data for key, data in rows}
+
+def save_persistence(db: Session, upserts: dict[tuple[str, str], bytes],
+                     deletes: Iterable[tuple[str, str]] = (), chunk_size: int = 500) -> None:
+    """Записывает изменившиеся записи одной транзакцией: удаление старых версий и вставка пачкой.
+
+    Ключи upserts и deletes - пары (namespace, key). Число запросов зависит от числа изменений,
+    а не от числа всех записей.
+    """
+    by_namespace: dict[str, list[str]] = {}
+    for namespace, key in set(upserts) | set(deletes):
+        by_namespace.setdefault(namespace, []).append(key)
+    for namespace, keys in by_namespace.items():
+        for start in range(0, len(keys), chunk_size):
+            db.query(models.PersistenceEntry).filter(
+                models.PersistenceEntry.namespace == namespace,
+                models.PersistenceEntry.key.in_(keys[start:start + chunk_size])
+            ).delete(synchronize_session=False)
+    if upserts:
+        db.execute(insert(models.PersistenceEntry), [
+            {"namespace": namespace, "key": key, "data": data} for (namespace, key), data in upserts.items()])
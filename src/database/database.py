@@ -1,19 +1,283 @@
 # src/database/database.py
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker, declarative_base
-from src.config import DATABASE_URL, logger
+import functools
+import inspect
+import logging
+from typing import Callable
+from contextlib import contextmanager
+from contextvars import ContextVar
+from sqlalchemy import create_engine, event, Select
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.orm import Session, sessionmaker, declarative_base
+from src.config import (DATABASE_URL, DATABASE_READ_URL, DB_READ_STICKY_SECONDS,
+                        DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PRE_PING,
+                        DB_STATEMENT_TIMEOUT_MS, SQLITE_BUSY_TIMEOUT_MS, SQLITE_MMAP_SIZE)
+from src.utils.cache import TTLCache
+from src.utils.metrics import instrument_engine
+
+logger = logging.getLogger(__name__)
+
+# --- Настройка движка ---
+
+def engine_options(url: str) -> dict:
+    """Параметры create_engine/create_async_engine для URL: пул соединений и таймаут запросов."""
+    url = make_url(url)
+    options = {"pool_pre_ping": DB_POOL_PRE_PING, "connect_args": {}}
+    if url.get_backend_name() == "sqlite":
+        if url.get_driver_name() == "pysqlite":
+            options["connect_args"]["check_same_thread"] = False # Сессии используются из потоков пула
+        if url.database in (None, "", ":memory:"):
+            return options # База в памяти: одно соединение на поток, настройки пула неприменимы
+    options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                   pool_timeout=DB_POOL_TIMEOUT, pool_recycle=DB_POOL_RECYCLE)
+    if url.get_backend_name() == "postgresql" and DB_STATEMENT_TIMEOUT_MS > 0:
+        # Передается при подключении, поэтому действует без отдельного SET на каждое соединение
+        if url.get_driver_name() == "asyncpg":
+            options["connect_args"]["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+        else:
+            options["connect_args"]["options"] = f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"
+    return options
+
+def setup_sqlite_connections(engine: Engine) -> None:
+    """Для SQLite: WAL (читатели не блокируют писателя), synchronous=NORMAL, mmap и ожидание блокировки.
+
+    Для асинхронного движка передается async_engine.sync_engine.
+    """
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute(f"PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}")
+            cursor.execute("PRAGMA journal_mode = WAL")
+            cursor.execute("PRAGMA synchronous = NORMAL") # В режиме WAL не теряет целостность при сбое
+            cursor.execute(f"PRAGMA mmap_size = {SQLITE_MMAP_SIZE}")
+        finally:
+            cursor.close()
+
+    @event.listens_for(engine, "savepoint")
+    def _begin_before_savepoint(conn, name):
+        # pysqlite/aiosqlite сами начинают транзакцию только перед INSERT/UPDATE/DELETE. SAVEPOINT без
+        # открытой транзакции открыл бы ее сам, и RELEASE зафиксировал бы все изменения апдейта.
+        # IMMEDIATE: точка сохранения окружает запись, блокировка берется сразу (с busy_timeout).
+        dbapi_connection = conn.connection.dbapi_connection
+        driver_connection = getattr(dbapi_connection, "driver_connection", dbapi_connection) # aiosqlite -> адаптер
+        if not driver_connection.in_transaction:
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+# --- Чтение с реплики ---
+
+class RoutingSession(Session):
+    """Сессия с основной БД и (необязательно) репликой для чтения.
+
+    На реплику идут только SELECT внутри функций crud с @replica_reads и только пока сессия ничего
+    не записала. Запись, SELECT ... FOR UPDATE и любые чтения после записи - на основную БД.
+    """
+
+    def __init__(self, *args, read_bind=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.read_bind = read_bind
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if (self.info.get("replica_reads") and reads_from_replica(self)
+                and not self._flushing and isinstance(clause, Select) and clause._for_update_arg is None):
+            return self.read_bind
+        return super().get_bind(mapper=mapper, clause=clause, **kwargs)
+
+def reads_from_replica(db: Session) -> bool:
+    """Чтения @replica_reads этой сессии идут на реплику: она задана, сессия ничего не записала
+    и не закреплена за основной БД (stick_to_primary_if_recent_writer)."""
+    return getattr(db, "read_bind", None) is not None and not db.info.get("primary") and not db.info.get("wrote")
+
+@event.listens_for(RoutingSession, "after_flush")
+def _on_flush(session, flush_context):
+    session.info["wrote"] = True # Дальше сессия читает свои же записи - только с основной БД
+
+@event.listens_for(RoutingSession, "do_orm_execute")
+def _on_orm_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+# --- Действия после коммита ---
+# Функции crud не коммитят сами: транзакцией управляет session_scope/async_session_scope, один раз
+# на апдейт. То, что можно делать только после успешного коммита (сброс кэшей, рассылка сбросов
+# другим репликам), crud откладывает через after_commit; при откате отложенные действия отменяются.
+
+def after_commit(db: Session, func: Callable, *args) -> None:
+    """Выполнить func(*args) после коммита текущей транзакции сессии."""
+    db.info.setdefault("after_commit", []).append((func, args))
+
+@event.listens_for(Session, "after_commit")
+def _run_after_commit(session):
+    if session.in_nested_transaction():
+        return # Освобождена точка сохранения, внешняя транзакция еще не зафиксирована
+    for func, args in session.info.pop("after_commit", ()):
+        try:
+            func(*args)
+        except Exception as e:
+            logger.error("Ошибка действия после коммита %s: %s", getattr(func, "__name__", func), e)
+
+@event.listens_for(Session, "after_rollback")
+def _drop_after_commit(session):
+    if not session.in_nested_transaction():
+        session.info.pop("after_commit", None)
+
+def replica_reads(func):
+    """Декоратор функции crud, которая только читает: ее запросы могут идти на реплику."""
+    if inspect.isgeneratorfunction(func):
+        # Запросы генератора выполняются при итерации, а не при вызове
+        @functools.wraps(func)
+        def gen_wrapper(db: Session, *args, **kwargs):
+            previous = db.info.get("replica_reads", False)
+            db.info["replica_reads"] = True
+            try:
+                yield from func(db, *args, **kwargs)
+            finally:
+                db.info["replica_reads"] = previous
+        return gen_wrapper
+
+    @functools.wraps(func)
+    def wrapper(db: Session, *args, **kwargs):
+        previous = db.info.get("replica_reads", False)
+        db.info["replica_reads"] = True
+        try:
+            return func(db, *args, **kwargs)
+        finally:
+            db.info["replica_reads"] = previous
+    return wrapper
+
+# Пользователи, недавно что-то записавшие: их апдейты читают с основной БД, пока реплика догоняет
+_recent_writers = TTLCache(maxsize=100_000, ttl=DB_READ_STICKY_SECONDS)
+
+def stick_to_primary_if_recent_writer(db: Session, user_id: int | None) -> None:
+    """Направляет все чтения сессии на основную БД, если пользователь недавно что-то записал."""
+    if user_id is not None and _recent_writers.get(user_id):
+        db.info["primary"] = True
+
+def remember_writer(db: Session, user_id: int | None) -> None:
+    """После коммита: если сессия писала, ее автор какое-то время читает с основной БД."""
+    if user_id is not None and db.info.get("wrote") and db.read_bind is not None:
+        _recent_writers.set(user_id, True)
 
 try:
     # echo=True полезно для отладки SQL запросов
-    engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {})
-    SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL))
+    setup_sqlite_connections(engine)
+    instrument_engine(engine)
+    read_engine = create_engine(DATABASE_READ_URL, **engine_options(DATABASE_READ_URL)) if DATABASE_READ_URL else None
+    if read_engine is not None:
+        setup_sqlite_connections(read_engine)
+        instrument_engine(read_engine)
+        logger.info("Чтение поиска и списков - с реплики (%s).", DATABASE_READ_URL.split('://')[0])
+    # expire_on_commit=False: после коммита объекты не истекают, и функции записи в crud возвращают
+    # заполненные объекты без повторного SELECT (db.refresh). Сессия живет один апдейт, поэтому
+    # устаревание между апдейтами невозможно; изменения другими транзакциями читаются новым запросом.
+    SessionLocal = sessionmaker(class_=RoutingSession, autocommit=False, autoflush=False, expire_on_commit=False,
+                                bind=engine, read_bind=read_engine)
     Base = declarative_base()
     logger.info("Соединение с базой данных установлено успешно.")
 except Exception as e:
-    logger.error(f"Ошибка подключения к базе данных: {e}")
+    logger.error("Ошибка подключения к базе данных: %s", e)
     raise
 
+# --- Счетчики пулов соединений ---
+# Позволяют увидеть утечки: checkouts - checkins должно возвращаться к нулю между апдейтами.
+# Считаются по каждому пулу: синхронному, асинхронному (async_database.py) и пулам реплики.
+_pools: dict[str, tuple[Engine, dict]] = {} # название -> (движок, счетчики)
+
+def track_pool(name: str, engine: Engine) -> None:
+    """Подключает счетчики выдачи/возврата к пулу движка. Для асинхронного передается async_engine.sync_engine."""
+    counters = {"checkouts": 0, "checkins": 0}
+    _pools[name] = (engine, counters)
+
+    @event.listens_for(engine, "checkout")
+    def _on_checkout(dbapi_connection, connection_record, connection_proxy):
+        counters["checkouts"] += 1
+
+    @event.listens_for(engine, "checkin")
+    def _on_checkin(dbapi_connection, connection_record):
+        counters["checkins"] += 1
+
+track_pool("синхронный", engine)
+if read_engine is not None:
+    track_pool("синхронный, реплика", read_engine)
+
+def get_pool_stats() -> dict:
+    """Счетчики выдачи/возврата соединений и состояние каждого пула; checkouts/checkins/in_use - сумма по пулам."""
+    pools = {
+        name: {"checkouts": counters["checkouts"], "checkins": counters["checkins"],
+               "in_use": counters["checkouts"] - counters["checkins"], "status": pool_engine.pool.status()}
+        for name, (pool_engine, counters) in _pools.items()
+    }
+    return {
+        "checkouts": sum(pool["checkouts"] for pool in pools.values()),
+        "checkins": sum(pool["checkins"] for pool in pools.values()),
+        "in_use": sum(pool["in_use"] for pool in pools.values()),
+        "pools": pools,
+    }
+
+# --- Подсчет SQL-запросов ---
+class QueryCounter:
+    """Считает SQL-запросы, выполненные движком (для проверок N+1 и бенчмарков)."""
+
+    def __init__(self):
+        self.count = 0
+        self.statements: list[str] = []
+
+    def __call__(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+@contextmanager
+def count_queries(bind=None):
+    """Контекст, внутри которого считаются запросы: with count_queries() as counter: ..."""
+    bind = bind or engine
+    counter = QueryCounter()
+    event.listen(bind, "before_cursor_execute", counter)
+    try:
+        yield counter
+    finally:
+        event.remove(bind, "before_cursor_execute", counter)
+
+# --- Синхронная сессия (скрипты, бенчмарки, миграции данных) ---
+# Обработчики апдейтов работают с БД через async_session_scope (async_database.py): синхронные запросы
+# блокировали бы цикл событий. Оба контекста устроены одинаково: текущая сессия хранится в ContextVar,
+# поэтому вложенные вызовы используют одну и ту же сессию и транзакцию, а параллельные задачи - разные.
+# Сессия открывается только на время работы с БД: ответы в Telegram отправляются после выхода из
+# блока, чтобы транзакция (и блокировка записи в SQLite) не ждала сети.
+_current_session: ContextVar[Session | None] = ContextVar("_current_session", default=None)
+
+@contextmanager
+def session_scope(user_id: int | None = None):
+    """Открывает сессию (или переиспользует уже открытую), коммитит/откатывает один раз и всегда закрывает.
+
+    user_id - автор апдейта: после его записи следующие апдейты какое-то время читают с основной БД.
+    """
+    db = _current_session.get()
+    if db is not None:
+        # Вложенный вызов: жизненным циклом управляет внешний session_scope
+        yield db
+        return
+
+    db = SessionLocal()
+    stick_to_primary_if_recent_writer(db, user_id)
+    token = _current_session.set(db)
+    try:
+        yield db
+        db.commit()
+        remember_writer(db, user_id)
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        _current_session.reset(token)
+        db.close() # Соединение возвращается в пул
+
 # Функция для получения сессии БД
+# Генератор нужно исчерпывать (например, через contextlib.closing или Depends-подобный механизм),
+# иначе db.close() не вызовется. В синхронном коде удобнее session_scope(), в обработчиках -
+# async_session_scope() из async_database.py.
 def get_db():
     db = SessionLocal()
     try:
@@ -21,7 +285,8 @@ def get_db():
     finally:
         db.close()
 
-# Функция для инициализации (создания таблиц)
+# Функция для инициализации (создания таблиц) без миграций: для пустой базы, бенчмарков и DB_CREATE_ALL.
+# Существующие таблицы не изменяет - для рабочей базы используйте alembic upgrade head.
 def init_db():
     try:
         # Импортируем модели здесь, чтобы избежать циклических зависимостей
@@ -30,7 +295,7 @@ def init_db():
         Base.metadata.create_all(bind=engine)
         logger.info("Таблицы базы данных успешно созданы (или уже существуют).")
     except Exception as e:
-        logger.error(f"Ошибка при создании таблиц: {e}")
+        logger.error("Ошибка при создании таблиц: %s", e)
         raise
 
 # Если запустить этот файл напрямую, он создаст таблицы
@@ -0,0 +1,37 @@
+# src/database/migrations/env.py
+# Окружение Alembic: подключение - DATABASE_URL из src/config.py, схема - модели из models.py
+# (по ним работает alembic revision --autogenerate и alembic check).
+from alembic import context
+from sqlalchemy import create_engine, pool
+
+from src.config import DATABASE_URL
+from src.database.database import Base
+from src.database import models # noqa: F401 - регистрирует таблицы в Base.metadata
+
+target_metadata = Base.metadata
+
+def run_migrations_offline() -> None:
+    """Выводит SQL миграций без подключения к БД (alembic upgrade head --sql)."""
+    context.configure(url=DATABASE_URL, target_metadata=target_metadata, literal_binds=True,
+                      render_as_batch=DATABASE_URL.startswith("sqlite"))
+    with context.begin_transaction():
+        context.run_migrations()
+
+def run_migrations_online() -> None:
+    # Отдельное соединение без пула: миграции запускаются вне процесса бота
+    connectable = create_engine(DATABASE_URL, poolclass=pool.NullPool)
+    with connectable.connect() as connection:
+        context.configure(
+            connection=connection,
+            target_metadata=target_metadata,
+            # SQLite не умеет большинство ALTER TABLE - batch-операции пересоздают таблицу
+            render_as_batch=connection.dialect.name == "sqlite",
+            transaction_per_migration=True,
+        )
+        with context.begin_transaction():
+            context.run_migrations()
+
+if context.is_offline_mode():
+    run_migrations_offline()
+else:
+    run_migrations_online()
@@ -0,0 +1,24 @@
+# src/database/migrations/helpers.py
+# Общие операции для файлов миграций.
+from alembic import op
+
+def create_index_online(name: str, table: str, columns: list[str], unique: bool = False) -> None:
+    """Создает индекс, не блокируя запись в таблицу.
+
+    На PostgreSQL - CREATE INDEX CONCURRENTLY вне транзакции миграции (таблица остается доступной
+    боту). Если такое создание прервется, останется индекс с пометкой INVALID - его нужно удалить
+    (DROP INDEX CONCURRENTLY) и запустить миграцию снова. На остальных СУБД - обычный CREATE INDEX.
+    """
+    if op.get_context().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.create_index(name, table, columns, unique=unique, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        op.create_index(name, table, columns, unique=unique, if_not_exists=True)
+
+def drop_index_online(name: str, table: str) -> None:
+    """Удаляет индекс (на PostgreSQL - DROP INDEX CONCURRENTLY вне транзакции)."""
+    if op.get_context().dialect.name == "postgresql":
+        with op.get_context().autocommit_block():
+            op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        op.drop_index(name, table_name=table, if_exists=True)
@@ -0,0 +1,84 @@
+"""Исходная схема: пользователи, профили водителей, поездки, бронирования
+
+Revision ID: 0001
+Revises:
+Create Date: 2026-10-18
+
+Базы, созданные прежними версиями бота через create_all до появления ключей городов,
+соответствуют этой ревизии: для них выполните alembic stamp 0001, затем alembic upgrade head.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0001"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "users",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("telegram_id", sa.Integer(), nullable=False),
+        sa.Column("full_name", sa.String()),
+        sa.Column("phone_number", sa.String()),
+        sa.Column("role", sa.String(), nullable=False),
+        sa.Column("is_blocked", sa.Boolean()),
+        sa.Column("registration_date", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_users_id", "users", ["id"])
+    op.create_index("ix_users_telegram_id", "users", ["telegram_id"], unique=True)
+    op.create_index("ix_users_full_name", "users", ["full_name"])
+    op.create_index("ix_users_phone_number", "users", ["phone_number"])
+
+    op.create_table(
+        "driver_profiles",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("user_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False, unique=True),
+        sa.Column("car_make", sa.String()),
+        sa.Column("car_model", sa.String()),
+        sa.Column("car_color", sa.String()),
+        sa.Column("car_plate", sa.String()),
+    )
+    op.create_index("ix_driver_profiles_id", "driver_profiles", ["id"])
+    op.create_index("ix_driver_profiles_car_plate", "driver_profiles", ["car_plate"], unique=True)
+
+    op.create_table(
+        "trips",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("driver_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("departure_city", sa.String(), nullable=False),
+        sa.Column("arrival_city", sa.String(), nullable=False),
+        sa.Column("departure_datetime", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("estimated_arrival_datetime", sa.DateTime(timezone=True)),
+        sa.Column("total_seats", sa.Integer(), nullable=False),
+        sa.Column("available_seats", sa.Integer(), nullable=False),
+        sa.Column("status", sa.String()),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    op.create_index("ix_trips_id", "trips", ["id"])
+    op.create_index("ix_trips_departure_city", "trips", ["departure_city"])
+    op.create_index("ix_trips_arrival_city", "trips", ["arrival_city"])
+    op.create_index("ix_trips_departure_datetime", "trips", ["departure_datetime"])
+    op.create_index("ix_trips_status", "trips", ["status"])
+
+    op.create_table(
+        "bookings",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("passenger_id", sa.Integer(), sa.ForeignKey("users.id"), nullable=False),
+        sa.Column("trip_id", sa.Integer(), sa.ForeignKey("trips.id"), nullable=False),
+        sa.Column("seats_booked", sa.Integer()),
+        sa.Column("status", sa.String()),
+        sa.Column("booked_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+        sa.UniqueConstraint("passenger_id", "trip_id", name="_passenger_trip_uc"),
+    )
+    op.create_index("ix_bookings_id", "bookings", ["id"])
+    op.create_index("ix_bookings_status", "bookings", ["status"])
+
+
+def downgrade() -> None:
+    op.drop_table("bookings")
+    op.drop_table("trips")
+    op.drop_table("driver_profiles")
+    op.drop_table("users")
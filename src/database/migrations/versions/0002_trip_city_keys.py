@@ -0,0 +1,77 @@
+"""Нормализованные ключи городов в поездках и составной индекс поиска
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18
+
+Ключи заполняются пачками по BATCH_SIZE строк (каждая пачка - отдельный UPDATE), индекс
+ix_trips_route_date на PostgreSQL строится CONCURRENTLY: поездки остаются доступны боту.
+
+Колонки ключей появились в моделях раньше миграций, и базы, созданные тогда через create_all, уже
+их содержат. Для таких баз колонки не добавляются, а заполняются только пустые ключи: ревизию можно
+выполнить на любой базе, помеченной 0001, и повторить после прерывания.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.database.migrations.helpers import create_index_online, drop_index_online
+from src.utils.cities import normalize_city
+
+revision = "0002"
+down_revision = "0001"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+trips = sa.table(
+    "trips",
+    sa.column("id", sa.Integer),
+    sa.column("departure_city", sa.String),
+    sa.column("arrival_city", sa.String),
+    sa.column("departure_key", sa.String),
+    sa.column("arrival_key", sa.String),
+)
+
+
+def upgrade() -> None:
+    if op.get_context().as_sql:
+        # Ключи считает normalize_city в Python - одним SQL-скриптом их не заполнить
+        raise RuntimeError("Ревизия 0002 заполняет ключи городов и не поддерживает --sql: выполните ее с подключением к БД")
+
+    connection = op.get_bind()
+    existing = {column["name"] for column in sa.inspect(connection).get_columns("trips")}
+    for name in ("departure_key", "arrival_key"):
+        if name not in existing:
+            op.add_column("trips", sa.Column(name, sa.String()))
+
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(trips.c.id, trips.c.departure_city, trips.c.arrival_city)
+            .where(trips.c.id > last_id, sa.or_(trips.c.departure_key.is_(None), trips.c.arrival_key.is_(None)))
+            .order_by(trips.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        connection.execute(
+            trips.update().where(trips.c.id == sa.bindparam("trip_id")).values(
+                departure_key=sa.bindparam("dep_key"), arrival_key=sa.bindparam("arr_key")),
+            [{"trip_id": row.id, "dep_key": normalize_city(row.departure_city),
+              "arr_key": normalize_city(row.arrival_city)} for row in rows],
+        )
+        last_id = rows[-1].id
+
+    with op.batch_alter_table("trips") as batch_op:
+        batch_op.alter_column("departure_key", existing_type=sa.String(), nullable=False)
+        batch_op.alter_column("arrival_key", existing_type=sa.String(), nullable=False)
+
+    create_index_online("ix_trips_route_date", "trips",
+                        ["departure_key", "arrival_key", "departure_datetime", "status"])
+
+
+def downgrade() -> None:
+    drop_index_online("ix_trips_route_date", "trips")
+    with op.batch_alter_table("trips") as batch_op:
+        batch_op.drop_column("arrival_key")
+        batch_op.drop_column("departure_key")
@@ -0,0 +1,36 @@
+"""Таблица outbox для уведомлений, записанных в одной транзакции с изменением
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0003"
+down_revision = "0002"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "outbox",
+        sa.Column("id", sa.Integer(), primary_key=True),
+        sa.Column("chat_id", sa.Integer(), nullable=False),
+        sa.Column("text", sa.String(), nullable=False),
+        sa.Column("dedup_key", sa.String()),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.Column("next_attempt_at", sa.DateTime(timezone=True), nullable=False),
+        sa.Column("lease_token", sa.String()),
+        sa.Column("sent_at", sa.DateTime(timezone=True)),
+        sa.Column("created_at", sa.DateTime(timezone=True), server_default=sa.func.now()),
+    )
+    # Таблица новая и пустая - индексы можно создавать обычным способом
+    op.create_index("ix_outbox_id", "outbox", ["id"])
+    op.create_index("ix_outbox_dedup_key", "outbox", ["dedup_key"])
+    op.create_index("ix_outbox_pending", "outbox", ["sent_at", "next_attempt_at"])
+
+
+def downgrade() -> None:
+    op.drop_table("outbox")
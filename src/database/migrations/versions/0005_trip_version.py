@@ -0,0 +1,23 @@
+"""Версия поездки для кэша отрисованных карточек
+
+Revision ID: 0005
+Revises: 0004
+Create Date: 2026-10-18
+"""
+from alembic import op
+import sqlalchemy as sa
+
+revision = "0005"
+down_revision = "0004"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Значение по умолчанию на стороне БД: на PostgreSQL 11+ колонка добавляется без перезаписи таблицы
+    op.add_column("trips", sa.Column("version", sa.Integer(), nullable=False, server_default="0"))
+
+
+def downgrade() -> None:
+    with op.batch_alter_table("trips") as batch_op:
+        batch_op.drop_column("version")
@@ -0,0 +1,67 @@
+"""Ключи городов в поездках с учетом синонимов справочника
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18
+
+Ревизия 0002 заполнила ключи через normalize_city, и поездка, созданная с "Мск", не находилась
+поиском "Москва". Ключи пересчитываются через city_key пачками по BATCH_SIZE строк; обновляются
+только строки, ключ которых изменился.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from src.utils.cities import city_key, normalize_city
+
+revision = "0006"
+down_revision = "0005"
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 1000
+
+trips = sa.table(
+    "trips",
+    sa.column("id", sa.Integer),
+    sa.column("departure_city", sa.String),
+    sa.column("arrival_city", sa.String),
+    sa.column("departure_key", sa.String),
+    sa.column("arrival_key", sa.String),
+)
+
+
+def _rekey(key) -> None:
+    if op.get_context().as_sql:
+        # Ключи считаются в Python - одним SQL-скриптом их не пересчитать
+        raise RuntimeError("Ревизия 0006 пересчитывает ключи городов и не поддерживает --sql: выполните ее с подключением к БД")
+
+    connection = op.get_bind()
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            sa.select(trips.c.id, trips.c.departure_city, trips.c.arrival_city,
+                      trips.c.departure_key, trips.c.arrival_key)
+            .where(trips.c.id > last_id).order_by(trips.c.id).limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        changed = []
+        for row in rows:
+            dep_key, arr_key = key(row.departure_city), key(row.arrival_city)
+            if (dep_key, arr_key) != (row.departure_key, row.arrival_key):
+                changed.append({"trip_id": row.id, "dep_key": dep_key, "arr_key": arr_key})
+        if changed:
+            connection.execute(
+                trips.update().where(trips.c.id == sa.bindparam("trip_id")).values(
+                    departure_key=sa.bindparam("dep_key"), arrival_key=sa.bindparam("arr_key")),
+                changed,
+            )
+        last_id = rows[-1].id
+
+
+def upgrade() -> None:
+    _rekey(city_key)
+
+
+def downgrade() -> None:
+    _rekey(normalize_city)
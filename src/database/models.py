@@ -1,6 +1,6 @@
 # src/database/models.py
-from sqlalchemy import (Column, Integer, String, ForeignKey, DateTime,
-                        Boolean, create_engine, UniqueConstraint)
+from sqlalchemy import (Column, Integer, String, ForeignKey, DateTime, LargeBinary,
+                        Boolean, create_engine, UniqueConstraint, Index)
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func # Для default=func.now() если нужно
 
@@ -10,6 +10,7 @@ from src.config import ROLE_PASSENGER
 
 class User(Base):
     __tablename__ = "users"
+    __mapper_args__ = {"eager_defaults": True} # Значения server_default - из RETURNING того же INSERT
 
     id = Column(Integer, primary_key=True, index=True)
     telegram_id = Column(Integer, unique=True, index=True, nullable=False)
@@ -45,17 +46,29 @@ class DriverProfile(Base):
 
 class Trip(Base):
     __tablename__ = "trips"
+    __mapper_args__ = {"eager_defaults": True} # Значения server_default - из RETURNING того же INSERT
 
     id = Column(Integer, primary_key=True, index=True)
     driver_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     departure_city = Column(String, index=True, nullable=False)
     arrival_city = Column(String, index=True, nullable=False)
+    # Ключи городов с учетом синонимов справочника (utils.cities.city_key) - по ним идет поиск
+    departure_key = Column(String, nullable=False)
+    arrival_key = Column(String, nullable=False)
     departure_datetime = Column(DateTime(timezone=True), nullable=False, index=True)
     estimated_arrival_datetime = Column(DateTime(timezone=True))
     total_seats = Column(Integer, nullable=False)
     available_seats = Column(Integer, nullable=False)
     status = Column(String, default='scheduled', index=True) # 'scheduled', 'active', 'completed', 'cancelled'
     created_at = Column(DateTime(timezone=True), server_default=func.now())
+    # Растет при любой записи crud в поездку, ее водителя или профиль водителя: отрисованные карточки
+    # кэшируются по (id, version) (utils/helpers.py), и устаревшая карточка не может быть показана
+    version = Column(Integer, nullable=False, server_default="0")
+
+    # Составной индекс для find_trips: равенство по маршруту + диапазон по дате
+    __table_args__ = (
+        Index('ix_trips_route_date', 'departure_key', 'arrival_key', 'departure_datetime', 'status'),
+    )
 
     # Связи
     driver = relationship("User", back_populates="driver_trips")
@@ -67,6 +80,7 @@ class Trip(Base):
 
 class Booking(Base):
     __tablename__ = "bookings"
+    __mapper_args__ = {"eager_defaults": True} # Значения server_default - из RETURNING того же INSERT
 
     id = Column(Integer, primary_key=True, index=True)
     passenger_id = Column(Integer, ForeignKey("users.id"), nullable=False)
@@ -84,3 +98,45 @@ class Booking(Base):
 
     def __repr__(self):
         return f"<Booking(id={self.id}, trip={self.trip_id}, passenger={self.passenger_id}, seats={self.seats_booked})>"
+
+class OutboxMessage(Base):
+    """Уведомление, записанное в той же транзакции, что и изменение (transactional outbox).
+
+    Отправляет фоновый OutboxSender (utils/outbox.py): если процесс упадет после коммита,
+    сообщение останется в таблице и будет отправлено после перезапуска.
+    """
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True, index=True)
+    chat_id = Column(Integer, nullable=False)
+    text = Column(String, nullable=False)
+    # Ключ события (например, "booking:15:cancelled"): неотправленные дубли с тем же ключом не отправляются повторно
+    dedup_key = Column(String, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    next_attempt_at = Column(DateTime(timezone=True), nullable=False) # Раньше этого времени строку не берут (аренда/повтор)
+    lease_token = Column(String) # Кто из отправителей (реплик) взял строку в работу
+    sent_at = Column(DateTime(timezone=True)) # NULL - еще не отправлено
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Выборка очереди: неотправленные строки, у которых подошло время
+    __table_args__ = (
+        Index('ix_outbox_pending', 'sent_at', 'next_attempt_at'),
+    )
+
+    def __repr__(self):
+        return f"<OutboxMessage(id={self.id}, chat={self.chat_id}, key='{self.dedup_key}', attempts={self.attempts})>"
+
+class PersistenceEntry(Base):
+    """Данные python-telegram-bot (user_data, chat_data, bot_data, состояния диалогов) - см. utils/persistence.py.
+
+    Одна строка на пользователя/чат/диалог, поэтому сохраняются только изменившиеся записи.
+    """
+    __tablename__ = "bot_persistence"
+
+    namespace = Column(String, primary_key=True) # "user_data", "chat_data", "bot_data", "conversation:<имя>"
+    key = Column(String, primary_key=True) # id пользователя/чата или ключ диалога (JSON)
+    data = Column(LargeBinary, nullable=False) # pickle
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<PersistenceEntry(namespace='{self.namespace}', key='{self.key}', size={len(self.data or b'')})>"
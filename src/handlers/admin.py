@@ -1,15 +1,24 @@
 # src/handlers/admin.py
 import logging
+from contextlib import closing
+from itertools import chain, islice
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (ContextTypes, ConversationHandler, CommandHandler, MessageHandler,
                            filters)
 
-from src.database import crud
-from src.database.database import get_db
-from src.config import logger, ADMIN_IDS, ROLE_DRIVER
+from src.database import crud, async_crud
+from src.database.models import User
+from src.database.database import get_pool_stats
+from src.database.async_database import async_session_scope
+from src.config import ADMIN_IDS, ROLE_DRIVER
 from src.keyboards import reply as reply_kb
+from src.utils.helpers import chunk_lines
+from src.utils.notifier import MAX_MESSAGE_LENGTH
+from src.utils.outbox import outbox_sender
 from .common import cancel
 
+logger = logging.getLogger(__name__)
+
 # Определим состояния для диалогов админа (если нужны)
 ASK_DRIVER_ID_TO_ADD, ASK_DRIVER_ID_TO_BLOCK, ASK_DRIVER_ID_TO_UNBLOCK = range(20, 23)
 
@@ -18,42 +27,80 @@ async def admin_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     # Дополнительная проверка, что пользователь действительно админ
     if user.id not in ADMIN_IDS:
-        logger.warning(f"Попытка доступа к админ-панели пользователем {user.id}")
+        logger.warning("Попытка доступа к админ-панели пользователем %s", user.id)
         return # Ничего не делаем
 
-    await update.message.reply_text(" FONT="monospace"> Панель администратора:", reply_markup=reply_kb.markup_admin_main)
+    await update.message.reply_text("🛠 Панель администратора:", reply_markup=reply_kb.markup_admin_main)
+
+async def pool_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает состояние пулов соединений с БД (для диагностики утечек и нехватки соединений)."""
+    user = update.effective_user
+    if user.id not in ADMIN_IDS: return
+
+    stats = get_pool_stats()
+    await update.message.reply_text("\n\n".join(
+        f"Пул соединений ({name}):\n{pool['status']}\n"
+        f"Выдано: {pool['checkouts']}, возвращено: {pool['checkins']}, занято сейчас: {pool['in_use']}"
+        for name, pool in stats["pools"].items()
+    ))
 
 # --- Управление водителями ---
 
+# Сообщений подряд в один чат больше не отправляем (лимит Telegram); дальше - уточнить фильтр
+DRIVER_LIST_MAX_MESSAGES = 10
+
+def _driver_line(i: int, driver: User) -> str:
+    profile = driver.driver_profile
+    car_info = f"{profile.car_make} {profile.car_model} ({profile.car_plate})" if profile else "Нет данных об авто"
+    status = " 🚫 [Заблокирован]" if driver.is_blocked else ""
+    return (f"{i}. {driver.full_name} (ID: {driver.telegram_id})\n"
+            f"   📞 Телефон: {driver.phone_number}\n"
+            f"   🚗 Авто: {car_info}{status}\n\n")
+
+def _parse_driver_filter(args: list[str]) -> tuple[bool | None, str | None]:
+    """Аргументы /list_drivers: [blocked|active] [начало имени]."""
+    blocked = None
+    if args and args[0].lower() in ("blocked", "active"):
+        blocked = args[0].lower() == "blocked"
+        args = args[1:]
+    return blocked, " ".join(args) or None
+
+def _driver_list_messages(db, blocked: bool | None, name_prefix: str | None) -> list[str]:
+    """Сообщения списка водителей: не больше DRIVER_LIST_MAX_MESSAGES + 1 (лишнее - признак, что список длиннее).
+
+    Водители читаются из БД пачками, чтение останавливается, как только набрано достаточно сообщений.
+    Синхронная (iter_drivers - генератор): вызывается через AsyncSession.run_sync.
+    """
+    with closing(crud.iter_drivers(db, blocked=blocked, name_prefix=name_prefix)) as drivers:
+        first = next(drivers, None)
+        if first is None:
+            return []
+        lines = (_driver_line(i, driver) for i, driver in enumerate(chain([first], drivers), 1))
+        return list(islice(chunk_lines(lines, MAX_MESSAGE_LENGTH, header="📋 Список водителей:\n\n"),
+                           DRIVER_LIST_MAX_MESSAGES + 1))
+
 async def list_drivers(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Выводит список водителей."""
+    """Выводит список водителей: /list_drivers [blocked|active] [начало имени].
+
+    Сообщения собираются до отправки: сессия БД не остается открытой на время вызовов Telegram.
+    """
     user = update.effective_user
     if user.id not in ADMIN_IDS: return
 
-    db = next(get_db())
-    drivers = crud.get_all_drivers(db)
+    blocked, name_prefix = _parse_driver_filter(context.args or [])
+    async with async_session_scope(user.id) as db:
+        messages = await db.run_sync(_driver_list_messages, blocked, name_prefix)
 
-    if not drivers:
-        await update.message.reply_text("В системе нет зарегистрированных водителей.")
+    if not messages:
+        await update.message.reply_text("Водители по заданному фильтру не найдены." if blocked is not None or name_prefix
+                                        else "В системе нет зарегистрированных водителей.")
         return
-
-    message = " FONT="monospace"> Список водителей:\n\n"
-    for i, driver in enumerate(drivers, 1):
-        profile = driver.driver_profile
-        car_info = f"{profile.car_make} {profile.car_model} ({profile.car_plate})" if profile else "Нет данных об авто"
-        status = " FONT="monospace"> [Заблокирован]" if driver.is_blocked else ""
-        message += (f"{i}. {driver.full_name} (ID: {driver.telegram_id})\n"
-                    f"    FONT="monospace"> Телефон: {driver.phone_number}\n"
-                    f"    FONT="monospace"> Авто: {car_info}{status}\n\n")
-
-    # Отправка может быть слишком длинной, надо разбивать
-    # Пока отправляем как есть
-    if len(message) > 4000: # Примерный лимит Telegram
-         await update.message.reply_text("Слишком много водителей для отображения одним сообщением.")
-         # Здесь нужна логика разбивки сообщения
-    else:
-         await update.message.reply_text(message)
-
+    for sent, chunk in enumerate(messages):
+        if sent == DRIVER_LIST_MAX_MESSAGES:
+            await update.message.reply_text(
+                "Список слишком длинный. Уточните фильтр: /list_drivers [blocked|active] [начало имени]")
+            break
+        await update.message.reply_text(chunk)
 
 async def add_driver_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог добавления водителя: спрашивает ID."""
@@ -77,8 +124,17 @@ async def add_driver_id_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Некорректный ID. Введите числовой Telegram ID.")
         return ASK_DRIVER_ID_TO_ADD
 
-    db = next(get_db())
-    target_user = crud.get_user_by_telegram_id(db, target_user_id)
+    async with async_session_scope(admin.id) as db:
+        target_user = await async_crud.get_user_profile(db, target_user_id)
+        updated_user = None
+        if target_user and target_user.role != ROLE_DRIVER:
+            # Меняем роль; уведомление пользователю сохраняется в outbox в той же транзакции
+            updated_user = await async_crud.update_user_role(db, target_user_id, ROLE_DRIVER, notify=lambda user: [crud.OutboxItem(
+                user.telegram_id,
+                "🎉 Администратор назначил вас водителем!\n"
+                "ℹ️ Теперь вам доступны функции водителя. Если вы еще не добавили данные об авто, используйте /register_driver.",
+                f"user:{user.telegram_id}:role:{ROLE_DRIVER}"
+            )])
 
     if not target_user:
         await update.message.reply_text(f"Пользователь с ID {target_user_id} не найден в базе бота.")
@@ -88,20 +144,10 @@ async def add_driver_id_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text(f"Пользователь {target_user.full_name} (ID: {target_user_id}) уже является водителем.")
         return ConversationHandler.END
 
-    # Меняем роль
-    updated_user = crud.update_user_role(db, target_user_id, ROLE_DRIVER)
     if updated_user:
-        logger.info(f"Администратор {admin.id} назначил {target_user_id} водителем.")
+        outbox_sender.wake()
+        logger.info("Администратор %s назначил %s водителем.", admin.id, target_user_id)
         await update.message.reply_text(f"✅ Пользователь {updated_user.full_name} (ID: {target_user_id}) назначен водителем.")
-        # Уведомить пользователя?
-        try:
-            await context.bot.send_message(
-                chat_id=target_user_id,
-                text=" FONT="monospace"> Администратор назначил вас водителем!\n"
-                     " FONT="monospace"> Теперь вам доступны функции водителя. Если вы еще не добавили данные об авто, используйте /register_driver."
-            )
-        except Exception as e:
-            logger.error(f"Не удалось уведомить пользователя {target_user_id} о назначении водителем: {e}")
     else:
         await update.message.reply_text(f"Не удалось обновить роль для пользователя {target_user_id}.")
 
@@ -127,17 +173,15 @@ async def block_driver_id_handler(update: Update, context: ContextTypes.DEFAULT_
         await update.message.reply_text("Некорректный ID.")
         return ASK_DRIVER_ID_TO_BLOCK
 
-    db = next(get_db())
-    user_to_block = crud.block_user(db, target_user_id, block_status=True)
+    async with async_session_scope(admin.id) as db:
+        user_to_block = await async_crud.block_user(db, target_user_id, block_status=True, notify=lambda user: [crud.OutboxItem(
+            user.telegram_id, "❌ Ваш аккаунт был заблокирован администратором." # Блокировка может повторяться - без ключа дублей
+        )])
 
     if user_to_block:
-        logger.info(f"Администратор {admin.id} заблокировал пользователя {target_user_id}")
+        outbox_sender.wake()
+        logger.info("Администратор %s заблокировал пользователя %s", admin.id, target_user_id)
         await update.message.reply_text(f"✅ Пользователь {user_to_block.full_name} (ID: {target_user_id}) заблокирован.")
-        # Уведомить пользователя о блокировке?
-        try:
-            await context.bot.send_message(chat_id=target_user_id, text="❌ Ваш аккаунт был заблокирован администратором.")
-        except Exception as e:
-             logger.error(f"Не удалось уведомить пользователя {target_user_id} о блокировке: {e}")
     else:
         await update.message.reply_text(f"Пользователь с ID {target_user_id} не найден или произошла ошибка.")
 
@@ -163,17 +207,15 @@ async def unblock_driver_id_handler(update: Update, context: ContextTypes.DEFAUL
         await update.message.reply_text("Некорректный ID.")
         return ASK_DRIVER_ID_TO_UNBLOCK
 
-    db = next(get_db())
-    user_to_unblock = crud.block_user(db, target_user_id, block_status=False)
+    async with async_session_scope(admin.id) as db:
+        user_to_unblock = await async_crud.block_user(db, target_user_id, block_status=False, notify=lambda user: [crud.OutboxItem(
+            user.telegram_id, "✅ Ваш аккаунт был разблокирован администратором."
+        )])
 
     if user_to_unblock:
-        logger.info(f"Администратор {admin.id} разблокировал пользователя {target_user_id}")
+        outbox_sender.wake()
+        logger.info("Администратор %s разблокировал пользователя %s", admin.id, target_user_id)
         await update.message.reply_text(f"✅ Пользователь {user_to_unblock.full_name} (ID: {target_user_id}) разблокирован.")
-        # Уведомить пользователя о разблокировке?
-        try:
-            await context.bot.send_message(chat_id=target_user_id, text="✅ Ваш аккаунт был разблокирован администратором.")
-        except Exception as e:
-             logger.error(f"Не удалось уведомить пользователя {target_user_id} о разблокировке: {e}")
     else:
         await update.message.reply_text(f"Пользователь с ID {target_user_id} не найден или произошла ошибка.")
 
@@ -187,6 +229,7 @@ add_driver_conv = ConversationHandler(
         ASK_DRIVER_ID_TO_ADD: [MessageHandler(filters.TEXT & ~filters.COMMAND, add_driver_id_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="add_driver_conversation", persistent=True,
 )
 block_driver_conv = ConversationHandler(
     entry_points=[CommandHandler('block_driver', block_driver_start, filters=filters.User(ADMIN_IDS))],
@@ -194,6 +237,7 @@ block_driver_conv = ConversationHandler(
         ASK_DRIVER_ID_TO_BLOCK: [MessageHandler(filters.TEXT & ~filters.COMMAND, block_driver_id_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="block_driver_conversation", persistent=True,
 )
 unblock_driver_conv = ConversationHandler(
     entry_points=[CommandHandler('unblock_driver', unblock_driver_start, filters=filters.User(ADMIN_IDS))],
@@ -201,12 +245,14 @@ unblock_driver_conv = ConversationHandler(
         ASK_DRIVER_ID_TO_UNBLOCK: [MessageHandler(filters.TEXT & ~filters.COMMAND, unblock_driver_id_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="unblock_driver_conversation", persistent=True,
 )
 
 # --- Список хендлеров администратора ---
 admin_handlers = [
     CommandHandler('admin', admin_menu, filters=filters.User(ADMIN_IDS)),
     CommandHandler('list_drivers', list_drivers, filters=filters.User(ADMIN_IDS)),
+    CommandHandler('pool_stats', pool_stats, filters=filters.User(ADMIN_IDS)),
     add_driver_conv,
     block_driver_conv,
     unblock_driver_conv,
@@ -1,26 +1,48 @@
 # src/handlers/common.py
 import logging
 from telegram import Update, ReplyKeyboardRemove, KeyboardButton, ReplyKeyboardMarkup
-from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, filters
+from telegram.ext import (ContextTypes, ConversationHandler, CommandHandler, MessageHandler, TypeHandler,
+                          ApplicationHandlerStop, filters)
 
-from src.database import crud
-from src.database.database import get_db
-from src.config import (logger, ADMIN_IDS, ROLE_ADMIN, ROLE_DRIVER, ROLE_PASSENGER,
+from src.database import crud, async_crud
+from src.database.async_database import async_session_scope
+from src.config import (ADMIN_IDS, ROLE_ADMIN, ROLE_DRIVER, ROLE_PASSENGER,
                         ASK_PHONE, ASK_FULL_NAME, REGISTRATION_COMPLETE, CHOOSE_ACTION)
 from src.keyboards import reply as reply_kb
 from src.keyboards import inline as inline_kb
-from .passenger import passenger_menu # Импортируем функции меню
-from .driver import driver_menu
-from .admin import admin_menu
+from src.utils.cities import city_index
+
+logger = logging.getLogger(__name__)
+
+# --- Фильтр заблокированных пользователей ---
+
+async def blocked_user_gate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Останавливает обработку апдейтов от заблокированных пользователей до остальных обработчиков.
+
+    Проверка идет по множеству в памяти (crud.is_user_blocked), без сессии БД.
+    """
+    user = update.effective_user
+    if user is None or not crud.is_user_blocked(user.id):
+        return
+    if update.message and update.message.text and update.message.text.startswith("/start"):
+        await update.message.reply_text("❌ Ваш аккаунт заблокирован администратором.")
+    raise ApplicationHandlerStop
+
+# Группа -1 обрабатывается раньше всех остальных
+blocked_user_gate_handler = TypeHandler(Update, blocked_user_gate)
 
 # --- Регистрация ---
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
     """Обработчик команды /start. Проверяет регистрацию."""
     user_tg = update.effective_user
-    logger.info(f"Пользователь {user_tg.id} ({user_tg.username or 'no_username'}) запустил /start")
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user_tg.id)
+    logger.info("Пользователь %s (%s) запустил /start", user_tg.id, user_tg.username or 'no_username')
+    async with async_session_scope(user_tg.id) as db:
+        db_user = await async_crud.get_user_profile(db, user_tg.id)
+        # Если ID в списке админов, даем админские права (даже если роль другая)
+        if (db_user and not db_user.is_blocked and db_user.telegram_id in ADMIN_IDS
+                and db_user.role != ROLE_ADMIN):
+            await async_crud.update_user_role(db, db_user.telegram_id, ROLE_ADMIN)
 
     if db_user:
         if db_user.is_blocked:
@@ -28,11 +50,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | Non
             return ConversationHandler.END
 
         # Пользователь найден, показываем меню согласно роли
-        logger.info(f"Пользователь {user_tg.id} уже зарегистрирован как {db_user.role}")
+        logger.info("Пользователь %s уже зарегистрирован как %s", user_tg.id, db_user.role)
         if db_user.telegram_id in ADMIN_IDS:
-            # Если ID в списке админов, даем админские права (даже если роль другая)
-            if db_user.role != ROLE_ADMIN:
-                crud.update_user_role(db, db_user.telegram_id, ROLE_ADMIN)
             await admin_menu(update, context)
         elif db_user.role == ROLE_DRIVER:
             await driver_menu(update, context)
@@ -49,10 +68,10 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | Non
 
     else:
         # Новый пользователь, начинаем регистрацию
-        logger.info(f"Новый пользователь {user_tg.id}. Начинаем регистрацию.")
+        logger.info("Новый пользователь %s. Начинаем регистрацию.", user_tg.id)
         await update.message.reply_text(
-            " FONT="monospace"> Добро пожаловать в бот междугородних перевозок!\n"
-            " FONT="monospace"> Для начала работы, пожалуйста, поделитесь вашим номером телефона.",
+            "👋 Добро пожаловать в бот междугородних перевозок!\n"
+            "📱 Для начала работы, пожалуйста, поделитесь вашим номером телефона.",
             reply_markup=reply_kb.markup_request_contact
         )
         return ASK_PHONE # Переходим к ожиданию номера телефона
@@ -69,10 +88,10 @@ async def ask_phone_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ASK_PHONE
 
     context.user_data['phone_number'] = contact.phone_number
-    logger.info(f"Получен номер телефона {contact.phone_number} от {user_tg.id}")
+    logger.info("Получен номер телефона %s от %s", contact.phone_number, user_tg.id)
 
     await update.message.reply_text(
-        " FONT="monospace"> Отлично! Теперь введите ваше ФИО (Фамилия Имя Отчество).",
+        "✅ Отлично! Теперь введите ваше ФИО (Фамилия Имя Отчество).",
         reply_markup=ReplyKeyboardRemove() # Убираем кнопку запроса контакта
     )
     return ASK_FULL_NAME # Переходим к ожиданию ФИО
@@ -88,49 +107,99 @@ async def ask_full_name_handler(update: Update, context: ContextTypes.DEFAULT_TY
         return ASK_FULL_NAME
 
     if not phone_number:
-        logger.error(f"Не найден номер телефона в context.user_data для {user_tg.id} на шаге ФИО.")
+        logger.error("Не найден номер телефона в context.user_data для %s на шаге ФИО.", user_tg.id)
         await update.message.reply_text("Произошла ошибка. Попробуйте начать сначала /start")
         return ConversationHandler.END
 
-    logger.info(f"Получено ФИО '{full_name}' от {user_tg.id}")
+    logger.info("Получено ФИО '%s' от %s", full_name, user_tg.id)
 
-    db = next(get_db())
     try:
-        db_user = crud.create_user(db, user_tg.id, full_name.strip(), phone_number)
-        logger.info(f"Пользователь {user_tg.id} успешно зарегистрирован.")
-        context.user_data.clear() # Очищаем временные данные
-
-        await update.message.reply_text(
-            f" FONT="monospace"> Регистрация завершена, {db_user.full_name}!\n"
-            " FONT="monospace"> Вы зарегистрированы как пассажир."
-        )
-        # Показываем меню пассажира
-        await passenger_menu(update, context)
-        return ConversationHandler.END # Завершаем диалог регистрации
-
+        async with async_session_scope(user_tg.id) as db:
+            db_user = await async_crud.create_user(db, user_tg.id, full_name.strip(), phone_number)
     except Exception as e:
-        logger.error(f"Ошибка при создании пользователя {user_tg.id}: {e}")
+        logger.error("Ошибка при создании пользователя %s: %s", user_tg.id, e)
         await update.message.reply_text("Произошла ошибка при регистрации. Попробуйте позже.")
         context.user_data.clear()
         return ConversationHandler.END
 
+    logger.info("Пользователь %s успешно зарегистрирован.", user_tg.id)
+    context.user_data.clear() # Очищаем временные данные
+    await update.message.reply_text(
+        f"🎉 Регистрация завершена, {db_user.full_name}!\n"
+        "👤 Вы зарегистрированы как пассажир."
+    )
+    # Показываем меню пассажира
+    await passenger_menu(update, context)
+    return ConversationHandler.END # Завершаем диалог регистрации
+
 async def registration_fallback_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обрабатывает некорректный ввод во время регистрации."""
     current_state = context.user_data.get('state') # Нужно будет сохранять состояние
-    logger.warning(f"Некорректный ввод от {update.effective_user.id} в состоянии регистрации {current_state}")
+    logger.warning("Некорректный ввод от %s в состоянии регистрации %s", update.effective_user.id, current_state)
     await update.message.reply_text("Некорректный ввод. Пожалуйста, следуйте инструкциям или нажмите /cancel для отмены.")
     # Возвращаем то же состояние, чтобы пользователь попробовал снова
     # Это требует сохранения текущего состояния в context.user_data или использования ConversationHandler state
     return ASK_PHONE # Или другое релевантное состояние
 
 
+# --- Выбор города (используется в диалогах поиска и создания поездки) ---
+
+async def resolve_city_input(update: Update, context: ContextTypes.DEFAULT_TYPE, field: str) -> str | None:
+    """Распознает введенный город по справочнику.
+
+    Возвращает каноническое название, если ввод распознан однозначно ("Мск" -> "Москва"),
+    или введенный текст, если похожих городов нет. Если есть только похожие варианты,
+    показывает подсказки и возвращает None (выбор придет в city_choice_from_callback).
+    """
+    typed_text = " ".join(update.message.text.split())
+    city = city_index.resolve(typed_text)
+    if city:
+        return city.name
+
+    suggestions = city_index.suggest(typed_text)
+    if not suggestions:
+        return typed_text
+
+    context.user_data[f'city_input_{field}'] = typed_text
+    await update.message.reply_text(
+        "Уточните город:",
+        reply_markup=inline_kb.city_suggestions_keyboard(suggestions, field, typed_text)
+    )
+    return None
+
+async def city_choice_from_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str | None:
+    """Обрабатывает нажатие на подсказку города (callback_data: city_<field>_<id|raw>)."""
+    query = update.callback_query
+    await query.answer()
+
+    try:
+        _, field, choice = query.data.split("_", 2)
+    except ValueError:
+        logger.error("Некорректный callback_data для выбора города: %s", query.data)
+        return None
+
+    if choice == "raw":
+        city_name = context.user_data.pop(f'city_input_{field}', None)
+    else:
+        city = city_index.get(int(choice)) if choice.isdigit() else None
+        city_name = city.name if city else None
+        context.user_data.pop(f'city_input_{field}', None)
+
+    if not city_name:
+        await query.edit_message_text("Не удалось определить город. Введите название еще раз.")
+        return None
+
+    await query.edit_message_text(f"Выбран город: {city_name}")
+    return city_name
+
+
 # --- Общие команды ---
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет сообщение с помощью."""
     # Текст помощи нужно будет дополнить
     help_text = (
-        " FONT="monospace"> Доступные команды:\n"
+        "ℹ️ Доступные команды:\n"
         "/start - Начать работу с ботом / Показать главное меню\n"
         "/find_trip - Найти поездку (для пассажиров)\n"
         "/my_bookings - Мои бронирования (для пассажиров)\n"
@@ -146,15 +215,15 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Отменяет текущий диалог ConversationHandler."""
     user = update.effective_user
-    logger.info(f"Пользователь {user.id} отменил диалог.")
+    logger.info("Пользователь %s отменил диалог.", user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
     # Очищаем user_data, если там хранились временные данные диалога
     # context.user_data.clear() # Делать осторожно, если там есть и постоянные данные
     await update.message.reply_text(
         "Действие отменено.", reply_markup=ReplyKeyboardRemove() # Убираем спец. клавиатуру, если была
     )
     # Нужно показать основное меню после отмены
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
     if db_user:
          if db_user.role == ROLE_ADMIN or db_user.telegram_id in ADMIN_IDS:
               await admin_menu(update, context)
@@ -176,8 +245,14 @@ registration_conv_handler = ConversationHandler(
     fallbacks=[
         CommandHandler('cancel', cancel),
         # Обработчик для любого другого сообщения в процессе регистрации
-        MessageHandler(filters.TEXT | filters.COMMAND | filters.VIDEO | filters.PHOTO | filters.Document, registration_fallback_handler)
+        MessageHandler(filters.TEXT | filters.COMMAND | filters.VIDEO | filters.PHOTO | filters.Document.ALL, registration_fallback_handler)
         ],
-    # persistent=True, name="registration_conversation" # Для хранения между перезапусками (требует настройки)
+    name="registration_conversation", persistent=True, # Состояние хранится в БД (utils/persistence.py)
     # allow_reentry=True # Позволяет войти в диалог снова по /start
 )
+
+# Функции меню импортируются в конце модуля: passenger, driver и admin сами импортируют cancel отсюда,
+# и к этому моменту он уже определен (иначе циклический импорт)
+from .passenger import passenger_menu # noqa: E402
+from .driver import driver_menu # noqa: E402
+from .admin import admin_menu # noqa: E402
@@ -5,42 +5,45 @@ from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (ContextTypes, ConversationHandler, CommandHandler, MessageHandler,
                           CallbackQueryHandler, filters)
 
-from src.database import crud
-from src.database.database import get_db
-from src.database.models import User
-from src.config import (logger, ROLE_DRIVER, ASK_CAR_MAKE, ASK_CAR_MODEL, ASK_CAR_COLOR, ASK_CAR_PLATE,
+from src.database import crud, async_crud
+from src.database.async_database import async_session_scope
+from src.config import (ROLE_DRIVER, ASK_CAR_MAKE, ASK_CAR_MODEL, ASK_CAR_COLOR, ASK_CAR_PLATE,
                         ASK_TRIP_DEPARTURE_CITY, ASK_TRIP_ARRIVAL_CITY, ASK_TRIP_DEPARTURE_DATETIME,
                         ASK_TRIP_ARRIVAL_DATETIME, ASK_TRIP_SEATS)
 from src.keyboards import reply as reply_kb
 from src.keyboards import inline as inline_kb
 from src.utils.helpers import format_trip_details, parse_datetime
-from .common import cancel
+from src.utils.cities import city_index
+from src.utils.outbox import outbox_sender
+from .common import cancel, resolve_city_input, city_choice_from_callback
+
+logger = logging.getLogger(__name__)
 
 async def driver_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню водителя."""
-    await update.message.reply_text(" FONT="monospace"> Панель водителя:", reply_markup=reply_kb.markup_driver_main)
+    await update.message.reply_text("🚕 Панель водителя:", reply_markup=reply_kb.markup_driver_main)
 
-def is_driver(db_user: User | None) -> bool:
+def is_driver(db_user: crud.UserProfile | None) -> bool:
     """Проверяет, является ли пользователь водителем."""
-    return db_user and db_user.role == ROLE_DRIVER and db_user.driver_profile is not None
+    return db_user and db_user.role == ROLE_DRIVER and db_user.has_driver_profile
 
 # --- Регистрация водителя ---
 
 async def register_driver_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог регистрации водителя (спрашивает марку авто)."""
     user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
 
     if not db_user or db_user.is_blocked: return ConversationHandler.END
     if is_driver(db_user):
         await update.message.reply_text("Вы уже зарегистрированы как водитель.")
         return ConversationHandler.END
 
-    logger.info(f"Пользователь {user.id} ({db_user.full_name}) начал регистрацию как водитель.")
+    logger.info("Пользователь %s (%s) начал регистрацию как водитель.", user.id, db_user.full_name)
     await update.message.reply_text(
-        " FONT="monospace"> Регистрация водителя.\n"
-        " FONT="monospace"> Пожалуйста, введите марку вашего автомобиля (например, Toyota, ВАЗ):",
+        "🚗 Регистрация водителя.\n"
+        "✏️ Пожалуйста, введите марку вашего автомобиля (например, Toyota, ВАЗ):",
         reply_markup=reply_kb.markup_cancel
     )
     return ASK_CAR_MAKE
@@ -52,7 +55,7 @@ async def ask_car_make_handler(update: Update, context: ContextTypes.DEFAULT_TYP
         await update.message.reply_text("Введите корректную марку автомобиля.")
         return ASK_CAR_MAKE
     context.user_data['car_make'] = car_make.strip()
-    await update.message.reply_text(" FONT="monospace"> Введите модель автомобиля (например, Camry, 2109):", reply_markup=reply_kb.markup_cancel)
+    await update.message.reply_text("✏️ Введите модель автомобиля (например, Camry, 2109):", reply_markup=reply_kb.markup_cancel)
     return ASK_CAR_MODEL
 
 async def ask_car_model_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -62,7 +65,7 @@ async def ask_car_model_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Введите корректную модель автомобиля.")
         return ASK_CAR_MODEL
     context.user_data['car_model'] = car_model.strip()
-    await update.message.reply_text(" FONT="monospace"> Введите цвет автомобиля:", reply_markup=reply_kb.markup_cancel)
+    await update.message.reply_text("🎨 Введите цвет автомобиля:", reply_markup=reply_kb.markup_cancel)
     return ASK_CAR_COLOR
 
 async def ask_car_color_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -72,7 +75,7 @@ async def ask_car_color_handler(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("Введите корректный цвет автомобиля.")
         return ASK_CAR_COLOR
     context.user_data['car_color'] = car_color.strip()
-    await update.message.reply_text(" FONT="monospace"> Введите государственный номер автомобиля (например, А123ВС77):", reply_markup=reply_kb.markup_cancel)
+    await update.message.reply_text("🔢 Введите государственный номер автомобиля (например, А123ВС77):", reply_markup=reply_kb.markup_cancel)
     return ASK_CAR_PLATE
 
 async def ask_car_plate_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -93,78 +96,101 @@ async def ask_car_plate_handler(update: Update, context: ContextTypes.DEFAULT_TY
     car_color = context.user_data.get('car_color')
 
     if not all([car_make, car_model, car_color]):
-        logger.error(f"Отсутствуют данные об авто в context.user_data при регистрации водителя {user.id}")
+        logger.error("Отсутствуют данные об авто в context.user_data при регистрации водителя %s", user.id)
         await update.message.reply_text("Произошла ошибка сбора данных. Попробуйте /register_driver снова.")
         context.user_data.clear()
         return ConversationHandler.END
 
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
-    if not db_user: return ConversationHandler.END # Не должно произойти, но на всякий случай
-
     try:
-        # Проверяем уникальность номера авто перед созданием профиля
-        existing_profile_plate = db.query(crud.models.DriverProfile).filter(crud.models.DriverProfile.car_plate == car_plate_processed).first()
-        if existing_profile_plate:
-             await update.message.reply_text(f"Автомобиль с номером {car_plate_processed} уже зарегистрирован в системе.")
-             # Не завершаем диалог, даем шанс ввести другой номер? Или отмена?
-             return ASK_CAR_PLATE # Возвращаемся к вводу номера
-
-        profile = crud.create_driver_profile(
-            db,
-            user_id=db_user.id,
-            car_make=car_make,
-            car_model=car_model,
-            car_color=car_color,
-            car_plate=car_plate_processed
-        )
-        # crud.create_driver_profile также меняет роль пользователя на ROLE_DRIVER
-        logger.info(f"Пользователь {user.id} успешно зарегистрирован как водитель. Профиль: {profile}")
-        context.user_data.clear() # Очищаем временные данные
-
-        await update.message.reply_text(
-            "✅ Вы успешно зарегистрированы как водитель!\n"
-            f" FONT="monospace"> Авто: {profile.car_make} {profile.car_model}, {profile.car_color}, {profile.car_plate}"
-        )
-        await driver_menu(update, context) # Показываем меню водителя
-        return ConversationHandler.END
-
+        async with async_session_scope(user.id) as db:
+            db_user = await async_crud.get_user_profile(db, user.id)
+            if not db_user: return ConversationHandler.END # Не должно произойти, но на всякий случай
+
+            # Проверяем уникальность номера авто перед созданием профиля
+            profile = None
+            if not await async_crud.is_car_plate_taken(db, car_plate_processed):
+                profile = await async_crud.create_driver_profile(
+                    db,
+                    user_id=db_user.id,
+                    car_make=car_make,
+                    car_model=car_model,
+                    car_color=car_color,
+                    car_plate=car_plate_processed
+                )
+                # crud.create_driver_profile также меняет роль пользователя на ROLE_DRIVER
+                logger.info("Пользователь %s зарегистрирован как водитель. Профиль: %s", user.id, profile)
+                car_info = f"{profile.car_make} {profile.car_model}, {profile.car_color}, {profile.car_plate}"
     except Exception as e:
-        logger.error(f"Ошибка при создании профиля водителя для {user.id}: {e}")
+        logger.error("Ошибка при создании профиля водителя для %s: %s", user.id, e)
         await update.message.reply_text("Произошла ошибка при регистрации водителя. Попробуйте позже.")
         context.user_data.clear()
         return ConversationHandler.END
 
+    if not profile:
+        await update.message.reply_text(f"Автомобиль с номером {car_plate_processed} уже зарегистрирован в системе.")
+        # Не завершаем диалог, даем шанс ввести другой номер? Или отмена?
+        return ASK_CAR_PLATE # Возвращаемся к вводу номера
+
+    context.user_data.clear() # Очищаем временные данные
+    await update.message.reply_text(
+        "✅ Вы успешно зарегистрированы как водитель!\n"
+        f"🚗 Авто: {car_info}"
+    )
+    await driver_menu(update, context) # Показываем меню водителя
+    return ConversationHandler.END
+
 # --- Создание поездки ---
 
 async def create_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог создания поездки: город отправления."""
     user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
     if not is_driver(db_user) or db_user.is_blocked:
         await update.message.reply_text("Доступ запрещен.")
         return ConversationHandler.END
 
-    logger.info(f"Водитель {user.id} начал создание поездки.")
-    await update.message.reply_text(" FONT="monospace"> Введите город отправления:", reply_markup=reply_kb.markup_cancel)
+    logger.info("Водитель %s начал создание поездки.", user.id)
+    await update.message.reply_text("📍 Введите город отправления:", reply_markup=reply_kb.markup_cancel)
     return ASK_TRIP_DEPARTURE_CITY
 
 async def ask_trip_departure_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает город отправления, спрашивает город прибытия."""
     city = update.message.text
     if not city or len(city) < 2: return ASK_TRIP_DEPARTURE_CITY # Повторный запрос
-    context.user_data['trip_departure_city'] = city.strip()
-    await update.message.reply_text(" FONT="monospace"> Введите город прибытия:", reply_markup=reply_kb.markup_cancel)
+    city = await resolve_city_input(update, context, 'tdep')
+    if city is None: return ASK_TRIP_DEPARTURE_CITY # Ждем выбора из подсказок
+    return await _save_trip_departure_city(update, context, city)
+
+async def trip_departure_city_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает город отправления, выбранный из подсказок."""
+    city = await city_choice_from_callback(update, context)
+    if city is None: return ASK_TRIP_DEPARTURE_CITY
+    return await _save_trip_departure_city(update, context, city)
+
+async def _save_trip_departure_city(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str) -> int:
+    context.user_data['trip_departure_city'] = city
+    await update.effective_message.reply_text("🏁 Введите город прибытия:", reply_markup=reply_kb.markup_cancel)
     return ASK_TRIP_ARRIVAL_CITY
 
 async def ask_trip_arrival_city_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Получает город прибытия, спрашивает дату/время отправления."""
     city = update.message.text
     if not city or len(city) < 2: return ASK_TRIP_ARRIVAL_CITY
-    context.user_data['trip_arrival_city'] = city.strip()
-    await update.message.reply_text(
-        " FONT="monospace"> Введите дату и время отправления (ДД.ММ ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ):",
+    city = await resolve_city_input(update, context, 'tarr')
+    if city is None: return ASK_TRIP_ARRIVAL_CITY # Ждем выбора из подсказок
+    return await _save_trip_arrival_city(update, context, city)
+
+async def trip_arrival_city_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает город прибытия, выбранный из подсказок."""
+    city = await city_choice_from_callback(update, context)
+    if city is None: return ASK_TRIP_ARRIVAL_CITY
+    return await _save_trip_arrival_city(update, context, city)
+
+async def _save_trip_arrival_city(update: Update, context: ContextTypes.DEFAULT_TYPE, city: str) -> int:
+    context.user_data['trip_arrival_city'] = city
+    await update.effective_message.reply_text(
+        "📅 Введите дату и время отправления (ДД.ММ ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ):",
         reply_markup=reply_kb.markup_cancel
     )
     return ASK_TRIP_DEPARTURE_DATETIME
@@ -182,7 +208,7 @@ async def ask_trip_departure_datetime_handler(update: Update, context: ContextTy
         return ASK_TRIP_DEPARTURE_DATETIME
     context.user_data['trip_departure_datetime'] = dep_dt
     await update.message.reply_text(
-        " FONT="monospace"> Введите примерное время прибытия (ДД.ММ ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ):",
+        "🕒 Введите примерное время прибытия (ДД.ММ ЧЧ:ММ или ДД.ММ.ГГГГ ЧЧ:ММ):",
         reply_markup=reply_kb.markup_cancel
     )
     return ASK_TRIP_ARRIVAL_DATETIME
@@ -200,7 +226,7 @@ async def ask_trip_arrival_datetime_handler(update: Update, context: ContextType
         )
         return ASK_TRIP_ARRIVAL_DATETIME
     context.user_data['trip_arrival_datetime'] = arr_dt
-    await update.message.reply_text(" FONT="monospace"> Введите количество доступных мест для пассажиров:", reply_markup=reply_kb.markup_cancel)
+    await update.message.reply_text("💺 Введите количество доступных мест для пассажиров:", reply_markup=reply_kb.markup_cancel)
     return ASK_TRIP_SEATS
 
 async def ask_trip_seats_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -222,64 +248,70 @@ async def ask_trip_seats_handler(update: Update, context: ContextTypes.DEFAULT_T
     arr_dt = context.user_data.get('trip_arrival_datetime')
 
     if not all([dep_city, arr_city, dep_dt, arr_dt]):
-        logger.error(f"Отсутствуют данные о поездке в context.user_data у водителя {user.id}")
+        logger.error("Отсутствуют данные о поездке в context.user_data у водителя %s", user.id)
         await update.message.reply_text("Произошла ошибка сбора данных. Попробуйте /create_trip снова.")
         context.user_data.clear()
         return ConversationHandler.END
 
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
-    if not db_user: return ConversationHandler.END
-
     try:
-        trip = crud.create_trip(
-            db,
-            driver_id=db_user.id,
-            departure_city=dep_city,
-            arrival_city=arr_city,
-            departure_datetime=dep_dt,
-            estimated_arrival_datetime=arr_dt,
-            total_seats=seats
-        )
-        logger.info(f"Водитель {user.id} создал поездку: {trip}")
-        context.user_data.clear()
-
-        await update.message.reply_text(
-            f"✅ Поездка успешно создана!\n\n{format_trip_details(trip)}"
-        )
-        await driver_menu(update, context) # Показываем меню водителя
-        return ConversationHandler.END
-
+        async with async_session_scope(user.id) as db:
+            db_user = await async_crud.get_user_profile(db, user.id)
+            if not db_user: return ConversationHandler.END
+
+            trip = await async_crud.create_trip(
+                db,
+                driver_id=db_user.id,
+                departure_city=dep_city,
+                arrival_city=arr_city,
+                departure_datetime=dep_dt,
+                estimated_arrival_datetime=arr_dt,
+                total_seats=seats
+            )
+            # Карточке нужны водитель и его профиль: загружаем их явно, ленивая загрузка в async недоступна
+            trip = await async_crud.get_trip_by_id(db, trip.id, load=crud.LOAD_TRIP_CARD)
+            trip_card = format_trip_details(trip)
     except Exception as e:
-        logger.error(f"Ошибка при создании поездки водителем {user.id}: {e}")
+        logger.error("Ошибка при создании поездки водителем %s: %s", user.id, e)
         await update.message.reply_text("Произошла ошибка при создании поездки. Попробуйте позже.")
         context.user_data.clear()
         return ConversationHandler.END
 
+    logger.info("Водитель %s создал поездку: %s", user.id, trip)
+    context.user_data.clear()
+    # Новые населенные пункты сразу попадают в справочник и подсказки
+    city_index.add(trip.departure_city)
+    city_index.add(trip.arrival_city)
+
+    await update.message.reply_text(f"✅ Поездка успешно создана!\n\n{trip_card}")
+    await driver_menu(update, context) # Показываем меню водителя
+    return ConversationHandler.END
+
 
 # --- Мои поездки (водителя) ---
 
 async def my_trips_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает активные/запланированные поездки водителя."""
     user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
+        cards = []
+        if is_driver(db_user) and not db_user.is_blocked:
+            trips = await async_crud.get_driver_trips(db, db_user.id, active_only=True, load=crud.LOAD_TRIP_CARD)
+            cards = [(format_trip_details(trip), trip.id) for trip in trips]
 
     if not is_driver(db_user) or db_user.is_blocked:
         await update.message.reply_text("Доступ запрещен.")
         return
 
-    trips = crud.get_driver_trips(db, db_user.id, active_only=True)
-
-    if not trips:
+    if not cards:
         await update.message.reply_text("У вас нет запланированных или активных поездок.")
     else:
         await update.message.reply_text("Ваши поездки:")
-        for trip in trips:
+        for card, trip_id in cards:
             # Отправляем каждую поездку с кнопками управления
             await update.message.reply_text(
-                format_trip_details(trip),
-                reply_markup=inline_kb.trip_management_keyboard(trip.id)
+                card,
+                reply_markup=inline_kb.trip_management_keyboard(trip_id)
             )
 
 async def cancel_trip_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -293,57 +325,47 @@ async def cancel_trip_callback(update: Update, context: ContextTypes.DEFAULT_TYP
     try:
         trip_id = int(callback_data.split("_")[-1])
     except (IndexError, ValueError):
-        logger.error(f"Некорректный callback_data для отмены поездки: {callback_data}")
+        logger.error("Некорректный callback_data для отмены поездки: %s", callback_data)
         await query.edit_message_text("Произошла ошибка.")
         return
 
     user = query.from_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
-
-    trip_to_cancel = db.query(crud.models.Trip).filter(
-        crud.models.Trip.id == trip_id,
-        crud.models.Trip.driver_id == db_user.id # Убеждаемся, что водитель отменяет свою поездку
-    ).first()
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
+
+        # Убеждаемся, что водитель отменяет свою поездку
+        trip_to_cancel = db_user and await async_crud.get_driver_trip(db, trip_id, db_user.id)
+        trip_status = trip_to_cancel.status if trip_to_cancel else None
+
+        cancellation = None
+        if trip_status in ['scheduled', 'active']: # Отменять можно только запланированные или активные
+            # Поездка, ее брони и уведомления пассажирам (outbox) - одна транзакция с set-based UPDATE
+            def notify_passengers(cancellation):
+                trip = cancellation.trip
+                return [crud.OutboxItem(
+                    booking.passenger_telegram_id,
+                    f"⚠️ Внимание! Поездка отменена водителем.\n"
+                    f"📍 Маршрут: {trip.departure_city} -> {trip.arrival_city}\n"
+                    f"🕒 Отправление: {trip.departure_datetime.strftime('%d.%m %H:%M')}\n"
+                    f"❌ Ваше бронирование #{booking.booking_id} было отменено.",
+                    f"booking:{booking.booking_id}:cancelled"
+                ) for booking in cancellation.bookings]
+            cancellation = await async_crud.cancel_trip_with_bookings(db, trip_id, driver_id=db_user.id, notify=notify_passengers)
 
     if not trip_to_cancel:
         await query.edit_message_text("Не удалось найти эту поездку или она вам не принадлежит.")
         return
-    if trip_to_cancel.status not in ['scheduled', 'active']: # Отменять можно только запланированные или активные
-        await query.edit_message_text(f"Эту поездку нельзя отменить (статус: {trip_to_cancel.status}).")
+    if trip_status not in ['scheduled', 'active']:
+        await query.edit_message_text(f"Эту поездку нельзя отменить (статус: {trip_status}).")
         return
 
-    # Получаем список пассажиров до отмены
-    passenger_bookings = db.query(crud.models.Booking).filter(
-        crud.models.Booking.trip_id == trip_id,
-        crud.models.Booking.status == 'confirmed'
-    ).all()
-
-    # Меняем статус поездки
-    updated_trip = crud.update_trip_status(db, trip_id, 'cancelled')
-
-    if updated_trip:
-        logger.info(f"Водитель {user.id} отменил поездку {trip_id}")
+    if cancellation:
+        outbox_sender.wake()
+        logger.info("Водитель %s отменил поездку %s, уведомляются пассажиры: %s",
+                    user.id, trip_id, [booking.passenger_id for booking in cancellation.bookings])
         await query.edit_message_text("✅ Поездка успешно отменена.")
-
-        # Отменяем брони и уведомляем пассажиров
-        for booking in passenger_bookings:
-            cancelled_booking = crud.cancel_booking(db, booking.id, cancelled_by="driver")
-            if cancelled_booking and cancelled_booking.passenger:
-                try:
-                    passenger_tg_id = cancelled_booking.passenger.telegram_id
-                    await context.bot.send_message(
-                        chat_id=passenger_tg_id,
-                        text=(f" FONT="monospace"> Внимание! Поездка отменена водителем.\n"
-                              f" FONT="monospace"> Маршрут: {trip_to_cancel.departure_city} -> {trip_to_cancel.arrival_city}\n"
-                              f" FONT="monospace"> Отправление: {trip_to_cancel.departure_datetime.strftime('%d.%m %H:%M')}\n"
-                              f" FONT="monospace"> Ваше бронирование #{booking.id} было отменено.")
-                    )
-                    logger.info(f"Уведомление об отмене поездки {trip_id} отправлено пассажиру {passenger_tg_id}")
-                except Exception as e:
-                    logger.error(f"Не удалось уведомить пассажира {cancelled_booking.passenger_id} об отмене поездки {trip_id}: {e}")
     else:
-        logger.error(f"Ошибка при отмене поездки {trip_id} водителем {user.id}")
+        logger.error("Ошибка при отмене поездки %s водителем %s", trip_id, user.id)
         await query.edit_message_text("Не удалось отменить поездку. Попробуйте позже.")
 
 
@@ -360,6 +382,7 @@ register_driver_conv_handler = ConversationHandler(
         ASK_CAR_PLATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_car_plate_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="register_driver_conversation", persistent=True,
 )
 
 create_trip_conv_handler = ConversationHandler(
@@ -368,13 +391,20 @@ create_trip_conv_handler = ConversationHandler(
         MessageHandler(filters.Regex('^➕ Создать поездку$'), create_trip_start),
     ],
     states={
-        ASK_TRIP_DEPARTURE_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_departure_city_handler)],
-        ASK_TRIP_ARRIVAL_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_arrival_city_handler)],
+        ASK_TRIP_DEPARTURE_CITY: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_departure_city_handler),
+            CallbackQueryHandler(trip_departure_city_callback, pattern='^city_tdep_'),
+        ],
+        ASK_TRIP_ARRIVAL_CITY: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_arrival_city_handler),
+            CallbackQueryHandler(trip_arrival_city_callback, pattern='^city_tarr_'),
+        ],
         ASK_TRIP_DEPARTURE_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_departure_datetime_handler)],
         ASK_TRIP_ARRIVAL_DATETIME: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_arrival_datetime_handler)],
         ASK_TRIP_SEATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_seats_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="create_trip_conversation", persistent=True,
 )
 
 # --- Общий список хендлеров водителя ---
@@ -382,7 +412,7 @@ driver_handlers = [
     register_driver_conv_handler,
     create_trip_conv_handler,
     CommandHandler('my_trips', my_trips_command),
-    MessageHandler(filters.Regex('^ FONT="monospace"> Мои поездки$'), my_trips_command),
+    MessageHandler(filters.Regex('^🚕 Мои поездки$'), my_trips_command),
     CallbackQueryHandler(cancel_trip_callback, pattern='^cancel_trip_'),
     # Добавить обработчики для других кнопок/действий водителя
 ]
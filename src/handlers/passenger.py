@@ -5,39 +5,39 @@ from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import (ContextTypes, ConversationHandler, CommandHandler, MessageHandler,
                           CallbackQueryHandler, filters)
 
-from src.database import crud
-from src.database.database import get_db
-from src.config import (logger, ROLE_PASSENGER, ASK_DEPARTURE_CITY, ASK_ARRIVAL_CITY, ASK_TRIP_DATE)
+from src.database import crud, async_crud
+from src.database.async_database import async_session_scope
+from src.config import (ROLE_PASSENGER, ASK_DEPARTURE_CITY, ASK_ARRIVAL_CITY, ASK_TRIP_DATE)
 from src.keyboards import reply as reply_kb
 from src.keyboards import inline as inline_kb
-from src.utils.helpers import format_trip_details, parse_date, format_booking_details
-from .common import cancel # Для fallback
+from src.utils.helpers import format_trip_details, parse_date, format_booking_details, parse_trip_cursor
+from src.utils.outbox import outbox_sender
+from .common import cancel, resolve_city_input, city_choice_from_callback # cancel - для fallback
+
+logger = logging.getLogger(__name__)
 
 async def passenger_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает главное меню пассажира."""
-    user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
     markup = reply_kb.markup_passenger_main
     # Проверяем, есть ли у него профиль водителя, чтобы не показывать кнопку "Стать водителем"
     # Это требует доработки crud и models или отдельной проверки
     # if db_user and crud.get_driver_profile(db, db_user.id):
     #     markup = ... # Клавиатура без кнопки "Стать водителем"
 
-    await update.message.reply_text(" FONT="monospace"> Панель пассажира:", reply_markup=markup)
+    await update.message.reply_text("🧳 Панель пассажира:", reply_markup=markup)
 
 # --- Поиск поездки ---
 
 async def find_trip_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог поиска поездки: спрашивает город отправления."""
     user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
     if not db_user or db_user.is_blocked: return ConversationHandler.END
 
-    logger.info(f"Пассажир {user.id} начал поиск поездки.")
+    logger.info("Пассажир %s начал поиск поездки.", user.id)
     await update.message.reply_text(
-        " FONT="monospace"> Введите город отправления:",
+        "📍 Введите город отправления:",
         reply_markup=reply_kb.markup_cancel # Добавляем кнопку отмены
     )
     return ASK_DEPARTURE_CITY
@@ -49,10 +49,23 @@ async def ask_departure_city_handler(update: Update, context: ContextTypes.DEFAU
         await update.message.reply_text("Введите корректное название города отправления.")
         return ASK_DEPARTURE_CITY
 
-    context.user_data['departure_city'] = departure_city.strip()
-    logger.info(f"Поиск поездки: город отправления '{departure_city}' от {update.effective_user.id}")
-    await update.message.reply_text(
-        " FONT="monospace"> Введите город прибытия:",
+    departure_city = await resolve_city_input(update, context, 'dep')
+    if departure_city is None:
+        return ASK_DEPARTURE_CITY # Ждем выбора из подсказок
+    return await _save_departure_city(update, context, departure_city)
+
+async def departure_city_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает город отправления, выбранный из подсказок."""
+    departure_city = await city_choice_from_callback(update, context)
+    if departure_city is None:
+        return ASK_DEPARTURE_CITY
+    return await _save_departure_city(update, context, departure_city)
+
+async def _save_departure_city(update: Update, context: ContextTypes.DEFAULT_TYPE, departure_city: str) -> int:
+    context.user_data['departure_city'] = departure_city
+    logger.info("Поиск поездки: город отправления '%s' от %s", departure_city, update.effective_user.id)
+    await update.effective_message.reply_text(
+        "🏁 Введите город прибытия:",
         reply_markup=reply_kb.markup_cancel
     )
     return ASK_ARRIVAL_CITY
@@ -64,10 +77,23 @@ async def ask_arrival_city_handler(update: Update, context: ContextTypes.DEFAULT
         await update.message.reply_text("Введите корректное название города прибытия.")
         return ASK_ARRIVAL_CITY
 
-    context.user_data['arrival_city'] = arrival_city.strip()
-    logger.info(f"Поиск поездки: город прибытия '{arrival_city}' от {update.effective_user.id}")
-    await update.message.reply_text(
-        " FONT="monospace"> Введите дату поездки (например, 25.12 или 25.12.2024):",
+    arrival_city = await resolve_city_input(update, context, 'arr')
+    if arrival_city is None:
+        return ASK_ARRIVAL_CITY # Ждем выбора из подсказок
+    return await _save_arrival_city(update, context, arrival_city)
+
+async def arrival_city_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
+    """Получает город прибытия, выбранный из подсказок."""
+    arrival_city = await city_choice_from_callback(update, context)
+    if arrival_city is None:
+        return ASK_ARRIVAL_CITY
+    return await _save_arrival_city(update, context, arrival_city)
+
+async def _save_arrival_city(update: Update, context: ContextTypes.DEFAULT_TYPE, arrival_city: str) -> int:
+    context.user_data['arrival_city'] = arrival_city
+    logger.info("Поиск поездки: город прибытия '%s' от %s", arrival_city, update.effective_user.id)
+    await update.effective_message.reply_text(
+        "📅 Введите дату поездки (например, 25.12 или 25.12.2024):",
         reply_markup=reply_kb.markup_cancel
     )
     return ASK_TRIP_DATE
@@ -88,36 +114,63 @@ async def ask_trip_date_handler(update: Update, context: ContextTypes.DEFAULT_TY
     arrival_city = context.user_data.get('arrival_city')
 
     if not departure_city or not arrival_city:
-        logger.error(f"Отсутствуют города в context.user_data для поиска у {update.effective_user.id}")
+        logger.error("Отсутствуют города в context.user_data для поиска у %s", update.effective_user.id)
         await update.message.reply_text("Произошла ошибка. Попробуйте начать поиск сначала /find_trip")
         context.user_data.pop('departure_city', None)
         context.user_data.pop('arrival_city', None)
         return ConversationHandler.END
 
-    logger.info(f"Ищем поездки: {departure_city} -> {arrival_city} на {trip_date.strftime('%d.%m.%Y')}")
+    logger.info("Ищем поездки: %s -> %s на %s", departure_city, arrival_city, trip_date)
 
-    db = next(get_db())
-    trips = crud.find_trips(db, departure_city, arrival_city, trip_date)
+    async with async_session_scope(update.effective_user.id) as db:
+        page = await async_crud.find_trips_page(db, departure_city, arrival_city, trip_date)
 
-    if not trips:
+    if not page.trips:
         await update.message.reply_text(
-            f" FONT="monospace"> На {trip_date.strftime('%d.%m.%Y')} поездок по маршруту\n"
-            f" FONT="monospace"> {departure_city} -> {arrival_city}\n"
-            f" FONT="monospace"> не найдено.",
+            f"😔 На {trip_date.strftime('%d.%m.%Y')} поездок по маршруту\n"
+            f"📍 {departure_city} -> {arrival_city}\n"
+            f"❌ не найдено.",
             reply_markup=reply_kb.markup_passenger_main # Возвращаем основную клавиатуру
         )
     else:
         await update.message.reply_text(
-            f" FONT="monospace"> Найденные поездки на {trip_date.strftime('%d.%m.%Y')}\n"
-            f" FONT="monospace"> {departure_city} -> {arrival_city}:",
-            reply_markup=inline_kb.trips_keyboard(trips)
+            f"🔎 Найденные поездки на {trip_date.strftime('%d.%m.%Y')}\n"
+            f"📍 {departure_city} -> {arrival_city}:",
+            reply_markup=inline_kb.trips_page_keyboard(page)
         )
+        # Параметры поиска нужны для листания страниц после завершения диалога
+        context.user_data['trip_search'] = {
+            'departure_city': departure_city, 'arrival_city': arrival_city, 'trip_date': trip_date
+        }
 
     # Очищаем данные поиска из user_data
     context.user_data.pop('departure_city', None)
     context.user_data.pop('arrival_city', None)
     return ConversationHandler.END # Завершаем диалог поиска
 
+async def trips_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Листает результаты поиска (кнопки "Назад"/"Далее")."""
+    query = update.callback_query
+    await query.answer()
+
+    _, direction, cursor_str = query.data.split("_", 2)
+    cursor = parse_trip_cursor(cursor_str)
+    search = context.user_data.get('trip_search')
+    # Курсор относится к другому поиску (или бот перезапускался) - листать нечего
+    if cursor is None or not search or cursor[0].date() != search['trip_date']:
+        await query.edit_message_text("Результаты поиска устарели. Начните поиск заново: /find_trip")
+        return
+
+    cursor_arg = {'after': cursor} if direction == "next" else {'before': cursor}
+    async with async_session_scope(update.effective_user.id) as db:
+        page = await async_crud.find_trips_page(
+            db, search['departure_city'], search['arrival_city'], search['trip_date'], **cursor_arg
+        )
+        if not page.trips:
+            # Поездки страницы успели разобрать или отменить - начинаем с первой страницы
+            page = await async_crud.find_trips_page(db, search['departure_city'], search['arrival_city'], search['trip_date'])
+    await query.edit_message_reply_markup(reply_markup=inline_kb.trips_page_keyboard(page))
+
 # --- Бронирование поездки ---
 
 async def book_trip_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -132,80 +185,86 @@ async def book_trip_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     try:
         trip_id = int(callback_data.split("_")[1])
     except (IndexError, ValueError):
-        logger.error(f"Некорректный callback_data для бронирования: {callback_data}")
+        logger.error("Некорректный callback_data для бронирования: %s", callback_data)
         await query.edit_message_text("Произошла ошибка.")
         return
 
     user_tg_id = query.from_user.id
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user_tg_id)
+    # Бронь и текст ответа - в одной транзакции; ответ отправляется после коммита
+    async with async_session_scope(user_tg_id) as db:
+        db_user = await async_crud.get_user_profile(db, user_tg_id)
+        booking = None
+        if db_user and not db_user.is_blocked:
+            # Уведомление водителю - в outbox, в той же транзакции
+            def notify_driver(booking):
+                trip = booking.trip
+                return [crud.OutboxItem(
+                    trip.driver.telegram_id,
+                    f"🔔 Новое бронирование!\n"
+                    f"👤 Пассажир: {db_user.full_name}\n"
+                    f"🚗 Поездка: {trip.departure_city} -> {trip.arrival_city} ({trip.departure_datetime.strftime('%d.%m %H:%M')})\n"
+                    f"💺 Свободно мест: {trip.available_seats}",
+                    f"booking:{booking.id}:confirmed"
+                )]
+            booking = await async_crud.create_booking(db, passenger_id=db_user.id, trip_id=trip_id, seats=1, notify=notify_driver) # Бронируем 1 место
+            if booking:
+                # Карточке нужны водитель и его профиль: загружаем их явно, ленивая загрузка в async недоступна
+                trip = await async_crud.get_trip_by_id(db, trip_id, load=crud.LOAD_TRIP_CARD)
+                reply_text = f"✅ Вы успешно забронировали место!\n\n{format_trip_details(trip)}"
+            else:
+                reply_text = await db.run_sync(_booking_error_message, db_user.id, trip_id)
 
     if not db_user or db_user.is_blocked:
         await query.edit_message_text("Не удалось выполнить бронирование (ошибка пользователя).")
         return
 
-    # Попытка создать бронирование
-    booking = crud.create_booking(db, passenger_id=db_user.id, trip_id=trip_id, seats=1) # Бронируем 1 место
-
     if booking:
-        logger.info(f"Пассажир {user_tg_id} успешно забронировал место на поездку {trip_id}")
-        trip = booking.trip # Получаем обновленную поездку из бронирования
-        await query.edit_message_text(
-            f"✅ Вы успешно забронировали место!\n\n{format_trip_details(trip)}"
-            # Можно добавить клавиатуру для управления бронью
-        )
-        # Уведомляем водителя (если нужно)
-        try:
-            driver_tg_id = trip.driver.telegram_id
-            await context.bot.send_message(
-                chat_id=driver_tg_id,
-                text=(f" FONT="monospace"> Новое бронирование!\n"
-                      f" FONT="monospace"> Пассажир: {db_user.full_name}\n"
-                      f" FONT="monospace"> Поездка: {trip.departure_city} -> {trip.arrival_city} ({trip.departure_datetime.strftime('%d.%m %H:%M')})\n"
-                      f" FONT="monospace"> Свободно мест: {trip.available_seats}")
-            )
-            logger.info(f"Уведомление о бронировании отправлено водителю {driver_tg_id}")
-        except Exception as e:
-            logger.error(f"Не удалось уведомить водителя {trip.driver_id} о бронировании: {e}")
+        outbox_sender.wake()
+        logger.info("Пассажир %s успешно забронировал место на поездку %s", user_tg_id, trip_id)
     else:
-        # Обработка ошибок бронирования (мест нет, поездка отменена и т.д.)
-        # crud.create_booking вернет None в случае неудачи
-        db_trip = crud.get_trip_by_id(db, trip_id) # Проверим причину
-        error_message = "Не удалось забронировать место."
-        if db_trip and db_trip.available_seats <= 0:
-            error_message = " FONT="monospace"> К сожалению, все места на эту поездку уже заняты."
-        elif db_trip and db_trip.status != 'scheduled':
-             error_message = f" FONT="monospace"> Бронирование на эту поездку больше недоступно (статус: {db_trip.status})."
-        elif crud.get_user_bookings(db, db_user.id, active_only=False): # Проверим, не бронировал ли уже
-            if any(b.trip_id == trip_id and b.status=='confirmed' for b in crud.get_user_bookings(db, db_user.id, active_only=False)):
-                 error_message = " FONT="monospace"> Вы уже забронировали место на эту поездку."
-
-        logger.warning(f"Неудачная попытка бронирования поездки {trip_id} пассажиром {user_tg_id}")
-        await query.edit_message_text(error_message)
+        logger.warning("Неудачная попытка бронирования поездки %s пассажиром %s", trip_id, user_tg_id)
+    await query.edit_message_text(reply_text)
+
+def _booking_error_message(db, passenger_id: int, trip_id: int) -> str:
+    """Причина неудачного бронирования (мест нет, поездка отменена и т.д.) для ответа пассажиру.
+
+    Синхронная: вызывается через AsyncSession.run_sync.
+    """
+    db_trip = crud.get_trip_by_id(db, trip_id)
+    if db_trip and db_trip.available_seats <= 0:
+        return "😔 К сожалению, все места на эту поездку уже заняты."
+    if db_trip and db_trip.status != 'scheduled':
+        return f"⛔ Бронирование на эту поездку больше недоступно (статус: {db_trip.status})."
+    # Проверим, не бронировал ли уже
+    if any(b.trip_id == trip_id and b.status == 'confirmed' for b in crud.get_user_bookings(db, passenger_id, active_only=False)):
+        return "ℹ️ Вы уже забронировали место на эту поездку."
+    return "Не удалось забронировать место."
 
 # --- Мои бронирования ---
 
 async def my_bookings_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает активные бронирования пользователя."""
     user_tg = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user_tg.id)
+    async with async_session_scope(user_tg.id) as db:
+        db_user = await async_crud.get_user_profile(db, user_tg.id)
+        cards = []
+        if db_user and not db_user.is_blocked:
+            bookings = await async_crud.get_user_bookings(db, db_user.id, active_only=True, load=crud.LOAD_BOOKING_CARD)
+            cards = [(format_booking_details(booking), booking.id) for booking in bookings]
 
     if not db_user or db_user.is_blocked:
         await update.message.reply_text("Ошибка доступа.")
         return
 
-    bookings = crud.get_user_bookings(db, db_user.id, active_only=True)
-
-    if not bookings:
+    if not cards:
         await update.message.reply_text("У вас нет активных бронирований.")
     else:
         await update.message.reply_text("Ваши активные бронирования:")
-        for booking in bookings:
+        for card, booking_id in cards:
             # Отправляем каждое бронирование отдельным сообщением с кнопкой отмены
             await update.message.reply_text(
-                format_booking_details(booking),
-                reply_markup=inline_kb.booking_management_keyboard(booking.id)
+                card,
+                reply_markup=inline_kb.booking_management_keyboard(booking_id)
             )
 
 async def cancel_booking_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -220,46 +279,46 @@ async def cancel_booking_callback(update: Update, context: ContextTypes.DEFAULT_
     try:
         booking_id = int(callback_data.split("_")[-1])
     except (IndexError, ValueError):
-        logger.error(f"Некорректный callback_data для отмены бронирования: {callback_data}")
+        logger.error("Некорректный callback_data для отмены бронирования: %s", callback_data)
         await query.edit_message_text("Произошла ошибка.")
         return
 
     user_tg_id = query.from_user.id
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user_tg_id)
-
-    # Проверяем, что пользователь отменяет свою бронь
-    booking_to_cancel = db.query(crud.models.Booking).filter(
-        crud.models.Booking.id == booking_id,
-        crud.models.Booking.passenger_id == db_user.id
-    ).first()
+    async with async_session_scope(user_tg_id) as db:
+        db_user = await async_crud.get_user_profile(db, user_tg_id)
+
+        # Проверяем, что пользователь отменяет свою бронь
+        booking_to_cancel = db_user and await async_crud.get_passenger_booking(db, booking_id, db_user.id)
+
+        booking_active = bool(booking_to_cancel) and booking_to_cancel.status == 'confirmed'
+        cancelled_booking = None
+        if booking_active:
+            # Уведомление водителю об отмене - в outbox, в той же транзакции
+            def notify_driver(booking):
+                trip = booking.trip
+                return [crud.OutboxItem(
+                    trip.driver.telegram_id,
+                    f"🔔 Отмена бронирования!\n"
+                    f"👤 Пассажир: {db_user.full_name}\n"
+                    f"🚗 Поездка: {trip.departure_city} -> {trip.arrival_city} ({trip.departure_datetime.strftime('%d.%m %H:%M')})\n"
+                    f"💺 Места возвращены. Свободно: {trip.available_seats}",
+                    f"booking:{booking.id}:cancelled"
+                )]
+            cancelled_booking = await async_crud.cancel_booking(db, booking_id=booking_id, cancelled_by="passenger", notify=notify_driver)
 
     if not booking_to_cancel:
         await query.edit_message_text("Не удалось найти это бронирование или оно принадлежит не вам.")
         return
-    if booking_to_cancel.status != 'confirmed':
+    if not booking_active:
          await query.edit_message_text("Это бронирование уже неактивно.")
          return
 
-    cancelled_booking = crud.cancel_booking(db, booking_id=booking_id, cancelled_by="passenger")
-
     if cancelled_booking:
-        logger.info(f"Пассажир {user_tg_id} отменил бронирование {booking_id}")
+        outbox_sender.wake()
+        logger.info("Пассажир %s отменил бронирование %s", user_tg_id, booking_id)
         await query.edit_message_text("✅ Бронирование успешно отменено.")
-        # Уведомить водителя об отмене? (опционально)
-        try:
-             driver_tg_id = cancelled_booking.trip.driver.telegram_id
-             await context.bot.send_message(
-                  chat_id=driver_tg_id,
-                  text=(f" FONT="monospace"> Отмена бронирования!\n"
-                      f" FONT="monospace"> Пассажир: {db_user.full_name}\n"
-                      f" FONT="monospace"> Поездка: {cancelled_booking.trip.departure_city} -> {cancelled_booking.trip.arrival_city} ({cancelled_booking.trip.departure_datetime.strftime('%d.%m %H:%M')})\n"
-                      f" FONT="monospace"> Места возвращены. Свободно: {cancelled_booking.trip.available_seats}")
-             )
-        except Exception as e:
-             logger.error(f"Не удалось уведомить водителя об отмене брони {booking_id}: {e}")
     else:
-        logger.error(f"Ошибка при отмене бронирования {booking_id} пассажиром {user_tg_id}")
+        logger.error("Ошибка при отмене бронирования %s пассажиром %s", booking_id, user_tg_id)
         await query.edit_message_text("Не удалось отменить бронирование. Попробуйте позже.")
 
 
@@ -270,11 +329,18 @@ find_trip_conv_handler = ConversationHandler(
         MessageHandler(filters.Regex('^🔍 Найти поездку$'), find_trip_start), # Обработка кнопки
     ],
     states={
-        ASK_DEPARTURE_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_departure_city_handler)],
-        ASK_ARRIVAL_CITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_arrival_city_handler)],
+        ASK_DEPARTURE_CITY: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, ask_departure_city_handler),
+            CallbackQueryHandler(departure_city_callback, pattern='^city_dep_'),
+        ],
+        ASK_ARRIVAL_CITY: [
+            MessageHandler(filters.TEXT & ~filters.COMMAND, ask_arrival_city_handler),
+            CallbackQueryHandler(arrival_city_callback, pattern='^city_arr_'),
+        ],
         ASK_TRIP_DATE: [MessageHandler(filters.TEXT & ~filters.COMMAND, ask_trip_date_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="find_trip_conversation", persistent=True,
 )
 
 # --- Обработчики для команд и колбэков пассажира ---
@@ -283,6 +349,7 @@ passenger_handlers = [
     CommandHandler('my_bookings', my_bookings_command),
     MessageHandler(filters.Regex('^🎫 Мои бронирования$'), my_bookings_command),
     CallbackQueryHandler(book_trip_callback, pattern='^book_'),
+    CallbackQueryHandler(trips_page_callback, pattern='^trips_(next|prev)_'),
     CallbackQueryHandler(cancel_booking_callback, pattern='^cancel_booking_'),
     # Обработчик для кнопки главного меню (если она не запускает ConversationHandler)
     # MessageHandler(filters.Regex('^Что-то еще$'), some_other_passenger_action),
@@ -3,16 +3,19 @@ import logging
 from telegram import Update, ReplyKeyboardRemove
 from telegram.ext import ContextTypes, ConversationHandler, CommandHandler, MessageHandler, filters
 
-from src.database import crud
-from src.database.database import get_db
-from src.config import logger, ADMIN_IDS, SUPPORT_MESSAGE
+from src.database import async_crud
+from src.database.async_database import async_session_scope
+from src.config import ADMIN_IDS, ROLE_DRIVER, SUPPORT_MESSAGE
+from src.utils.notifier import notifier
 from .common import cancel # Импорт cancel для fallback
 
+logger = logging.getLogger(__name__)
+
 async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает диалог поддержки."""
     user = update.effective_user
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
 
     if not db_user:
         await update.message.reply_text("Пожалуйста, сначала зарегистрируйтесь с помощью /start.")
@@ -21,10 +24,10 @@ async def support_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("Ваш аккаунт заблокирован.")
         return ConversationHandler.END
 
-    logger.info(f"Пользователь {user.id} ({db_user.full_name}) инициировал обращение в поддержку.")
+    logger.info("Пользователь %s (%s) инициировал обращение в поддержку.", user.id, db_user.full_name)
     await update.message.reply_text(
-        " FONT="monospace"> Напишите ваше сообщение для администратора. Мы передадим его вместе с вашими контактами.\n"
-        " FONT="monospace"> Для отмены введите /cancel.",
+        "✉️ Напишите ваше сообщение для администратора. Мы передадим его вместе с вашими контактами.\n"
+        "❌ Для отмены введите /cancel.",
         reply_markup=ReplyKeyboardRemove() # Или можно добавить кнопку Cancel
     )
     return SUPPORT_MESSAGE # Переходим в состояние ожидания сообщения
@@ -33,8 +36,8 @@ async def support_message_handler(update: Update, context: ContextTypes.DEFAULT_
     """Обрабатывает сообщение пользователя и пересылает админам."""
     user = update.effective_user
     message_text = update.message.text
-    db = next(get_db())
-    db_user = crud.get_user_by_telegram_id(db, user.id)
+    async with async_session_scope(user.id) as db:
+        db_user = await async_crud.get_user_profile(db, user.id)
 
     if not db_user: # Доп. проверка
         return ConversationHandler.END
@@ -42,14 +45,14 @@ async def support_message_handler(update: Update, context: ContextTypes.DEFAULT_
          await update.message.reply_text("Пожалуйста, введите текстовое сообщение.")
          return SUPPORT_MESSAGE # Остаемся в том же состоянии
 
-    logger.info(f"Получено сообщение поддержки от {user.id}: {message_text[:50]}...")
+    logger.info("Получено сообщение поддержки от %s: %s...", user.id, message_text[:50])
 
     support_header = (
-        f" FONT="monospace"> === Обращение в поддержку ===\n"
-        f" FONT="monospace"> От: {db_user.full_name} (ID: {user.id})\n"
-        f" FONT="monospace"> Телефон: {db_user.phone_number}\n"
-        f" FONT="monospace"> Telegram: @{user.username or 'нет'}\n"
-        f" FONT="monospace"> ==========================="
+        f"📩 === Обращение в поддержку ===\n"
+        f"👤 От: {db_user.full_name} (ID: {user.id})\n"
+        f"📞 Телефон: {db_user.phone_number}\n"
+        f"💬 Telegram: @{user.username or 'нет'}\n"
+        f"📩 ==========================="
     )
     full_support_message = f"{support_header}\n\n{message_text}"
 
@@ -60,17 +63,9 @@ async def support_message_handler(update: Update, context: ContextTypes.DEFAULT_
         )
         return ConversationHandler.END
 
-    message_sent_to_admin = False
-    for admin_id in ADMIN_IDS:
-        try:
-            await context.bot.send_message(
-                chat_id=admin_id,
-                text=full_support_message
-            )
-            message_sent_to_admin = True
-            logger.info(f"Сообщение поддержки от {user.id} отправлено администратору {admin_id}")
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение поддержки админу {admin_id}: {e}")
+    # Рассылка администраторам идет в фоне: пользователь не ждет отправки каждому из них
+    message_sent_to_admin = notifier.notify_many(ADMIN_IDS, full_support_message) > 0
+    logger.info("Сообщение поддержки от %s поставлено в очередь для %s администраторов", user.id, len(ADMIN_IDS))
 
     if message_sent_to_admin:
         await update.message.reply_text(
@@ -99,4 +94,5 @@ support_conv_handler = ConversationHandler(
         SUPPORT_MESSAGE: [MessageHandler(filters.TEXT & ~filters.COMMAND, support_message_handler)],
     },
     fallbacks=[CommandHandler('cancel', cancel)],
+    name="support_conversation", persistent=True,
 )
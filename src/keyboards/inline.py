@@ -1,16 +1,16 @@
 # src/keyboards/inline.py
 from telegram import InlineKeyboardMarkup, InlineKeyboardButton
 from src.database.models import Trip
+from src.database.crud import TripPage
+from src.utils.cities import City
+from src.utils.helpers import format_trip_cursor, format_trip_button
 
 # Пример клавиатуры для найденных поездок
 def trips_keyboard(trips: list[Trip]) -> InlineKeyboardMarkup:
     buttons = []
     for trip in trips:
-        # Форматируем время для отображения
-        dep_time = trip.departure_datetime.strftime("%H:%M")
-        driver_name = trip.driver.full_name.split()[0] if trip.driver and trip.driver.full_name else "Водитель"
-        # Текст кнопки: Время - Имя водителя - Места
-        button_text = f"{dep_time} - {driver_name} ({trip.available_seats} мест)"
+        # Текст кнопки: Время - Имя водителя - Места (кэшируется по версии поездки)
+        button_text = format_trip_button(trip)
         # callback_data должен содержать уникальный идентификатор поездки
         callback_data = f"book_{trip.id}"
         buttons.append([InlineKeyboardButton(button_text, callback_data=callback_data)])
@@ -20,6 +20,26 @@ def trips_keyboard(trips: list[Trip]) -> InlineKeyboardMarkup:
 
     return InlineKeyboardMarkup(buttons)
 
+# Страница результатов поиска: кнопки поездок + листание. Курсор страницы передается в callback_data,
+# параметры поиска (города, дата) хранятся в user_data.
+def trips_page_keyboard(page: TripPage) -> InlineKeyboardMarkup:
+    keyboard = list(trips_keyboard(page.trips).inline_keyboard)
+    navigation = []
+    if page.has_prev and page.first_cursor:
+        navigation.append(InlineKeyboardButton("⬅️ Назад", callback_data=f"trips_prev_{format_trip_cursor(page.first_cursor)}"))
+    if page.has_next and page.last_cursor:
+        navigation.append(InlineKeyboardButton("Далее ➡️", callback_data=f"trips_next_{format_trip_cursor(page.last_cursor)}"))
+    if navigation:
+        keyboard.append(navigation)
+    return InlineKeyboardMarkup(keyboard)
+
+# Подсказки городов: field - какое поле диалога заполняется (dep/arr - поиск, tdep/tarr - создание поездки)
+def city_suggestions_keyboard(cities: list[City], field: str, typed_text: str) -> InlineKeyboardMarkup:
+    buttons = [[InlineKeyboardButton(city.name, callback_data=f"city_{field}_{city.id}")] for city in cities]
+    # Возможность оставить введенное название (например, небольшой населенный пункт не из справочника)
+    buttons.append([InlineKeyboardButton(f"Оставить «{typed_text[:30]}»", callback_data=f"city_{field}_raw")])
+    return InlineKeyboardMarkup(buttons)
+
 # Клавиатура подтверждения (да/нет)
 def confirmation_keyboard(yes_callback: str, no_callback: str) -> InlineKeyboardMarkup:
     buttons = [
@@ -19,7 +19,7 @@ markup_passenger_main = ReplyKeyboardMarkup([
 
 # Основное меню водителя (пример)
 button_create_trip = KeyboardButton("➕ Создать поездку")
-button_my_trips = KeyboardButton(" FONT="monospace"> Мои поездки")
+button_my_trips = KeyboardButton("🚕 Мои поездки")
 markup_driver_main = ReplyKeyboardMarkup([
     [button_create_trip],
     [button_my_trips],
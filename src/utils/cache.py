@@ -0,0 +1,215 @@
+# src/utils/cache.py
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Hashable, Iterable
+
+logger = logging.getLogger(__name__)
+
+class TTLCache:
+    """LRU-кэш в памяти процесса с временем жизни записей и ограничением объема.
+
+    - maxsize: максимум записей; при переполнении вытесняется давно не использованная;
+    - ttl: время жизни записи в секундах;
+    - max_weight: ограничение суммарного "веса" (например, числа закэшированных строк),
+      вес записи считает функция weigh;
+    - теги: запись можно пометить тегами и точечно сбросить все записи с тегом;
+    - поколения: значение, прочитанное до сброса его ключа или тега, не записывается (set(since=...));
+      set(settle=...) не записывает и значение, ключ или тег которого сбрасывались за последние settle секунд.
+
+    Потокобезопасен: crud вызывается и из цикла событий, и из потоков.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, max_weight: int | None = None,
+                 weigh: Callable[[Any], int] | None = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.max_weight = max_weight
+        self._weigh = weigh or (lambda value: 1)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[Hashable, tuple[float, int, Any, tuple]] = OrderedDict() # key -> (expires, weight, value, tags)
+        self._tags: dict[Hashable, set[Hashable]] = {} # tag -> keys
+        self._weight = 0
+        # Поколение растет при каждом сбросе. Для ключей и тегов помнится поколение последнего сброса
+        # (не дольше ttl и не больше maxsize отметок); забытые отметки учитываются через _forgotten_generation
+        self._generation = 0
+        self._invalidated_at: OrderedDict[tuple, tuple[int, float]] = OrderedDict() # ("key"|"tag", x) -> (поколение, время)
+        self._forgotten_generation = 0
+        self._forgotten_at = float("-inf") # Время самой новой забытой отметки
+        self.hits = self.misses = self.evictions = self.expirations = self.invalidations = self.stale_sets = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxsize > 0 and self.ttl > 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            if entry[0] < time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[2]
+
+    def generation(self) -> int:
+        """Текущее поколение сбросов: берется до чтения значения из источника и передается в set(since=...)."""
+        with self._lock:
+            return self._generation
+
+    def set(self, key: Hashable, value: Any, tags: Iterable[Hashable] = (), since: int | None = None,
+            settle: float = 0) -> None:
+        """Записывает значение. since - поколение, взятое до чтения value: если ключ или один из тегов
+        с тех пор сбрасывался, value могло устареть, и запись пропускается. settle - то же для сбросов
+        за последние settle секунд (источник, например реплика, может отставать от сброса)."""
+        if not self.enabled:
+            return
+        weight = self._weigh(value)
+        if self.max_weight is not None and weight > self.max_weight:
+            return # Запись больше всего кэша - не кэшируем
+        tags = tuple(tags)
+        with self._lock:
+            if (since is not None or settle > 0) and self._invalidated_since(since, settle, key, tags):
+                self.stale_sets += 1
+                return
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + self.ttl, weight, value, tags)
+            self._weight += weight
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self._entries and (len(self._entries) > self.maxsize or
+                                     (self.max_weight is not None and self._weight > self.max_weight)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> None:
+        with self._lock:
+            self._mark_invalidated(("key", key))
+            if key in self._entries:
+                self._remove(key)
+                self.invalidations += 1
+
+    def invalidate_tag(self, tag: Hashable) -> int:
+        """Сбрасывает все записи с тегом. Возвращает число сброшенных записей."""
+        with self._lock:
+            self._mark_invalidated(("tag", tag))
+            keys = self._tags.get(tag, set()).copy()
+            for key in keys:
+                self._remove(key)
+            self.invalidations += len(keys)
+            return len(keys)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+            self._weight = 0
+            self._generation += 1
+            self._invalidated_at.clear()
+            self._forgotten_generation = self._generation
+            self._forgotten_at = time.monotonic()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": len(self._entries), "weight": self._weight,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "expirations": self.expirations, "invalidations": self.invalidations,
+                "stale_sets": self.stale_sets,
+            }
+
+    def _mark_invalidated(self, marker: tuple) -> None:
+        # Вызывается под self._lock
+        if not self.enabled:
+            return
+        self._generation += 1
+        now = time.monotonic()
+        self._invalidated_at.pop(marker, None)
+        self._invalidated_at[marker] = (self._generation, now)
+        while self._invalidated_at:
+            generation, invalidated_at = next(iter(self._invalidated_at.values()))
+            if invalidated_at >= now - self.ttl and len(self._invalidated_at) <= self.maxsize:
+                break
+            # Чтение, начатое раньше забытой отметки, не может доказать, что не пересеклось со сбросом
+            self._invalidated_at.popitem(last=False)
+            self._forgotten_generation = max(self._forgotten_generation, generation)
+            self._forgotten_at = max(self._forgotten_at, invalidated_at)
+
+    def _invalidated_since(self, since: int | None, settle: float, key: Hashable, tags: tuple) -> bool:
+        # Вызывается под self._lock
+        since = since if since is not None else self._generation
+        settled_after = time.monotonic() - settle if settle > 0 else float("inf")
+        if since < self._forgotten_generation or self._forgotten_at > settled_after:
+            return True
+        for marker in [("key", key)] + [("tag", tag) for tag in tags]:
+            mark = self._invalidated_at.get(marker)
+            if mark is not None and (mark[0] > since or mark[1] > settled_after):
+                return True
+        return False
+
+    def _remove(self, key: Hashable) -> None:
+        # Вызывается под self._lock
+        _, weight, _, tags = self._entries.pop(key)
+        self._weight -= weight
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+class RedisInvalidationBus:
+    """Рассылка сбросов кэша между репликами через Redis pub/sub (необязательная зависимость redis).
+
+    Каждая реплика публикует ключ, который сбросила у себя, и слушает канал в фоновом потоке,
+    сбрасывая тот же ключ в своем кэше. Если сообщение потеряется, устаревание ограничено TTL кэша.
+    Публикация тоже идет в фоновом потоке (одном, чтобы сохранить порядок сбросов): publish вызывается
+    из хуков after_commit, которые в асинхронных сессиях выполняются в цикле событий.
+    """
+
+    def __init__(self, url: str, channel: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("Для общего кэша между репликами установите пакет redis (pip install redis)") from e
+        self.channel = channel
+        self._client = redis.Redis.from_url(url)
+        self._listener = None
+        self._publisher = ThreadPoolExecutor(max_workers=1, thread_name_prefix="redis-publish")
+
+    def publish(self, key: Hashable) -> None:
+        """Ставит публикацию в очередь и сразу возвращается."""
+        try:
+            self._publisher.submit(self._publish, str(key))
+        except RuntimeError: # Шина уже закрыта (остановка бота)
+            logger.warning("Сброс кэша %s не опубликован: шина Redis закрыта", key)
+
+    def _publish(self, key: str) -> None:
+        try:
+            self._client.publish(self.channel, key)
+        except Exception as e:
+            # Недоступность Redis не должна ломать запись в БД: другие реплики догонят по TTL
+            logger.warning("Не удалось опубликовать сброс кэша %s в Redis: %s", key, e)
+
+    def listen(self, on_key: Callable[[str], None]) -> None:
+        """Запускает фоновый поток, вызывающий on_key для каждого сброса от других реплик."""
+        if self._listener is not None:
+            return
+        pubsub = self._client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{self.channel: lambda message: on_key(message["data"].decode())})
+        self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def close(self) -> None:
+        """Останавливает подписку и дожидается отправки уже поставленных публикаций."""
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        self._publisher.shutdown(wait=True)
@@ -0,0 +1,186 @@
+# src/utils/cities.py
+# Работа с названиями городов: нормализация и справочник с автодополнением.
+import bisect
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+
+CITIES_FILE = Path(__file__).with_name("cities.txt")
+
+def normalize_city(name: str) -> str:
+    """Приводит название города к ключу поиска: регистр, лишние пробелы, ё -> е.
+
+    "  Орёл " и "орел" дают один ключ "орел". Синонимы справочника ("Мск") не учитывает -
+    ключи поездок считает city_key.
+    """
+    return " ".join(name.casefold().replace("ё", "е").split())
+
+_TRANSLIT = {
+    "а": "a", "б": "b", "в": "v", "г": "g", "д": "d", "е": "e", "ж": "zh", "з": "z", "и": "i",
+    "й": "y", "к": "k", "л": "l", "м": "m", "н": "n", "о": "o", "п": "p", "р": "r", "с": "s",
+    "т": "t", "у": "u", "ф": "f", "х": "kh", "ц": "ts", "ч": "ch", "ш": "sh", "щ": "shch",
+    "ъ": "", "ы": "y", "ь": "", "э": "e", "ю": "yu", "я": "ya",
+}
+
+def transliterate(key: str) -> str:
+    """Латинская транслитерация нормализованного ключа ("москва" -> "moskva")."""
+    return "".join(_TRANSLIT.get(ch, ch) for ch in key)
+
+def _trigrams(key: str) -> set[str]:
+    padded = f"  {key} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+def _levenshtein(a: str, b: str, limit: int) -> int:
+    """Расстояние Левенштейна с отсечкой: если оно больше limit, возвращается limit + 1."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous = list(range(len(b) + 1))
+    for i, ch_a in enumerate(a, 1):
+        current = [i]
+        for j, ch_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ch_a != ch_b)))
+        if min(current) > limit:
+            return limit + 1
+        previous = current
+    return previous[-1]
+
+@dataclass(frozen=True)
+class City:
+    id: int
+    name: str # Каноническое название для показа и сохранения в trips
+
+class CityIndex:
+    """Справочник городов в памяти.
+
+    - точное совпадение (название, сокращение, латиница) - поиск в словаре;
+    - автодополнение по префиксу - двоичный поиск в отсортированном массиве ключей
+      (сортируется один раз при первом поиске после добавлений, а не при каждой вставке);
+    - нечеткий поиск - кандидаты по общим триграммам, ранжирование по расстоянию Левенштейна.
+    """
+
+    def __init__(self):
+        self._cities: list[City] = []
+        self._by_key: dict[str, int] = {} # ключ/синоним -> id города
+        self._sorted_keys: list[str] | None = None # ключи для префиксного поиска, None - пересортировать
+        self._trigrams: dict[str, set[str]] = {} # триграмма -> ключи
+
+    def __len__(self) -> int:
+        return len(self._cities)
+
+    def add(self, name: str, aliases: tuple[str, ...] = ()) -> City:
+        """Добавляет город (если он уже есть - добавляет только новые синонимы)."""
+        key = normalize_city(name)
+        city_id = self._by_key.get(key)
+        if city_id is None:
+            city_id = len(self._cities)
+            self._cities.append(City(city_id, " ".join(name.split())))
+        for variant in (name, *aliases):
+            variant_key = normalize_city(variant)
+            for k in {variant_key, transliterate(variant_key)}:
+                if k and k not in self._by_key:
+                    self._by_key[k] = city_id
+                    self._sorted_keys = None
+                    for trigram in _trigrams(k):
+                        self._trigrams.setdefault(trigram, set()).add(k)
+        return self._cities[city_id]
+
+    def get(self, city_id: int) -> City | None:
+        return self._cities[city_id] if 0 <= city_id < len(self._cities) else None
+
+    def resolve(self, text: str) -> City | None:
+        """Однозначное распознавание ввода (с учетом сокращений и латиницы)."""
+        key = normalize_city(text)
+        city_id = self._by_key.get(key)
+        if city_id is None:
+            city_id = self._by_key.get(transliterate(key))
+        return self._cities[city_id] if city_id is not None else None
+
+    def prefix(self, text: str, limit: int = 5) -> list[City]:
+        """Города, ключ которых начинается с введенного текста."""
+        key = normalize_city(text)
+        result: list[City] = []
+        if not key:
+            return result
+        sorted_keys = self._sorted_keys
+        if sorted_keys is None:
+            sorted_keys = self._sorted_keys = sorted(self._by_key)
+        start = bisect.bisect_left(sorted_keys, key)
+        for k in sorted_keys[start:]:
+            if not k.startswith(key) or len(result) >= limit:
+                break
+            city = self._cities[self._by_key[k]]
+            if city not in result:
+                result.append(city)
+        return result
+
+    def fuzzy(self, text: str, limit: int = 5) -> list[City]:
+        """Города с опечатками во вводе ("масква", "ниж новгород")."""
+        key = normalize_city(text)
+        if not key:
+            return []
+        counts: dict[str, int] = {}
+        for trigram in _trigrams(key):
+            for k in self._trigrams.get(trigram, ()):
+                counts[k] = counts.get(k, 0) + 1
+        max_distance = max(1, len(key) // 3)
+        candidates = sorted(counts, key=counts.get, reverse=True)[:50]
+        scored = []
+        for k in candidates:
+            distance = _levenshtein(key, k, max_distance)
+            if distance <= max_distance:
+                scored.append((distance, -counts[k], k))
+        result: list[City] = []
+        for _, _, k in sorted(scored):
+            city = self._cities[self._by_key[k]]
+            if city not in result:
+                result.append(city)
+            if len(result) >= limit:
+                break
+        return result
+
+    def suggest(self, text: str, limit: int = 5) -> list[City]:
+        """Подсказки для ввода: сначала по префиксу, затем нечеткие совпадения."""
+        result = self.prefix(text, limit)
+        for city in self.fuzzy(text, limit):
+            if len(result) >= limit:
+                break
+            if city not in result:
+                result.append(city)
+        return result
+
+# Общий справочник бота (заполняется при запуске, см. load_city_index)
+city_index = CityIndex()
+_builtin_loaded = False
+_builtin_lock = threading.Lock() # city_key вызывается и из потоков crud
+
+def _load_builtin_cities() -> None:
+    global _builtin_loaded
+    with _builtin_lock:
+        if _builtin_loaded:
+            return
+        if CITIES_FILE.exists():
+            for line in CITIES_FILE.read_text(encoding="utf-8").splitlines():
+                line = line.strip()
+                if not line or line.startswith("#"):
+                    continue
+                name, *aliases = [part.strip() for part in line.split("|")]
+                city_index.add(name, tuple(aliases))
+        _builtin_loaded = True
+
+def city_key(name: str) -> str:
+    """Ключ поиска для поездки (trips.departure_key/arrival_key, составной индекс маршрута).
+
+    Синонимы и латиница из справочника приводятся к ключу канонического названия: "Мск", "Moscow"
+    и "москва" дают "москва". Неизвестный город - normalize_city.
+    """
+    _load_builtin_cities()
+    city = city_index.resolve(name)
+    return normalize_city(city.name if city is not None else name)
+
+def load_city_index(extra_names=()) -> CityIndex:
+    """Загружает встроенный список городов и названия, уже встречающиеся в поездках."""
+    _load_builtin_cities()
+    for name in extra_names:
+        if name and name.strip():
+            city_index.add(name)
+    return city_index
@@ -1,9 +1,36 @@
 # src/utils/helpers.py
-from datetime import datetime
+from datetime import datetime, date
+from typing import Any, Callable, Hashable, Iterable, Iterator
+from src.config import RENDER_CACHE_SIZE, RENDER_CACHE_TTL
 from src.database.models import Trip, Booking, User
+from src.utils.cache import TTLCache
+
+# Кэш отрисованных карточек: ключ содержит Trip.version, который растет при любой записи crud
+# в поездку, ее водителя или профиль водителя, поэтому сбрасывать кэш не нужно. Хранится текст,
+# а не ORM-объекты. Популярная поездка (в поиске, "мои поездки", брони) отрисовывается один раз.
+_render_cache = TTLCache(maxsize=RENDER_CACHE_SIZE, ttl=RENDER_CACHE_TTL)
+
+def _cached_render(key: Hashable | None, render: Callable[[Any], str], obj: Any) -> str:
+    if key is None: # Поездка еще не записана в БД - версии нет
+        return render(obj)
+    text = _render_cache.get(key)
+    if text is None:
+        text = render(obj)
+        _render_cache.set(key, text)
+    return text
+
+def _trip_key(kind: str, trip: Trip) -> tuple | None:
+    return (kind, trip.id, trip.version) if trip.id is not None and trip.version is not None else None
+
+def get_render_cache_stats() -> dict:
+    """Счетчики кэша карточек (попадания, промахи, вытеснения)."""
+    return _render_cache.stats()
 
 def format_trip_details(trip: Trip) -> str:
     """Форматирует информацию о поездке для вывода пользователю."""
+    return _cached_render(_trip_key("trip", trip), _render_trip_details, trip)
+
+def _render_trip_details(trip: Trip) -> str:
     dep_dt = trip.departure_datetime.strftime("%d.%m.%Y %H:%M")
     arr_dt = trip.estimated_arrival_datetime.strftime("%H:%M") if trip.estimated_arrival_datetime else "не указано"
     driver_info = "Неизвестный водитель"
@@ -14,32 +41,47 @@ def format_trip_details(trip: Trip) -> str:
             driver_info += f" (Авто: {profile.car_make} {profile.car_model}, {profile.car_color}, {profile.car_plate})"
 
     return (
-        f" FONT="monospace"> Поездка #{trip.id}\n"
-        f" FONT="monospace"> Маршрут: {trip.departure_city} -> {trip.arrival_city}\n"
-        f" FONT="monospace"> Отправление: {dep_dt}\n"
-        f" FONT="monospace"> Прибытие (ориент.): {arr_dt}\n"
-        f" FONT="monospace"> Водитель: {driver_info}\n"
-        f" FONT="monospace"> Свободно мест: {trip.available_seats} из {trip.total_seats}\n"
-        f" FONT="monospace"> Статус: {trip.status}"
+        f"🚗 Поездка #{trip.id}\n"
+        f"📍 Маршрут: {trip.departure_city} -> {trip.arrival_city}\n"
+        f"🕒 Отправление: {dep_dt}\n"
+        f"🏁 Прибытие (ориент.): {arr_dt}\n"
+        f"👤 Водитель: {driver_info}\n"
+        f"💺 Свободно мест: {trip.available_seats} из {trip.total_seats}\n"
+        f"ℹ️ Статус: {trip.status}"
     )
 
 def format_booking_details(booking: Booking) -> str:
     """Форматирует информацию о бронировании."""
     if not booking.trip:
         return f"Бронирование #{booking.id} (поездка удалена)"
+    # Места и дата брони не меняются, статус - меняется; данные поездки - по ее версии
+    trip_key = _trip_key("booking", booking.trip)
+    key = trip_key + (booking.id, booking.status) if trip_key and booking.id is not None else None
+    return _cached_render(key, _render_booking_details, booking)
+
+def _render_booking_details(booking: Booking) -> str:
 
     trip_info = (f"{booking.trip.departure_city} -> {booking.trip.arrival_city} "
                  f"({booking.trip.departure_datetime.strftime('%d.%m %H:%M')})")
 
     return (
-        f" FONT="monospace"> Бронь #{booking.id}\n"
-        f" FONT="monospace"> Поездка: {trip_info}\n"
-        f" FONT="monospace"> Забронировано мест: {booking.seats_booked}\n"
-        f" FONT="monospace"> Статус: {booking.status}\n"
-        f" FONT="monospace"> Дата брони: {booking.booked_at.strftime('%d.%m.%Y %H:%M')}"
+        f"🎫 Бронь #{booking.id}\n"
+        f"🚗 Поездка: {trip_info}\n"
+        f"💺 Забронировано мест: {booking.seats_booked}\n"
+        f"ℹ️ Статус: {booking.status}\n"
+        f"📅 Дата брони: {booking.booked_at.strftime('%d.%m.%Y %H:%M')}"
     )
 
-def parse_date(date_str: str) -> datetime.date | None:
+def format_trip_button(trip: Trip) -> str:
+    """Текст кнопки поездки в результатах поиска: время - имя водителя - места."""
+    return _cached_render(_trip_key("button", trip), _render_trip_button, trip)
+
+def _render_trip_button(trip: Trip) -> str:
+    dep_time = trip.departure_datetime.strftime("%H:%M")
+    driver_name = trip.driver.full_name.split()[0] if trip.driver and trip.driver.full_name else "Водитель"
+    return f"{dep_time} - {driver_name} ({trip.available_seats} мест)"
+
+def parse_date(date_str: str) -> date | None:
     """Пытается распарсить дату из строки (ДД.ММ.ГГГГ или ДД.ММ)."""
     formats = ["%d.%m.%Y", "%d.%m"]
     today = datetime.now().date()
@@ -76,4 +118,37 @@ def parse_datetime(datetime_str: str) -> datetime | None:
             continue
     return None
 
+# Курсор постраничного поиска в callback_data: "<время отправления>_<id поездки>".
+# Время с микросекундами, чтобы курсор точно совпадал со значением в БД (callback_data - до 64 байт).
+_CURSOR_TIME_FORMAT = "%Y%m%d%H%M%S%f"
+
+def format_trip_cursor(cursor: tuple[datetime, int]) -> str:
+    departure_datetime, trip_id = cursor
+    return f"{departure_datetime.strftime(_CURSOR_TIME_FORMAT)}_{trip_id}"
+
+def parse_trip_cursor(cursor_str: str) -> tuple[datetime, int] | None:
+    """Разбирает курсор из callback_data. None, если строка повреждена."""
+    try:
+        time_str, trip_id = cursor_str.split("_")
+        return datetime.strptime(time_str, _CURSOR_TIME_FORMAT), int(trip_id)
+    except ValueError:
+        return None
+
+def chunk_lines(lines: Iterable[str], limit: int, header: str = "") -> Iterator[str]:
+    """Собирает строки в тексты не длиннее limit символов (сообщения Telegram), не разрывая строку.
+
+    Части копятся в списке и склеиваются один раз на сообщение. header добавляется в начало первого
+    текста. Строка длиннее limit обрезается.
+    """
+    parts, size = [header] if header else [], len(header)
+    for line in lines:
+        line = line[:limit]
+        if parts and size + len(line) > limit:
+            yield "".join(parts)
+            parts, size = [], 0
+        parts.append(line)
+        size += len(line)
+    if parts:
+        yield "".join(parts)
+
 # Можно добавить больше хелперов: валидация номера телефона, номера авто и т.д.
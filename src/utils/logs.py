@@ -0,0 +1,79 @@
+# src/utils/logs.py
+# Логирование через очередь: в обработчиках и crud запись только кладется в очередь (QueueHandler),
+# а в stderr ее пишет фоновый поток (QueueListener), поэтому медленный вывод не блокирует цикл событий.
+# Формат - текст или JSON (одна запись - одна строка), уровни можно задать отдельно для модулей.
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from datetime import datetime, timezone
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+class JsonFormatter(logging.Formatter):
+    """Запись в виде строки JSON: время, уровень, логгер, сообщение и traceback (если есть)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Аргументы подставляются в потоке, записавшем лог: объекты (модели SQLAlchemy) могут измениться,
+        # пока запись ждет в очереди. Traceback тоже форматируется здесь, а формат строки - в фоновом потоке.
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def parse_levels(spec: str) -> dict[str, str]:
+    """'src.handlers=DEBUG,httpx=WARNING' -> {'src.handlers': 'DEBUG', 'httpx': 'WARNING'}."""
+    levels = {}
+    for item in spec.split(','):
+        name, sep, level = item.partition('=')
+        if sep and name.strip() and level.strip():
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+_listener: logging.handlers.QueueListener | None = None
+
+def setup_logging(level: str = "INFO", fmt: str = "text", levels: str = "") -> None:
+    """Настраивает корневой логгер: очередь + фоновый поток вывода. Повторный вызов ничего не делает."""
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(sys.stderr)
+    stream_handler.setFormatter(JsonFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(_QueueHandler(log_queue))
+    root.setLevel(level.upper())
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+    _listener = logging.handlers.QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+def stop_logging() -> None:
+    """Дописывает записи из очереди и останавливает фоновый поток (при выходе из процесса)."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,245 @@
+# src/utils/metrics.py
+# Встроенные метрики без внешних зависимостей: время каждого обработчика, SQL-запросы с привязкой
+# к обработчику, в котором они выполнены, время вызовов Bot API. Отдаются в текстовом формате Prometheus
+# (GET /metrics на отдельном порту METRICS_PORT). Медленные запросы пишутся в лог.
+import bisect
+import functools
+import logging
+import time
+from contextvars import ContextVar
+from typing import Callable
+
+from aiohttp import web
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from telegram.ext import Application, ApplicationHandlerStop, BaseHandler, ConversationHandler
+from telegram.request import BaseRequest
+
+from src.config import METRICS_ENABLED, METRICS_PORT, METRICS_LISTEN, SLOW_QUERY_MS
+
+logger = logging.getLogger(__name__)
+
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+BACKGROUND = "background" # Запросы вне обработчиков: outbox, persistence, post_init
+
+class Histogram:
+    """Гистограмма Prometheus с одной меткой."""
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: tuple = TIME_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self.buckets = buckets
+        self._series: dict[str, list] = {} # значение метки -> [счетчики корзин..., sum, count]
+
+    def observe(self, label_value: str, value: float) -> None:
+        series = self._series.get(label_value)
+        if series is None:
+            series = self._series[label_value] = [0] * len(self.buckets) + [0.0, 0]
+        index = bisect.bisect_left(self.buckets, value) # Первая корзина с границей >= value
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_value, series in sorted(self._series.items()):
+            label = f'{self.label}="{_escape(label_value)}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {series[-1]}')
+            lines.append(f"{self.name}_sum{{{label}}} {series[-2]}")
+            lines.append(f"{self.name}_count{{{label}}} {series[-1]}")
+        return lines
+
+class Counter:
+    """Счетчик Prometheus с одной меткой."""
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help = help_text
+        self.label = label
+        self._values: dict[str, float] = {}
+
+    def inc(self, label_value: str, amount: float = 1) -> None:
+        self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f'{self.name}{{{self.label}="{_escape(value)}"}} {total}' for value, total in sorted(self._values.items())]
+        return lines
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+handler_duration = Histogram("bot_handler_duration_seconds", "Время обработчика апдейта", "handler")
+handler_errors = Counter("bot_handler_errors_total", "Исключения в обработчиках", "handler")
+handler_queries = Histogram("bot_handler_db_queries", "SQL-запросов за один вызов обработчика", "handler", COUNT_BUCKETS)
+query_duration = Histogram("bot_db_query_duration_seconds", "Время SQL-запросов по обработчикам", "handler")
+slow_queries = Counter("bot_db_slow_queries_total", f"SQL-запросы дольше {SLOW_QUERY_MS:g} мс", "handler")
+api_duration = Histogram("bot_telegram_api_duration_seconds", "Время вызовов Bot API", "method")
+api_errors = Counter("bot_telegram_api_errors_total", "Неуспешные вызовы Bot API (ошибка сети или статус не 200)", "method")
+_metrics = (handler_duration, handler_errors, handler_queries, query_duration, slow_queries, api_duration, api_errors)
+
+# Мгновенные значения (размер очереди, соединения пула): имя -> (описание, функция)
+_gauges: dict[str, tuple[str, Callable[[], float]]] = {}
+
+def register_gauge(name: str, help_text: str, func: Callable[[], float]) -> None:
+    _gauges[name] = (help_text, func)
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for name, (help_text, func) in sorted(_gauges.items()):
+        try:
+            value = func()
+        except Exception as e:
+            logger.warning("Метрика %s недоступна: %s", name, e)
+            continue
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {value}"]
+    return "\n".join(lines) + "\n"
+
+# --- Обработчики ---
+
+class _HandlerScope:
+    __slots__ = ("name", "queries")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.queries = 0
+
+_current_handler: ContextVar[_HandlerScope | None] = ContextVar("_current_handler", default=None)
+
+def _timed(callback, name: str):
+    @functools.wraps(callback)
+    async def wrapper(*args, **kwargs):
+        scope = _HandlerScope(name)
+        token = _current_handler.set(scope)
+        started = time.perf_counter()
+        try:
+            return await callback(*args, **kwargs)
+        except ApplicationHandlerStop:
+            raise # Штатное прерывание (фильтр заблокированных), не ошибка
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            handler_duration.observe(name, time.perf_counter() - started)
+            handler_queries.observe(name, scope.queries)
+            _current_handler.reset(token)
+    wrapper.__metrics_timed__ = True
+    return wrapper
+
+def _iter_handlers(handlers):
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _iter_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                yield from _iter_handlers(state_handlers)
+            yield from _iter_handlers(handler.fallbacks)
+        else:
+            yield handler
+
+def instrument_handlers(application: Application) -> int:
+    """Оборачивает callback каждого зарегистрированного обработчика (и обработчиков внутри
+    ConversationHandler) замером времени. Возвращает число обернутых."""
+    if not METRICS_ENABLED:
+        return 0
+    wrapped = 0
+    for group_handlers in application.handlers.values():
+        for handler in _iter_handlers(group_handlers):
+            callback = getattr(handler, "callback", None)
+            if not isinstance(handler, BaseHandler) or callback is None or getattr(callback, "__metrics_timed__", False):
+                continue # Один обработчик может стоять в нескольких состояниях диалога
+            module = callback.__module__.rsplit(".", 1)[-1]
+            handler.callback = _timed(callback, f"{module}.{callback.__name__}")
+            wrapped += 1
+    return wrapped
+
+# --- SQL-запросы ---
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("metrics_query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info["metrics_query_start"].pop()
+    scope = _current_handler.get()
+    name = scope.name if scope is not None else BACKGROUND
+    if scope is not None:
+        scope.queries += 1
+    query_duration.observe(name, elapsed)
+    if SLOW_QUERY_MS and elapsed * 1000 >= SLOW_QUERY_MS:
+        slow_queries.inc(name)
+        # Параметры не пишем: в них телефоны и имена пользователей
+        logger.warning("Медленный запрос (%.0f мс, %s): %s", elapsed * 1000, name, ' '.join(statement.split())[:1000])
+
+def instrument_engine(engine: Engine) -> None:
+    """Подключает замер запросов к движку (для асинхронного - к async_engine.sync_engine)."""
+    if METRICS_ENABLED:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+# --- Bot API ---
+
+class InstrumentedRequest(BaseRequest):
+    """Транспорт Bot API, замеряющий время каждого вызова; сам запрос выполняет обернутый транспорт."""
+
+    def __init__(self, request: BaseRequest):
+        self._request = request
+
+    @property
+    def read_timeout(self) -> float | None:
+        return self._request.read_timeout
+
+    async def initialize(self) -> None:
+        await self._request.initialize()
+
+    async def shutdown(self) -> None:
+        await self._request.shutdown()
+
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs) -> tuple[int, bytes]:
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter()
+        try:
+            status, body = await self._request.do_request(url, method, request_data, *args, **kwargs)
+        except Exception:
+            api_errors.inc(api_method)
+            raise
+        finally:
+            api_duration.observe(api_method, time.perf_counter() - started)
+        if status != 200:
+            api_errors.inc(api_method)
+        return status, body
+
+# --- Отдача метрик ---
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    """GET /metrics в текстовом формате Prometheus."""
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8",
+                        headers={"X-Content-Type-Options": "nosniff"})
+
+_runner: web.AppRunner | None = None
+
+async def start_server() -> None:
+    """Отдельный HTTP-сервер метрик на METRICS_PORT (если задан)."""
+    global _runner
+    if not METRICS_ENABLED or not METRICS_PORT or _runner is not None:
+        return
+    web_app = web.Application()
+    web_app.router.add_get("/metrics", handle_metrics)
+    _runner = web.AppRunner(web_app)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_LISTEN, METRICS_PORT).start()
+    logger.info("Метрики: http://%s:%s/metrics", METRICS_LISTEN, METRICS_PORT)
+
+async def stop_server() -> None:
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
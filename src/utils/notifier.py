@@ -0,0 +1,242 @@
+# src/utils/notifier.py
+# Отправка уведомлений (отмена поездки, новые брони, обращения в поддержку) в фоне.
+# Обработчик только ставит сообщение в очередь и сразу отвечает пользователю; отправкой занимается
+# пул воркеров с ограничением частоты по лимитам Telegram (общий и на каждый чат).
+import asyncio
+import logging
+import time
+from collections import deque
+from typing import Callable
+from telegram import Bot
+from telegram.error import RetryAfter, Forbidden, BadRequest, TimedOut, NetworkError
+
+from src.config import (NOTIFY_WORKERS, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_RATE,
+                        NOTIFY_QUEUE_SIZE, NOTIFY_MAX_ATTEMPTS)
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096 # Лимит Telegram на длину текста сообщения
+
+# Итог отправки, передаваемый в on_done
+SENT = "sent"
+REJECTED = "rejected" # Telegram отказал окончательно (бот заблокирован, чат не найден) - повторять бессмысленно
+FAILED = "failed" # Не удалось после всех попыток (сеть) - можно повторить позже
+
+class TokenBucket:
+    """Ограничитель частоты: rate токенов в секунду, не больше capacity подряд."""
+
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self) -> None:
+        async with self._lock: # Ждущие получают токены по очереди
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._refill(now)
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        """Не выдавать токены seconds секунд (ответ Telegram RetryAfter)."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    def idle(self, now: float) -> bool:
+        """Корзина полна и не на паузе - ее можно удалить, новая будет такой же."""
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._paused_until and not self._lock.locked()
+
+class NotificationDispatcher:
+    """Очередь уведомлений с пулом воркеров.
+
+    - notify() не ждет отправки: сообщение попадает в очередь чата, чат - в очередь готовых;
+    - один чат обрабатывается одним воркером за раз, поэтому порядок сообщений в чате сохраняется;
+    - несколько простых текстовых сообщений, накопившихся для чата, склеиваются в одно
+      (экономит лимит "1 сообщение в секунду на чат"), одинаковые подряд - отбрасываются;
+    - RetryAfter приостанавливает отправку (в чат или вся), затем сообщение повторяется;
+    - on_done(результат) вызывается после отправки (для склеенных сообщений - у каждого исходного).
+    """
+
+    def __init__(self, workers: int = NOTIFY_WORKERS, global_rate: float = NOTIFY_GLOBAL_RATE,
+                 chat_rate: float = NOTIFY_CHAT_RATE, max_queue: int = NOTIFY_QUEUE_SIZE,
+                 max_attempts: int = NOTIFY_MAX_ATTEMPTS):
+        self.workers = workers
+        self.chat_rate = chat_rate
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self._global_bucket = TokenBucket(global_rate) # Без всплесков: лимит Telegram считается по скользящему окну
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._pending: dict[int, deque] = {} # chat_id -> [[text, kwargs, on_done...]], еще не взятые воркером
+        self._in_flight: set[int] = set() # чаты, которые сейчас отправляет воркер
+        self._ready: asyncio.Queue[int] | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._bot: Bot | None = None
+        self._queued = 0
+        self.stats = {"queued": 0, "sent": 0, "coalesced": 0, "dropped": 0, "failed": 0, "retry_after": 0}
+
+    @property
+    def running(self) -> bool:
+        return bool(self._tasks)
+
+    @property
+    def queued(self) -> int:
+        """Сообщений в очереди, еще не взятых воркерами."""
+        return self._queued
+
+    def start(self, bot: Bot) -> None:
+        """Запускает воркеры (из post_init, когда цикл событий уже работает)."""
+        if self._tasks:
+            return
+        self._bot = bot
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(), name=f"notifier-{i}") for i in range(self.workers)]
+        logger.info("Очередь уведомлений запущена: %s воркеров", self.workers)
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Дожидается отправки очереди (не дольше timeout) и останавливает воркеры."""
+        if not self._tasks:
+            return
+        try:
+            await asyncio.wait_for(self._ready.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не отправлено уведомлений при остановке: %s", self._queued)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self, chat_id: int, text: str, on_done: Callable[[str], None] | None = None, **kwargs) -> bool:
+        """Ставит сообщение в очередь. False - очередь переполнена (сообщение отброшено)."""
+        callbacks = [on_done] if on_done else []
+        if self._queued >= self.max_queue:
+            self.stats["dropped"] += 1
+            logger.error("Очередь уведомлений переполнена, сообщение для %s отброшено", chat_id)
+            return False
+        pending = self._pending.get(chat_id)
+        if pending and not kwargs and pending[-1][:2] == [text, {}]:
+            self.stats["coalesced"] += 1 # Такое же сообщение уже ждет отправки
+            pending[-1][2].extend(callbacks)
+            return True
+        if pending is None:
+            pending = self._pending[chat_id] = deque()
+            if chat_id not in self._in_flight:
+                self._schedule(chat_id)
+        pending.append([text, kwargs, callbacks])
+        self._queued += 1
+        self.stats["queued"] += 1
+        return True
+
+    def notify_many(self, chat_ids, text: str, **kwargs) -> int:
+        """Одно сообщение нескольким получателям. Возвращает число поставленных в очередь."""
+        return sum(self.notify(chat_id, text, **kwargs) for chat_id in chat_ids)
+
+    def _schedule(self, chat_id: int) -> None:
+        if self._ready is None:
+            raise RuntimeError("Очередь уведомлений не запущена: вызовите notifier.start(bot)")
+        self._ready.put_nowait(chat_id)
+
+    def _take_batch(self, chat_id: int) -> list[list]:
+        """Забирает сообщения чата, склеивая подряд идущие простые тексты в пределах лимита длины."""
+        pending = self._pending.pop(chat_id)
+        batch: list[list] = []
+        while pending:
+            text, kwargs, callbacks = pending.popleft()
+            self._queued -= 1
+            if batch and not kwargs and not batch[-1][1] and len(batch[-1][0]) + len(text) + 2 <= MAX_MESSAGE_LENGTH:
+                batch[-1][0] = f"{batch[-1][0]}\n\n{text}"
+                batch[-1][2].extend(callbacks)
+                self.stats["coalesced"] += 1
+            else:
+                batch.append([text, kwargs, callbacks])
+        return batch
+
+    async def _worker(self) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            self._in_flight.add(chat_id)
+            batch: list[list] = []
+            reported = 0 # Сообщений пачки, по которым on_done уже вызван
+            try:
+                batch = self._take_batch(chat_id)
+                for text, kwargs, callbacks in batch:
+                    result = await self._send(chat_id, text, kwargs)
+                    reported += 1
+                    self._report(callbacks, result)
+            except Exception as e:
+                logger.error("Ошибка воркера уведомлений (чат %s): %s", chat_id, e, exc_info=True)
+            finally:
+                # on_done каждого взятого сообщения вызывается ровно один раз: не отправленные из-за ошибки
+                # или остановки получают FAILED, иначе их владелец (outbox) ждал бы результата вечно
+                if reported < len(batch):
+                    self.stats["failed"] += len(batch) - reported
+                    for _, _, callbacks in batch[reported:]:
+                        self._report(callbacks, FAILED)
+                self._in_flight.discard(chat_id)
+                if chat_id in self._pending:
+                    self._schedule(chat_id) # Пока отправляли, пришли новые сообщения
+                self._prune_buckets()
+                self._ready.task_done()
+
+    @staticmethod
+    def _report(callbacks: list[Callable[[str], None]], result: str) -> None:
+        for callback in callbacks:
+            try:
+                callback(result)
+            except Exception as e:
+                logger.error("Ошибка в on_done уведомления: %s", e, exc_info=True)
+
+    async def _send(self, chat_id: int, text: str, kwargs: dict) -> str:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+        attempt = 0
+        while attempt < self.max_attempts:
+            await bucket.acquire()
+            await self._global_bucket.acquire()
+            try:
+                await self._bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                self.stats["sent"] += 1
+                return SENT
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                delay = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else float(e.retry_after)
+                logger.warning("Telegram просит подождать %s с перед отправкой в чат %s", delay, chat_id)
+                bucket.pause(delay)
+                self._global_bucket.pause(delay) # Флуд-лимит может быть и общим - притормаживаем всех
+            except (Forbidden, BadRequest) as e:
+                # Пользователь заблокировал бота / чат не существует - повторять бессмысленно
+                self.stats["failed"] += 1
+                logger.warning("Уведомление в чат %s не доставлено: %s", chat_id, e)
+                return REJECTED
+            except (TimedOut, NetworkError) as e:
+                attempt += 1 # RetryAfter попыткой не считается: Telegram сам сказал, когда повторить
+                logger.warning("Сетевая ошибка при отправке в чат %s (попытка %s): %s", chat_id, attempt, e)
+                await asyncio.sleep(min(2 ** attempt, 30))
+        self.stats["failed"] += 1
+        logger.error("Уведомление в чат %s не доставлено после %s попыток", chat_id, self.max_attempts)
+        return FAILED
+
+    def _prune_buckets(self) -> None:
+        # Корзины чатов без отправок не храним, чтобы словарь не рос с числом пользователей
+        if len(self._chat_buckets) < 1024:
+            return
+        now = time.monotonic()
+        for chat_id in [c for c, b in self._chat_buckets.items() if c not in self._in_flight and b.idle(now)]:
+            del self._chat_buckets[chat_id]
+
+# Общая очередь бота (запускается в post_init, останавливается в post_shutdown)
+notifier = NotificationDispatcher()
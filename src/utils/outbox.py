@@ -0,0 +1,147 @@
+# src/utils/outbox.py
+# Фоновая отправка уведомлений из таблицы outbox (см. crud.OutboxItem).
+# Строки берутся пачками, передаются в очередь notifier (она соблюдает лимиты Telegram),
+# результаты отправки записываются в БД тоже пачками. Новые строки берутся, только пока очередь
+# notifier успевает разослать их до истечения аренды.
+import asyncio
+import functools
+import logging
+import uuid
+from datetime import datetime, timedelta
+
+from src.config import (OUTBOX_POLL_INTERVAL, OUTBOX_BATCH_SIZE, OUTBOX_LEASE_SECONDS,
+                        OUTBOX_MAX_ATTEMPTS, OUTBOX_RETENTION_HOURS, NOTIFY_GLOBAL_RATE)
+from src.database import async_crud
+from src.database.async_database import async_session_scope
+from src.utils.notifier import notifier, FAILED
+
+logger = logging.getLogger(__name__)
+
+class OutboxSender:
+    """Отправитель outbox: доставка "хотя бы один раз" с отсевом дублей по dedup_key.
+
+    После записи уведомлений обработчик вызывает wake(), чтобы не ждать очередного опроса.
+    max_queued - сколько сообщений может ждать в очереди notifier, чтобы взять еще строки. По умолчанию
+    столько, сколько notifier отправит за половину аренды: взятые строки уходят до ее истечения,
+    и попытки не тратятся на повторную аренду неотправленных строк.
+    """
+
+    def __init__(self, poll_interval: float = OUTBOX_POLL_INTERVAL, batch_size: int = OUTBOX_BATCH_SIZE,
+                 lease_seconds: float = OUTBOX_LEASE_SECONDS, max_attempts: int = OUTBOX_MAX_ATTEMPTS,
+                 max_queued: int | None = None):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.max_queued = max_queued if max_queued is not None else max(batch_size, int(lease_seconds * NOTIFY_GLOBAL_RATE / 2))
+        self.exhausted = 0 # Неотправленных строк, исчерпавших попытки (на момент последней проверки)
+        self._lease_token = uuid.uuid4().hex # Отличает строки этой реплики от строк других
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+        self._in_flight: set[int] = set()
+        self._sent: list[tuple[int, str | None]] = [] # (id, dedup_key), ждут записи в БД
+        self._failed: list[int] = []
+        self._next_purge = datetime.min
+        self._next_exhausted_check = datetime.min
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="outbox-sender")
+            logger.info("Отправитель outbox запущен.")
+
+    async def stop(self) -> None:
+        """Останавливает опрос. Результаты отправок записывает flush_results (после остановки notifier)."""
+        if self._task is None:
+            return
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._task = None
+
+    def wake(self) -> None:
+        """Проверить outbox сейчас, не дожидаясь интервала опроса."""
+        self._wakeup.set()
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush_results()
+                limit = min(self.batch_size, self.max_queued - notifier.queued)
+                if limit > 0 and await self._dispatch_batch(limit) >= limit:
+                    self._wakeup.set() # Outbox не пуст, а в очереди notifier есть место - берем следующую пачку сразу
+                # Иначе следующая пачка - после опроса: notifier тем временем разошлет часть очереди
+                await self._purge_if_due()
+                await self._check_exhausted_if_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Ошибка отправителя outbox: %s", e, exc_info=True)
+
+    async def _dispatch_batch(self, limit: int) -> int:
+        async with async_session_scope() as db:
+            rows = await async_crud.claim_outbox_batch(
+                db, limit, self.lease_seconds, self.max_attempts, self._lease_token)
+        for outbox_id, chat_id, text, dedup_key in rows:
+            if outbox_id in self._in_flight:
+                continue # Аренда истекла раньше, чем закончилась отправка
+            self._in_flight.add(outbox_id)
+            accepted = notifier.notify(chat_id, text, on_done=functools.partial(self._on_done, outbox_id, dedup_key))
+            if not accepted:
+                self._in_flight.discard(outbox_id)
+                self._failed.append(outbox_id)
+        return len(rows)
+
+    def _on_done(self, outbox_id: int, dedup_key: str | None, result: str) -> None:
+        # Вызывается воркером notifier; в БД пишется пачкой в flush_results
+        self._in_flight.discard(outbox_id)
+        if result == FAILED:
+            self._failed.append(outbox_id)
+        else:
+            self._sent.append((outbox_id, dedup_key)) # Отклоненные Telegram окончательно тоже закрываем
+
+    async def flush_results(self) -> None:
+        """Записывает в БД результаты завершенных отправок. Строки, отправка которых не завершилась,
+        останутся арендованными и будут взяты снова после истечения аренды."""
+        sent, self._sent = self._sent, []
+        failed, self._failed = self._failed, []
+        if not sent and not failed:
+            return
+        try:
+            async with async_session_scope() as db:
+                await async_crud.mark_outbox_sent(db, [i for i, _ in sent], [k for _, k in sent])
+                await async_crud.reschedule_outbox(db, failed, self.poll_interval * 10)
+        except Exception:
+            # Транзакция откатилась: возвращаем результаты, их запишет следующий вызов
+            self._sent[:0] = sent
+            self._failed[:0] = failed
+            raise
+
+    async def _purge_if_due(self) -> None:
+        now = datetime.now()
+        if now < self._next_purge:
+            return
+        self._next_purge = now + timedelta(hours=1)
+        async with async_session_scope() as db:
+            deleted = await async_crud.purge_outbox(db, now - timedelta(hours=OUTBOX_RETENTION_HOURS))
+        if deleted:
+            logger.info("Outbox: удалено старых отправленных уведомлений: %s", deleted)
+
+    async def _check_exhausted_if_due(self) -> None:
+        """Считает строки, исчерпавшие попытки: они больше не отправляются и остаются в таблице."""
+        now = datetime.now()
+        if now < self._next_exhausted_check:
+            return
+        self._next_exhausted_check = now + timedelta(seconds=self.lease_seconds) # Раньше новые не появятся
+        async with async_session_scope() as db:
+            exhausted = await async_crud.count_exhausted_outbox(db, self.max_attempts)
+        if exhausted > self.exhausted:
+            logger.error("Outbox: уведомлений, исчерпавших %s попыток и не отправленных: %s (было %s)",
+                         self.max_attempts, exhausted, self.exhausted)
+        self.exhausted = exhausted
+
+# Общий отправитель бота (запускается в post_init после notifier)
+outbox_sender = OutboxSender()
@@ -0,0 +1,169 @@
+# src/utils/persistence.py
+# Хранение user_data, chat_data, bot_data и состояний ConversationHandler в таблице bot_persistence,
+# чтобы перезапуск бота не обрывал регистрацию водителя, создание поездки и другие диалоги.
+# python-telegram-bot раз в update_interval передает только записи, которых касались апдейты;
+# из них в БД пишутся те, чье содержимое действительно изменилось, одной транзакцией.
+import asyncio
+import hashlib
+import json
+import logging
+import pickle
+from typing import Any
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+from src.config import PERSISTENCE_UPDATE_INTERVAL
+from src.database import async_crud
+from src.database.async_database import async_session_scope
+
+logger = logging.getLogger(__name__)
+
+USER_DATA = "user_data"
+CHAT_DATA = "chat_data"
+BOT_DATA = "bot_data"
+CONVERSATION = "conversation:" # + имя ConversationHandler
+
+def _digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+class SQLPersistence(BasePersistence):
+    """BasePersistence поверх нашей БД с отслеживанием изменений.
+
+    - для каждой записи хранится хэш последней записанной версии: неизменившиеся записи не пишутся;
+    - изменения одного цикла update_persistence собираются и пишутся одной транзакцией;
+    - если запись не удалась, изменения остаются и будут записаны в следующем цикле.
+    arbitrary_callback_data бот не использует, поэтому callback_data не сохраняется.
+    """
+
+    def __init__(self, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(callback_data=False), update_interval=update_interval)
+        self._written: dict[tuple[str, str], bytes] = {} # (namespace, key) -> хэш записанной версии
+        self._upserts: dict[tuple[str, str], bytes] = {} # ждут записи
+        self._deletes: set[tuple[str, str]] = set()
+        self._write_task: asyncio.Task | None = None
+        self.stats = {"staged": 0, "unchanged": 0, "written": 0, "deleted": 0, "transactions": 0}
+
+    # --- Чтение при старте ---
+
+    async def _load(self, namespace: str) -> dict[str, Any]:
+        async with async_session_scope() as db:
+            rows = await async_crud.load_persistence(db, namespace)
+        for key, data in rows.items():
+            self._written[(namespace, key)] = _digest(data)
+        return {key: pickle.loads(data) for key, data in rows.items()}
+
+    async def get_user_data(self) -> dict[int, dict]:
+        return {int(key): value for key, value in (await self._load(USER_DATA)).items()}
+
+    async def get_chat_data(self) -> dict[int, dict]:
+        return {int(key): value for key, value in (await self._load(CHAT_DATA)).items()}
+
+    async def get_bot_data(self) -> dict:
+        return (await self._load(BOT_DATA)).get("", {})
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> dict:
+        return {tuple(json.loads(key)): state for key, state in (await self._load(CONVERSATION + name)).items()}
+
+    # --- Изменения ---
+
+    def _stage(self, namespace: str, key: str, value: Any) -> None:
+        item = (namespace, key)
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        self._deletes.discard(item)
+        if self._written.get(item) == _digest(data):
+            self._upserts.pop(item, None)
+            self.stats["unchanged"] += 1
+            return
+        self._upserts[item] = data
+        self.stats["staged"] += 1
+
+    def _stage_delete(self, namespace: str, key: str) -> None:
+        item = (namespace, key)
+        self._upserts.pop(item, None)
+        if item in self._written:
+            self._deletes.add(item)
+
+    async def _commit_soon(self) -> None:
+        # update_persistence вызывает update_* параллельно (asyncio.gather): первый вызов запускает
+        # запись, которая ждет один проход цикла событий, чтобы остальные успели добавить свои изменения
+        if self._write_task is None:
+            self._write_task = asyncio.create_task(self._write_after_yield())
+        await asyncio.shield(self._write_task)
+
+    async def _write_after_yield(self) -> None:
+        await asyncio.sleep(0)
+        self._write_task = None
+        await self._write()
+
+    async def _write(self) -> None:
+        if not self._upserts and not self._deletes:
+            return
+        upserts, self._upserts = self._upserts, {}
+        deletes, self._deletes = self._deletes, set()
+        try:
+            async with async_session_scope() as db:
+                await async_crud.save_persistence(db, upserts, deletes)
+        except Exception:
+            # Возвращаем в очередь, не затирая более новые изменения тех же записей
+            for item, data in upserts.items():
+                if item not in self._deletes:
+                    self._upserts.setdefault(item, data)
+            self._deletes |= {item for item in deletes if item not in self._upserts}
+            raise
+        for item, data in upserts.items():
+            self._written[item] = _digest(data)
+        for item in deletes:
+            self._written.pop(item, None)
+        self.stats["written"] += len(upserts)
+        self.stats["deleted"] += len(deletes)
+        self.stats["transactions"] += 1
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._stage(USER_DATA, str(user_id), data)
+        await self._commit_soon()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._stage(CHAT_DATA, str(chat_id), data)
+        await self._commit_soon()
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._stage(BOT_DATA, "", data)
+        await self._commit_soon()
+
+    async def update_callback_data(self, data) -> None:
+        pass
+
+    async def update_conversation(self, name: str, key: tuple, new_state: object | None) -> None:
+        if new_state is None:
+            self._stage_delete(CONVERSATION + name, json.dumps(key))
+        else:
+            self._stage(CONVERSATION + name, json.dumps(key), new_state)
+        await self._commit_soon()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._stage_delete(USER_DATA, str(user_id))
+        await self._commit_soon()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._stage_delete(CHAT_DATA, str(chat_id))
+        await self._commit_soon()
+
+    # Данные живут только в этом процессе - перечитывать из БД нечего
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        pass
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        """Вызывается при остановке бота после последнего update_persistence."""
+        if self._write_task is not None:
+            await asyncio.gather(self._write_task, return_exceptions=True)
+        await self._write()
+        logger.info("Persistence: %s", self.stats)
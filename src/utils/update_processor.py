@@ -0,0 +1,62 @@
+# src/utils/update_processor.py
+import asyncio
+from typing import Any, Awaitable
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает апдейты разных пользователей параллельно, а апдейты одного пользователя - по очереди.
+
+    Общее число одновременно обрабатываемых апдейтов ограничено max_concurrent_updates.
+    Последовательная обработка апдейтов одного чата/пользователя нужна, чтобы состояния
+    ConversationHandler (регистрация, создание поездки, поиск) не перескакивали.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._locks: dict[tuple, asyncio.Lock] = {}
+        self._waiters: dict[tuple, int] = {} # Сколько задач держат/ждут блокировку ключа
+
+    @staticmethod
+    def _update_key(update: object) -> tuple | None:
+        if not isinstance(update, Update):
+            return None
+        chat_id = update.effective_chat.id if update.effective_chat else None
+        user_id = update.effective_user.id if update.effective_user else None
+        if chat_id is None and user_id is None:
+            return None
+        return (chat_id, user_id)
+
+    async def process_update(self, update: object, coroutine: Awaitable[Any]) -> None: # type: ignore[misc]
+        # Базовый process_update (помечен @final) берет слот семафора до do_process_update. Здесь порядок
+        # обратный: сначала очередь пользователя, затем слот. Иначе апдейты одного пользователя, ждущие
+        # своей очереди, занимали бы все max_concurrent_updates слотов и останавливали остальных.
+        key = self._update_key(update)
+        if key is None:
+            # Апдейты без пользователя и чата (например, опросы) упорядочивать не нужно
+            await super().process_update(update, coroutine)
+            return
+
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            # Удаляем блокировку, когда апдейтов этого пользователя больше нет, чтобы словарь не рос
+            self._waiters[key] -= 1
+            if not self._waiters[key]:
+                del self._waiters[key]
+                del self._locks[key]
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        self._locks.clear()
+        self._waiters.clear()
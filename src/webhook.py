@@ -0,0 +1,102 @@
+# src/webhook.py
+# Режим webhook: встроенный HTTP-сервер (aiohttp), принимающий апдейты от Telegram.
+# Позволяет запускать несколько реплик бота за балансировщиком.
+import asyncio
+import hmac
+import json
+import logging
+import signal
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Application
+
+from src.config import (WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_LISTEN, WEBHOOK_PORT,
+                        WEBHOOK_SECRET, WEBHOOK_MAX_BODY_SIZE)
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+APPLICATION_KEY = web.AppKey("application", Application)
+
+async def handle_update(request: web.Request) -> web.Response:
+    """Принимает апдейт от Telegram и ставит его в очередь приложения."""
+    application = request.app[APPLICATION_KEY]
+
+    if WEBHOOK_SECRET and not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET):
+        logger.warning("Запрос к вебхуку с неверным секретом от %s", request.remote)
+        return web.Response(status=403)
+
+    try:
+        # Размер тела ограничен client_max_size: при превышении aiohttp ответит 413
+        data = await request.json()
+        update = Update.de_json(data, application.bot)
+    except (json.JSONDecodeError, UnicodeDecodeError, TypeError, ValueError, KeyError) as e:
+        logger.warning("Некорректный апдейт в вебхуке: %s", e)
+        return web.Response(status=400)
+    if update is None:
+        return web.Response(status=400)
+
+    await application.update_queue.put(update)
+    return web.Response() # 200: Telegram не будет повторять доставку
+
+async def handle_health(request: web.Request) -> web.Response:
+    """Проверка живости для балансировщика/оркестратора."""
+    application = request.app[APPLICATION_KEY]
+    status = 200 if application.running else 503
+    return web.json_response(
+        {"status": "ok" if application.running else "stopped", "update_queue": application.update_queue.qsize()},
+        status=status,
+    )
+
+def build_webhook_app(application: Application) -> web.Application:
+    """Создает aiohttp-приложение с маршрутами вебхука и проверки здоровья.
+
+    Метрики здесь не отдаются: этот сервер доступен Telegram (а значит, всем), метрики - только
+    на отдельном сервере METRICS_LISTEN:METRICS_PORT.
+    """
+    web_app = web.Application(client_max_size=WEBHOOK_MAX_BODY_SIZE)
+    web_app[APPLICATION_KEY] = application
+    web_app.router.add_post(WEBHOOK_PATH, handle_update)
+    web_app.router.add_get("/health", handle_health)
+    return web_app
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме webhook и ждет сигнала остановки (SIGINT/SIGTERM)."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError: # Windows
+            pass
+
+    runner = web.AppRunner(build_webhook_app(application))
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await runner.setup()
+        await web.TCPSite(runner, WEBHOOK_LISTEN, WEBHOOK_PORT).start()
+        logger.info("Webhook-сервер слушает %s:%s%s", WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH)
+
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET or None,
+                allowed_updates=Update.ALL_TYPES,
+            )
+            logger.info("Вебхук зарегистрирован в Telegram: %s%s", WEBHOOK_URL, WEBHOOK_PATH)
+        else:
+            logger.warning("WEBHOOK_URL не задан: вебхук не регистрируется в Telegram (локальный режим).")
+
+        await stop_event.wait()
+    finally:
+        logger.info("Остановка webhook-сервера...")
+        await runner.cleanup()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)